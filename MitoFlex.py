@@ -29,17 +29,25 @@ import sys
 import traceback
 import time
 import shutil
+import copy
+import signal
 
 if sys.version_info[0] < 3:
     sys.exit('Python 3 must be installed in current environment! Please check if any of your environment setup (like conda environment) is deactivated or wrong!')
 
+# The submit client only sends the job to a served MitoFlex, so it's handled
+# before the modules are imported.
+if __name__ == '__main__' and sys.argv[1:2] == ['submit']:
+    from utility.server import submit
+    sys.exit(submit(sys.argv[2:]))
+
 try:
     from utility.parser import parse_func, freeze_arguments, arg_prop, parse_then_call
     from utility import logger
     from utility.helper import shell_call, timed
+    from utility import runner
     from arguments import *  # pylint: disable=unused-wildcard-import
     import configurations
-    from Bio import SeqIO
 except ModuleNotFoundError as identifier:
     print(
         f'Module {identifier.name} not found! Please check your MitoFlex installation!')
@@ -125,7 +133,8 @@ def assemble(args):
                                   kmer_list=args.kmer_list, depth_list=args.depth_list,
                                   prune_level=args.prune_level, prune_depth=args.prune_depth,
                                   keep_temp=args.keep_temp, threads=args.threads,
-                                  insert_size=args.insert_size, no_scaf=args.disable_scaffolding)
+                                  insert_size=args.insert_size, no_scaf=args.disable_scaffolding,
+                                  max_memory=args.max_memory)
 
     # Further processing for calling directly
     if args.__calling == 'assemble':
@@ -157,16 +166,21 @@ def findmitoscaf(args):
                 fq1, fq2 = fq2, fq1
             # Remapping to calculate average depth.
             from findmitoscaf.findmitoscaf import remap_sequence
-            args.fastafile = remap_sequence(args.workname, args.findmitoscaf_dir, filtered_fasta, args.fastq1, args.fastq2, args.threads)
+            args.fastafile = remap_sequence(args.workname, args.findmitoscaf_dir, filtered_fasta, args.fastq1, args.fastq2, args.threads,
+                                            cache_dir=path.join(args.temp_dir, 'mapping'))
         else:
             logger.log(2, "Remapping skipped since from-megahit is specified, no tagging needed.")
 
     from findmitoscaf.findmitoscaf import findmitoscaf as _findmitoscaf
+    from annotation.annotation_tookit import HitStore
+    # Kept for the annotation in the pipeline to reuse the nhmmer hits
+    args.hit_store = HitStore()
     picked_fa = _findmitoscaf(
         thread_number=args.threads, clade=args.clade, relaxing=args.taxa_tolerance, gene_code=args.genetic_code,
         multi=args.min_abundance, taxa=args.required_taxa if not args.disable_taxa else None,
         prefix=args.workname, basedir=args.findmitoscaf_dir, contigs_file=args.fastafile,
-        merge_method=args.merge_method, merge_overlapping=args.merge_overlap, merge_search=args.merge_start)
+        merge_method=args.merge_method, merge_overlapping=args.merge_overlap, merge_search=args.merge_start,
+        hit_store=args.hit_store)
 
     # Further processing for calling directly
     if args.__calling == 'findmitoscaf':
@@ -177,22 +191,24 @@ def findmitoscaf(args):
 
 @parse_func(func_help='annotate PCGs, tRNA and rRNA genes',
             parents=[universal_parser, fasta_parser, annotation_parser, saa_parser, search_parser])
+@arg_prop(dest='batch', help='a folder of fasta files, or a sample sheet with a sample name and a fasta file each line, to annotate many mitogenomes at once. fastafile is not needed then.')
 @timed(enabled=True)
 def annotate(args):
 
-    from annotation.annotation import annotate as _annotate, fix_circular
+    if getattr(args, 'batch', None):
+        return annotate_batch(args)
 
-    # Check assemble file, if only one sequence and itself is circular, the genome is then circular.
-    circular = False
-    if configurations.annotation.trim_circular:
-        circular = fix_circular(fa_file=args.fastafile)
+    from annotation.annotation import annotate as _annotate
+
+    circular = trim_genome(args)
 
     # Annotate the file
     annotate_json, fa_file, rna_file = _annotate(basedir=args.annotation_dir, prefix=args.workname,
                                                  ident=30, fastafile=args.fastafile, genetic_code=args.genetic_code,
                                                  clade=args.clade, thread_number=args.threads,
                                                  wildcard_profile=args.wider_taxa, trna_overlapping=30,
-                                                 hmmer_search=args.use_hmmer, score=args.hmmer_score, e_value=args.hmmer_e)
+                                                 hmmer_search=args.use_hmmer, score=args.hmmer_score, e_value=args.hmmer_e,
+                                                 hit_store=getattr(args, 'hit_store', None))
 
     # Further processing for calling directly
     if args.__calling == 'annotate':
@@ -227,6 +243,36 @@ def annotate(args):
     return annotate_json, circular, fa_file, rna_file
 
 
+def trim_genome(args):
+    # Check assemble file, if only one sequence and itself is circular, the genome is then circular.
+    # It's only checked once, since a trimmed genome won't look circular again.
+    if not hasattr(args, 'trimmed'):
+        from annotation.annotation import fix_circular
+        args.trimmed = configurations.annotation.trim_circular and fix_circular(fa_file=args.fastafile)
+    return args.trimmed
+
+
+def annotate_batch(args):
+    from annotation.batch import read_samples, annotate_batch as _annotate_batch
+
+    results = _annotate_batch(basedir=args.annotation_dir, prefix=args.workname, samples=read_samples(args.batch),
+                              ident=30, genetic_code=args.genetic_code, clade=args.clade,
+                              thread_number=args.threads, wildcard_profile=args.wider_taxa, trna_overlapping=30,
+                              hmmer_search=args.use_hmmer, score=args.hmmer_score, e_value=args.hmmer_e)
+
+    # Results of every sample are put in a folder of its name
+    for sample, (annotate_json, fa_file, rna_file, circular) in results.items():
+        sample_dir = path.join(args.result_dir, sample)
+        os.makedirs(sample_dir, exist_ok=True)
+        for file in (annotate_json, fa_file, rna_file):
+            os.rename(file, path.join(sample_dir, path.basename(file)))
+        print(sample, ':', path.join(sample_dir, path.basename(annotate_json)),
+              '(circular and trimmed)' if circular else '')
+    logger.log(2, f'{len(results)} samples annotated, results dumped at {args.result_dir}')
+
+    return results
+
+
 @parse_func(func_help='visualization of sequences',
             parents=[universal_parser, fasta_parser, fastq_parser])
 @arg_prop(dest='pos_json', help='specify the json file for marking genes')
@@ -234,17 +280,15 @@ def annotate(args):
 @timed(enabled=True)
 def visualize(args):
 
-    basedir = args.temp_dir if args.__calling == 'visualize' else path.join(
-        args.temp_dir, 'visualize')
-    try:
-        os.makedirs(basedir, exist_ok=True)
-    except Exception:
-        raise RuntimeError("Cannot validate folder for visualization!")
+    basedir = visualize_dir(args)
 
     from visualize.visualize import visualize as _visualize
     circos_png, circos_svg = _visualize(fasta_file=args.fastafile, fastq1=args.fastq1, fastq2=args.fastq2,
                                         pos_json=args.pos_json, prefix=args.workname, basedir=basedir,
-                                        threads=args.threads, circular=args.circular)
+                                        threads=args.threads, circular=args.circular,
+                                        cache_dir=path.join(args.temp_dir, 'mapping'),
+                                        depth=getattr(args, 'depth_track', None),
+                                        gc_file=getattr(args, 'gc_track', None))
 
     # Further processing for calling directly
     if args.__calling == 'visualize':
@@ -257,6 +301,16 @@ def visualize(args):
     return circos_png, circos_svg
 
 
+def visualize_dir(args):
+    basedir = args.temp_dir if args.__calling == 'visualize' else path.join(
+        args.temp_dir, 'visualize')
+    try:
+        os.makedirs(basedir, exist_ok=True)
+    except Exception:
+        raise RuntimeError("Cannot validate folder for visualization!")
+    return basedir
+
+
 @parse_func(func_help='run all the methods',
             parents=[universal_parser, assembly_parser, filter_parser, fastq_parser,
                      search_parser, saa_parser, annotation_parser])
@@ -281,19 +335,62 @@ def all(args):
         args.cleanq1 += '.gz'
         args.cleanq2 += '.gz'
 
-    if not args.disable_filter:
+    # Stages are run by what they depend on, the read mapping and the GC
+    # content of the visualization only need the final genome, so they are
+    # run along with the annotation.
+    from utility.stages import StageGraph
+    graph = StageGraph(threads=args.threads, on_change=lambda running: mark_stage(args, ','.join(running)))
+
+    def run_filter():
         args.fastq1, args.fastq2 = filter(args)
 
-    args.fastafile = assemble(args)
-    args.fastafile = findmitoscaf(args)
+    def run_assemble():
+        args.fastafile = assemble(args)
 
-    if not args.disable_annotation:
+    def run_findmitoscaf():
+        args.fastafile = findmitoscaf(args)
+
+    def run_trim():
+        trim_genome(args)
+
+    # Visualization is of no way if not annotated.
+    visualizing = not (args.disable_annotation or args.disable_visualization)
+    map_threads = max(1, args.threads // 4) if visualizing else 0
+    annotate_threads = max(1, args.threads - map_threads)
+
+    def run_annotate():
         (args.pos_json, args.circular,
-         args.annotated_cds, args.annotated_rna) = annotate(args)
+         args.annotated_cds, args.annotated_rna) = annotate(with_threads(args, annotate_threads))
+
+    def run_mapping():
+        from visualize.visualize import depth_track
+        args.depth_track = depth_track(fasta_file=args.fastafile, fastq1=args.fastq1, fastq2=args.fastq2,
+                                       prefix=args.workname, basedir=visualize_dir(args), threads=map_threads,
+                                       cache_dir=path.join(args.temp_dir, 'mapping'))
+
+    def run_gc():
+        from visualize.visualize import gc_track
+        args.gc_track = gc_track(fasta_file=args.fastafile, prefix=args.workname, basedir=visualize_dir(args))
 
-        # Visualization is of no way if not annotated.
-        args.circos_png, args.circos_svg = visualize(
-            args) if not args.disable_visualization else (None, None)
+    def run_visualize():
+        args.circos_png, args.circos_svg = visualize(args)
+
+    args.circos_png = args.circos_svg = None
+    args.pos_json = args.annotated_cds = args.annotated_rna = None
+    if not args.disable_filter:
+        graph.add('filter', run_filter, threads=args.threads)
+    graph.add('assemble', run_assemble, after=[] if args.disable_filter else ['filter'], threads=args.threads)
+    graph.add('findmitoscaf', run_findmitoscaf, after=['assemble'], threads=args.threads)
+    if not args.disable_annotation:
+        graph.add('trim', run_trim, after=['findmitoscaf'])
+        graph.add('annotate', run_annotate, after=['trim'], threads=annotate_threads)
+    if visualizing:
+        # A redirected genome is only known after the annotation
+        genome = ['annotate'] if configurations.annotation.redirection else ['trim']
+        graph.add('mapping', run_mapping, after=genome, threads=map_threads)
+        graph.add('gc', run_gc, after=genome)
+        graph.add('visualize', run_visualize, after=['annotate', 'mapping', 'gc'])
+    graph.run()
 
     # Add command check if there's something further
     # If you wrapped the 'all' module in other task or workflow
@@ -310,6 +407,44 @@ def all(args):
                        args.pos_json, args.fastafile,
                        args.annotated_cds, args.annotated_rna)
         logger.log(2, f'Results dumped at {args.result_dir}')
+    mark_stage(args, 'done')
+
+
+def with_threads(args, threads):
+    # Arguments of a stage running along with others
+    copied = copy.copy(args)
+    copied.threads = threads
+    return copied
+
+
+def mark_stage(args, stage):
+    # Lets a batch run know what the run is doing
+    with open(path.join(args.work_dir, f'{args.workname}.stage'), 'w') as f:
+        print(stage, file=f)
+
+
+@parse_func(func_help='run all the methods for many samples in a sample sheet on this node',
+            parents=[universal_parser])
+@arg_prop(dest='sample_sheet', help='a sample sheet with a sample name, fastq1 and an optional fastq2 each line.', required=True)
+@arg_prop(dest='sample_threads', help='threads given to the run of a single sample.', default=8)
+@arg_prop(dest='io_threads', help='threads counted for a sample when it\'s filtering or mapping reads, which mostly waits for the disk.', default=2)
+@arg_prop(dest='memory', help='memory in GB the whole batch could use, 0 to use the configured ratio of the available memory.', default=0.0)
+@arg_prop(dest='sample_memory', help='memory in GB given to the run of a single sample.', default=16.0)
+@arg_prop(dest='all_args', help='other arguments given to every run, like "--clade Chordata --disable-visualization".', default='')
+@timed(enabled=True)
+def batch(args):
+
+    from batch.batch import read_sheet, run_batch
+
+    samples = read_sheet(args.sample_sheet)
+    if args.sample_threads <= 0 or args.io_threads <= 0 or args.sample_memory <= 0:
+        raise RuntimeError('Threads and memory given to a sample should be larger than 0.')
+    summary = run_batch(samples=samples, basedir=args.work_dir, prefix=args.workname, threads=args.threads,
+                        sample_threads=min(args.sample_threads, args.threads), io_threads=args.io_threads,
+                        memory=args.memory, sample_memory=args.sample_memory, all_args=args.all_args)
+
+    os.rename(summary, path.join(args.result_dir, path.basename(summary)))
+    logger.log(2, f'Summary of the batch dumped at {args.result_dir}')
 
 
 @parse_func(func_help='Assemble, annotate and visualize mitogenome, but with a pipeline similar to MITObim',
@@ -380,6 +515,52 @@ def load_modules(args):
         logger.log(2, 'All modules are loaded correctly.')
 
 
+@parse_func(func_help='keep a MitoFlex running with modules and profiles loaded, and run jobs sent by MitoFlex.py submit [--socket <FILE>] <command> <arguments>')
+@arg_prop(dest='socket', help='the Unix socket to listen on.', default=configurations.serve.socket)
+@arg_prop(dest='workers', help='how many jobs could run at once.', default=4)
+@timed(enabled=False)
+def serve(args):
+
+    if args.workers <= 0:
+        raise RuntimeError('At least one worker should be given.')
+
+    # Loaded here, so every job forked from this process has them
+    logger.log(2, 'Loading modules and profiles.')
+    from filter.filter import filter_pe, filter_se
+    from assemble.assemble import assemble
+    from findmitoscaf.findmitoscaf import findmitoscaf
+    from annotation.annotation import annotate, profile_dir_hmm
+    from annotation.annotation_tookit import required_cds
+    from visualize.visualize import visualize
+    from utility.server import serve as _serve
+    from utility.taxonomy import taxonomy
+    taxonomy()
+    required_cds(path.join(profile_dir_hmm, 'required_cds.json'), configurations.findmitoscaf.default_clade)
+
+    parser = freeze_arguments('MitoFlex', desc)
+
+    def run_job(argv):
+        global start_time
+        start_time = time.time()
+        # The job logs and profiles on its own, not with the ones of the server
+        logger.finalize()
+        from utility import profiler
+        profiler.reset()
+        try:
+            parse_then_call(parser, pre=pre, post=post, argv=argv)
+        except SystemExit as err:
+            return err.code if isinstance(err.code, int) else int(err.code is not None)
+        except BaseException:
+            try:
+                sys.excepthook(*sys.exc_info())
+            except SystemExit:
+                pass
+            return 1
+        return 0
+
+    _serve(socket_path=args.socket, run_job=run_job, workers=args.workers)
+
+
 # This is for initializing the framework right before the command executed,
 # but after the arguments are processed. Pre will initialize something no
 # matter what command is called. Not pretty.
@@ -406,7 +587,7 @@ def pre(args):
         logger.log(3, 'Annotation is not enabled.')
 
     def runtime_error_logger(exception_type, value, tb):
-        if exception_type == RuntimeError:
+        if issubclass(exception_type, RuntimeError):
             logger.log(4, value)
             logger.log(
                 4,
@@ -446,6 +627,18 @@ def pre(args):
 
     sys.excepthook = runtime_error_logger
 
+    # Programs called are killed as well when MitoFlex is terminated, like
+    # by a batch or a hangup, since they would not be told otherwise.
+    def terminate(signum, frame):
+        try:
+            runner.cancel()
+            logger.log(3, f'MitoFlex was terminated by signal {signum}.')
+        finally:
+            sys.exit(128 + signum)
+
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, terminate)
+
 
 # This is for cleaning up temporal files generated by commands, and clean up
 # the environment to make a proper end.
@@ -459,6 +652,11 @@ def post(args):
         os.remove(args.cleanq1)
         if args.fastq2 != None:
             os.remove(args.cleanq2)
+    if hasattr(args, 'result_dir') and path.isdir(args.result_dir):
+        from utility import profiler
+        profiler.write_trace(path.join(args.result_dir, f'{args.workname}.trace.json'))
+        profiler.write_summary(path.join(args.result_dir, f'{args.workname}.stages.tsv'))
+        logger.log(1, f'Profile of the run is written to {args.result_dir}.')
     logger.log(2, f'All done! Time elapsed : {time.time()-start_time:.2f}s.')
     logger.finalize()
 
@@ -25,16 +25,22 @@ import os
 import sys
 from os import path
 import json
+import pickle
+import shutil
+import filecmp
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     sys.path.insert(0, os.path.abspath(os.path.join(
         os.path.dirname(os.path.abspath(__file__)), "..")))
     from utility.helper import concat_command
+    from utility.cache import Cache, file_digest
     from annotation import annotation_tookit as tk  # pylint: disable=import-error, no-name-in-module
     from Bio import SeqIO
     from Bio import BiopythonWarning
     from utility import logger
+    from utility.runner import cancel
     from misc.check_circular import check_circular
     import configurations
 except ImportError as identifier:
@@ -53,10 +59,155 @@ def concat_java(*args, **kwargs):
     return concat_command(*args, **kwargs).replace('--', '-')
 
 
+def rna_search(tracks, fastafile, basedir, prefix, threads, residues=None):
+    '''
+    Submits the tRNA and the rRNA search to the track executor, returns their
+    futures. threads are the ones of the tRNA and the rRNA search.
+    '''
+    trna_out_dir = path.join(basedir, 'trna')
+    os.makedirs(trna_out_dir, exist_ok=True)
+    rrna_out_dir = path.join(basedir, 'rrna')
+    os.makedirs(rrna_out_dir, exist_ok=True)
+
+    return (tracks.submit(tk.trna_hits, fastafile, profile_dir_trna, trna_out_dir, prefix, 0.01,
+                          threads=threads[0], residues=residues),
+            tracks.submit(tk.rrna_hits, fastafile, profile_dir_rrna, rrna_out_dir, prefix, 0.01,
+                          residues=residues, threads=threads[1]))
+
+
 def annotate(basedir=None, prefix=None, ident=30, fastafile=None,
              genetic_code=9, clade=None, thread_number=8,
-             wildcard_profile=False, trna_overlapping=40, hmmer_search=True, score=5, e_value=0.005):
+             wildcard_profile=False, trna_overlapping=40, hmmer_search=True, score=5, e_value=0.005,
+             hit_store=None):
     logger.log(2, 'Entering annotation module.')
+
+    cache, search_key, key = result_cache(
+        fastafile=fastafile, clade=clade, wildcard_profile=wildcard_profile,
+        searches=(ident, genetic_code), options=(trna_overlapping, hmmer_search, score, e_value))
+    entry = cache.lookup(key) if cache is not None else None
+    if entry is not None:
+        logger.log(2, 'Same annotation is found in the cache, reusing its results.')
+        return restore_results(entry, basedir, prefix, fastafile)
+
+    # Searches don't depend on how genes are picked from them, so only the
+    # picking is done again if just its options are changed.
+    searched = cache.lookup(search_key) if cache is not None else None
+    searches = restore_searches(searched, fastafile) if searched is not None else None
+    if searches is not None:
+        logger.log(2, 'Same searches are found in the cache, picking genes from their results.')
+        wise_frame, trnas, rrnas = searches
+    else:
+        wise_frame, trnas, rrnas = search_genes(
+            basedir=basedir, prefix=prefix, ident=ident, fastafile=fastafile, genetic_code=genetic_code,
+            clade=clade, thread_number=thread_number, wildcard_profile=wildcard_profile)
+        if cache is not None:
+            with cache.create(search_key) as staging:
+                shutil.copyfile(fastafile, path.join(staging, 'genome.fa'))
+                with open(path.join(staging, 'searches.pickle'), 'wb') as fout:
+                    pickle.dump((wise_frame, trnas, rrnas), fout)
+
+    def rescue():
+        return tk.nhmmer_rescue(fasta_file=fastafile, thread_number=thread_number,
+                                nhmmer_profile=profile_dir_hmm + f'/{clade}.hmm', prefix=prefix, basedir=basedir,
+                                hit_store=hit_store)
+
+    results = write_annotation(basedir=basedir, prefix=prefix, fastafile=fastafile, genetic_code=genetic_code,
+                               clade=clade, wise_frame=wise_frame, trnas=trnas, rrnas=rrnas,
+                               trna_overlapping=trna_overlapping, rescue=rescue if hmmer_search else None,
+                               score=score, e_value=e_value)
+
+    if cache is not None:
+        with cache.create(key) as staging:
+            for file, name in zip(results + (fastafile,), cached_files):
+                shutil.copyfile(file, path.join(staging, name))
+    return results
+
+
+# Files kept in a cached annotation, the final genome is kept as well since
+# it could be reversed by the annotation.
+cached_files = ('locs.json', 'cds.fa', 'rna.fa', 'genome.fa')
+
+
+def result_cache(fastafile=None, clade=None, wildcard_profile=False, searches=(), options=()):
+    '''
+    Returns the annotation cache, the key of the searches and the key of this
+    annotation, or None for all of them if the cache is disabled. The keys are
+    made of the input sequences, the options, configurations affecting the
+    results, the profiles used and the versions of the programs searching them.
+    '''
+    root = configurations.annotation.result_cache
+    if root is None:
+        return None, None, None
+    try:
+        cache = Cache(root, max_size=configurations.annotation.result_cache_size)
+    except OSError:
+        logger.log(3, f'Cannot use the annotation cache at {root}, it\'s disabled in this run.')
+        return None, None, None
+
+    if wildcard_profile:
+        tbn_profiles = [path.join(profile_dir_tbn, x) for x in sorted(os.listdir(profile_dir_tbn))
+                        if x.endswith('.fa') and x != 'Animal.fa']
+    else:
+        tbn_profiles = [path.join(profile_dir_tbn, f'{clade}.fa')]
+    cm_profiles = [path.join(folder, x)
+                   for folder in (profile_dir_trna, profile_dir_rrna)
+                   for x in sorted(os.listdir(folder)) if x.endswith('.cm')]
+    profiles = file_digest(*tbn_profiles, *cm_profiles,
+                           path.join(profile_dir, 'genewise', 'codon_InverMito.table'))
+    picking = file_digest(path.join(profile_dir_hmm, f'{clade}.hmm'),
+                          path.join(profile_dir_hmm, 'required_cds.json'))
+
+    # Results of an upgraded BLAST, GeneWise, Infernal or HMMER are not reused
+    versions = [tk.tool_version(program, flag) for program, flag in
+                (('tblastn', '-version'), ('genewise', '-version'), ('cmsearch', '-h'))]
+
+    conf = configurations.annotation
+    search_key = Cache.key('searches', file_digest(fastafile), clade, wildcard_profile, searches,
+                           conf.redirection, conf.overlap_ratio, profiles, versions)
+    key = Cache.key('annotation', search_key, options, conf.reloc_genes, conf.trna_min_score,
+                    picking, tk.tool_version('nhmmer', '-h'))
+    return cache, search_key, key
+
+
+def restore_searches(entry, fastafile):
+    '''
+    Returns the cached genewise results, tRNA hits and rRNA hits, with the
+    genome put in the direction they were searched in. None if they cannot be
+    loaded, like when pickled by another version of pandas.
+    '''
+    try:
+        with open(path.join(entry, 'searches.pickle'), 'rb') as fin:
+            searches = pickle.load(fin)
+    except Exception:
+        logger.log(3, 'Cached searches cannot be loaded, searching again.')
+        return None
+    if not filecmp.cmp(path.join(entry, 'genome.fa'), fastafile, shallow=False):
+        shutil.copyfile(path.join(entry, 'genome.fa'), fastafile)
+    return searches
+
+
+def restore_results(entry, basedir, prefix, fastafile):
+    results = (path.join(basedir, 'locs.json'),
+               path.join(basedir, f'{prefix}.annotated.cds.fa'),
+               path.join(basedir, f'{prefix}.annotated.rna.fa'),
+               fastafile)
+    for file, name in zip(results, cached_files):
+        # The genome may be read by other stages meanwhile, so it's only
+        # written if the annotation has changed it.
+        if file == fastafile and filecmp.cmp(path.join(entry, name), file, shallow=False):
+            continue
+        shutil.copyfile(path.join(entry, name), file)
+    return results[:3]
+
+
+def search_genes(basedir=None, prefix=None, ident=30, fastafile=None, genetic_code=9, clade=None,
+                 thread_number=8, wildcard_profile=False, residues=None, targets=None):
+    '''
+    Runs all the searches of the fasta file, returns the washed genewise
+    results, the tRNA hits and the 12S and 16S hits. Given the residues, the
+    searches are made as searching a genome of this size, and tblastn reports
+    hits on at most targets sequences for each query.
+    '''
     if wildcard_profile:
         logger.log(
             3, 'Wildcard protein profile is used, results may not be accurate.')
@@ -79,30 +230,73 @@ def annotate(basedir=None, prefix=None, ident=30, fastafile=None,
     tbn_profile = path.join(
         profile_dir_tbn, f'{clade if not wildcard_profile else "Animal"}.fa')
 
-    blast_file = tk.tblastn_multi(dbfile=tbn_profile, infile=fastafile, genetic_code=genetic_code,
-                                  basedir=basedir, prefix=prefix, threads=thread_number)
-    blast_frame, _ = tk.blast_to_csv(blast_file, ident=ident, score=25)
-    washed_frame = tk.wash_blast_results(blast_frame)
+    # PCGs, tRNAs and rRNAs only share the input fasta, so the RNA searches are
+    # run as background tracks while PCGs are annotated. A quarter of the
+    # threads is split between the two RNA tracks, since cmsearch on a
+    # mitogenome is far lighter than tblastn and genewise.
+    quarter = max(1, thread_number // 4)
+    trna_threads = max(1, quarter // 2)
+    rrna_threads = max(1, quarter - trna_threads)
+    pcg_threads = max(1, thread_number - trna_threads - rrna_threads)
+    rna_threads = (trna_threads, rrna_threads)
+    rna_tracks = None
+    with ThreadPoolExecutor(max_workers=2) as tracks:
+        try:
+            if not configurations.annotation.redirection:
+                rna_tracks = rna_search(tracks, fastafile, basedir, prefix, rna_threads, residues)
 
-    if configurations.annotation.redirection:
-        logger.log(2, 'Checking genome directions.')
-        if tk.redirect_genome(fasta_file=fastafile, blast_frame=blast_frame):
-            # Not fixing frame directly because I'm lazy, since later I'll need to fix tRNA and rRNA frames if so...
-            logger.log(2, "Genome is reversed, launching a second annotation to fix gene locations.")
             blast_file = tk.tblastn_multi(dbfile=tbn_profile, infile=fastafile, genetic_code=genetic_code,
-                                          basedir=basedir, prefix=prefix, threads=thread_number)
+                                          basedir=basedir, prefix=prefix, threads=pcg_threads,
+                                          dbsize=residues, max_targets=targets)
             blast_frame, _ = tk.blast_to_csv(blast_file, ident=ident, score=25)
             washed_frame = tk.wash_blast_results(blast_frame)
 
-    wise_frame, _, _ = tk.genewise(
-        basedir=basedir, prefix=prefix, wises=washed_frame,
-        infile=fastafile, dbfile=tbn_profile, cutoff=0.5)
-
-    # Add an extra washing here, since Pandas will have some
-    # strange behaviour processing data this large...
-    # Also prevent some mutation of ['plus']
-    wise_frame = tk.wash_blast_results(wise_frame, mut_plus=False)
-
+            if configurations.annotation.redirection:
+                logger.log(2, 'Checking genome directions.')
+                flipped = tk.redirect_genome(fasta_file=fastafile, blast_frame=blast_frame)
+                if flipped:
+                    # Hits on the reversed sequences are the same ones on the other
+                    # strand, so they are moved instead of searched again.
+                    logger.log(2, f"{len(flipped)} sequences are reversed, moving gene locations onto them.")
+                    blast_frame = tk.flip_blast_frame(blast_frame, flipped)
+                    washed_frame = tk.wash_blast_results(blast_frame, mut_plus=False)
+
+                # RNAs are searched only after the genome is put in its final direction
+                rna_tracks = rna_search(tracks, fastafile, basedir, prefix, rna_threads, residues)
+
+            wise_frame, _, _ = tk.genewise(
+                basedir=basedir, prefix=prefix, wises=washed_frame,
+                infile=fastafile, dbfile=tbn_profile, cutoff=0.5, threads=pcg_threads)
+
+            # Add an extra washing here, since Pandas will have some
+            # strange behaviour processing data this large...
+            # Also prevent some mutation of ['plus']
+            wise_frame = tk.wash_blast_results(wise_frame, mut_plus=False)
+
+            # Join the RNA tracks
+            trna_track, rrna_track = rna_tracks
+            trnas = trna_track.result()
+            rrnas = rrna_track.result()
+        except BaseException:
+            # The annotation fails as a whole, so the RNA searches are
+            # stopped and the programs still running are killed, instead of
+            # being waited for when the tracks are shut down.
+            for track in rna_tracks or ():
+                track.cancel()
+            cancel()
+            raise
+
+    return wise_frame, trnas, rrnas
+
+
+def write_annotation(basedir=None, prefix=None, fastafile=None, genetic_code=9, clade=None,
+                     wise_frame=None, trnas=None, rrnas=None, trna_overlapping=40,
+                     rescue=None, score=5, e_value=0.005):
+    '''
+    Picks genes from the search results of a single mitogenome, then writes
+    the locations and sequences. rescue is called for the nhmmer hits if
+    some PCGs are missing, None to disable it.
+    '''
     taxa_data = {}
     for _, row in wise_frame.iterrows():
         splited = str(row.qseq).split('_')
@@ -130,10 +324,8 @@ def annotate(basedir=None, prefix=None, ident=30, fastafile=None,
         wise_frame = tk.reloc_genes(fasta_file=fastafile,
                                     wises=wise_frame, code=genetic_code)
 
-    cds_indexes = {}
     cds_found = []
-    with open(path.join(profile_dir_hmm, 'required_cds.json')) as f:
-        cds_indexes = json.load(f)[clade]
+    cds_indexes = tk.required_cds(path.join(profile_dir_hmm, 'required_cds.json'), clade)
 
     for _, row in wise_frame.iterrows():
         cds = str(row).split('_')[3]
@@ -143,37 +335,29 @@ def annotate(basedir=None, prefix=None, ident=30, fastafile=None,
 
     cds_notfound = [x for x in cds_indexes if x not in cds_found]
     logger.log(2, f'PCGs found in annotation : {cds_found}')
-    if cds_notfound and not hmmer_search:
+    if cds_notfound and rescue is None:
         logger.log(3, f'Expected PCG {cds_notfound} not found!')
-    elif cds_notfound and hmmer_search:
+    elif cds_notfound:
         logger.log(
             3, f'Expected PCG {cds_notfound} not found, turning to nhmmer search.'
         )
-        hmmer_frame = tk.nhmmer_search(fasta_file=fastafile, thread_number=thread_number,
-                                       nhmmer_profile=profile_dir_hmm + f'/{clade}.hmm', prefix=prefix, basedir=basedir)
+        hmmer_frame = rescue()
         hmmer_frame = hmmer_frame[~hmmer_frame['query'].isin(cds_found)]
         hmmer_frame = hmmer_frame[hmmer_frame['e'] < e_value]
         hmmer_frame = hmmer_frame[hmmer_frame['score'] > score]
         logger.log(2, 'Recovered pcgs : \n' + str(hmmer_frame))
 
-    trna_out_dir = path.join(basedir, 'trna')
-    os.makedirs(trna_out_dir, exist_ok=True)
-
     # Disable some annoying warning
     with warnings.catch_warnings():
         warnings.simplefilter('ignore', BiopythonWarning)
-        query_dict, missing_trna = tk.trna_search(
-            fastafile, profile_dir_trna, trna_out_dir, prefix, genetic_code, 0.01, overlap_cutoff=trna_overlapping)
+        query_dict, missing_trna = tk.pick_trnas(trnas, gene_code=genetic_code,
+                                                 overlap_cutoff=trna_overlapping)
+    result_12, result_16 = (x[0] if x else None for x in rrnas)
 
     logger.log(2, f'tRNAs found : {list(query_dict.keys())}')
     if missing_trna:
         logger.log(3, f'Missing tRNAs : {missing_trna}')
 
-    rrna_out_dir = path.join(basedir, 'rrna')
-    os.makedirs(rrna_out_dir, exist_ok=True)
-    result_12, result_16 = tk.rrna_search(
-        fastafile, profile_dir_rrna, rrna_out_dir, prefix, 0.01)
-
     if not result_12:
         logger.log(3, '12s rRNA is not found!')
 
@@ -24,9 +24,11 @@ along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
 import os
 from os import path
 import sys
-import subprocess
-import multiprocessing
-from itertools import tee, chain
+import heapq
+import shutil
+from itertools import chain
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from pandas.core.frame import DataFrame
 
@@ -34,8 +36,10 @@ try:
     sys.path.insert(0, os.path.abspath(os.path.join(
         os.path.dirname(os.path.abspath(__file__)), "..")))
     from utility.helper import concat_command, direct_call, shell_call
+    from utility.runner import process_pool
+    from utility.cache import Cache, file_digest
     from utility import logger
-    from utility.bio import wuss, infernal
+    from utility.bio import wuss, infernal, codon
     import pandas
     import numpy as np
     from Bio import SeqIO
@@ -48,99 +52,168 @@ except ImportError as err:
         f"Unable to import helper module {err.name}, is the installation of MitoFlex valid?")
 
 
-# Truncates all the -- to - to suit blast's parsing style
-def truncated_call(*args, **kwargs):
-    return direct_call(concat_command(*args, **kwargs).replace('--', '-'))
+# Parsed profile json files, kept for the whole process
+_parsed_json = {}
 
 
-# Use multiprocessing to actually boost the search
-def tblastn_multi(dbfile=None, infile=None, genetic_code=9, basedir=None,
-                  prefix=None, threads=8):
+def required_cds(json_file, clade):
+    '''
+    Returns the required PCGs of the clade, the file is only parsed once in a
+    process, so jobs of a served MitoFlex share it.
+    '''
+    if json_file not in _parsed_json:
+        import json
+        with open(json_file) as f:
+            _parsed_json[json_file] = json.load(f)
+    return _parsed_json[json_file][clade]
 
-    infile = path.abspath(infile)
-    dbfile = path.abspath(dbfile)
 
-    truncated_call('makeblastdb', '-in', infile, dbtype='nucl')
+# Versions of the programs called, kept for the whole process
+_tool_versions = {}
 
-    tasks = []
 
-    protein_data_dir = path.join(basedir, 'tblastn_data')
+def tool_version(program, flag='-h'):
+    '''
+    Returns what the program prints with the flag, like its version or its
+    help with the version in the header. If that fails, the path, size and
+    time of the binary are used instead, which still change with an upgrade.
+    '''
+    if program not in _tool_versions:
+        try:
+            _tool_versions[program] = direct_call(f'{program} {flag}').strip()
+        except RuntimeError:
+            binary = shutil.which(program)
+            stat = os.stat(binary) if binary is not None else None
+            _tool_versions[program] = f'{binary} {stat.st_size} {stat.st_mtime_ns}' if stat else None
+    return _tool_versions[program]
 
+
+# Truncates all the -- to - to suit blast's parsing style
+def truncated_call(*args, **kwargs):
+    return direct_call(concat_command(*args, **kwargs).replace('--', '-'))
+
+
+def residue_chunks(records, parts, size=len):
+    '''
+    Cut records into at most parts consecutive chunks of similar total size,
+    so concatenated results of the chunks keep the order of the records.
+    '''
+    total = sum(size(x) for x in records)
+    chunks = []
+    load = 0
+    for record in records:
+        if not chunks or load >= total * len(chunks) / parts:
+            chunks.append([])
+        chunks[-1].append(record)
+        load += size(record)
+    return chunks
+
+
+def _call_shard(task):
+    idx, command = task
+    direct_call(command)
+    return idx
+
+
+def blast_shards(command=None, records=None, data_dir=None, out_blast=None, threads=8):
+    '''
+    Search the query records in many small residue balanced shards.
+
+    Shards are handed to the idle workers one by one, so a shard of long
+    proteins will not hold the other cores. Tabular results are written by
+    blast itself and appended to out_blast as soon as all the shards before
+    them are done, which keeps the order of a single blast run.
+    '''
     try:
-        os.mkdir(protein_data_dir)
+        os.mkdir(data_dir)
     except FileExistsError:
         raise RuntimeError(
             "Folder is already created, please make sure the working folder is clean.")
 
-    logger.log(1, f'Making {threads} small datasets for calling tblastn.')
-    tblastn_db = np.array_split(list(SeqIO.parse(dbfile, 'fasta')), threads)
-    for idx, data in enumerate(tblastn_db):
-        if data.any():
-            logger.log(0, f'Dataset {idx} has {len(data)} queries.')
-            dataset_path = path.join(protein_data_dir, f'dataset_{idx}.fasta')
-            SeqIO.write(data, dataset_path, 'fasta')
-            tasks.append(
-                f'tblastn -evalue 1e-5 -outfmt 6 -seg no -db_gencode {genetic_code} -db {infile} -query {dataset_path}')
-    logger.log(1, f'Generating map for calling tblastn.')
-    pool = multiprocessing.Pool(processes=threads)
-
-    out_blast = path.join(path.abspath(basedir), f'{prefix}.blast')
-    with open(out_blast, 'w') as f:
-        pool.map_async(direct_call, tasks, callback=lambda x: f.write(''.join(x)))
-        logger.log(1, f'Waiting for all processes to finish.')
-        pool.close()
-        pool.join()
+    tasks = []
+    outputs = []
+    for idx, data in enumerate(residue_chunks(records, threads * configurations.annotation.blast_shards)):
+        dataset_path = path.join(data_dir, f'dataset_{idx}.fasta')
+        SeqIO.write(data, dataset_path, 'fasta')
+        outputs.append(f'{dataset_path}.tsv')
+        tasks.append((idx, f'{command} -query {dataset_path} -out {outputs[-1]}'))
+    logger.log(1, f'Made {len(tasks)} small datasets from {len(records)} queries.')
+
+    finished = set()
+    written = 0
+    with process_pool(threads) as pool, open(out_blast, 'w') as f:
+        for idx in pool.imap_unordered(_call_shard, tasks):
+            finished.add(idx)
+            while written in finished:
+                with open(outputs[written]) as fin:
+                    shutil.copyfileobj(fin, f)
+                written += 1
 
     logger.log(1, f'Cleaning generated temp files.')
-    shell_call('rm -r', protein_data_dir)
-    os.remove(f'{infile}.nhr')
-    os.remove(f'{infile}.nin')
-    os.remove(f'{infile}.nsq')
+    shutil.rmtree(data_dir)
     return out_blast
 
 
-def blastn_multi(dbfile=None, infile=None, basedir=None, prefix=None, threads=8):
-    infile = path.abspath(infile)
-    dbfile = path.abspath(dbfile)
-
-    truncated_call('makeblastdb', '-in', infile, dbtype='nucl')
-
-    nucl_data_dir = path.join(basedir, "blastn_data")
-
-    try:
-        os.mkdir(nucl_data_dir)
-    except FileExistsError:
-        raise RuntimeError("Folder is already created, please make sure the working folder is clean.")
-
-    logger.log(1, f'Making {threads} small datasets for calling blastn.')
+@contextmanager
+def blast_db(fasta_file=None, basedir=None):
+    '''
+    Yields the nucleotide blast database of the fasta file, which is kept
+    until the block exits. Databases are cached by the content of the fasta
+    file, in the blastdb folder of the run temp folder, or the shared one in
+    configurations.
+    '''
+    root = configurations.annotation.blast_db_cache
+    if root is None:
+        root = path.join(path.dirname(path.abspath(basedir)), 'blastdb')
+    cache = Cache(root, max_entries=configurations.annotation.blast_db_entries)
+
+    key = Cache.key('nucl', file_digest(fasta_file))
+    with cache.hold(key) as entry:
+        if entry is None:
+            with cache.create(key) as staging:
+                truncated_call('makeblastdb', '-in', fasta_file, dbtype='nucl',
+                               out=path.join(staging, 'db'))
+            entry = cache.lookup(key)
+        else:
+            logger.log(1, f'Reusing cached blast database of {fasta_file}.')
+        yield path.join(entry, 'db')
 
-    file_names = [path.join(nucl_data_dir, f'dataset_{x}.fasta') for x in range(threads)]
 
-    tasks = [f'blastn -evalue 1e-5 -outfmt 6 -db {infile} -query {dataset_path}' for dataset_path in file_names]
-    seqs = [[] for i in range(threads)]
+# Use multiprocessing to actually boost the search
+def tblastn_multi(dbfile=None, infile=None, genetic_code=9, basedir=None,
+                  prefix=None, threads=8, dbsize=None, max_targets=None):
 
-    for i, seq in enumerate(SeqIO.parse(dbfile, 'fasta')):
-        seqs[i % threads].append(seq)
+    infile = path.abspath(infile)
+    dbfile = path.abspath(dbfile)
 
-    for i in range(threads):
-        SeqIO.write(seqs[i], file_names[i], 'fasta')
+    # Options for searching many genomes at once, E-values are computed as
+    # searching a genome of dbsize, and every genome may have a hit.
+    extra = ''
+    if dbsize is not None:
+        extra += f' -dbsize {int(dbsize)}'
+    if max_targets is not None:
+        extra += f' -max_target_seqs {int(max_targets)}'
+
+    with blast_db(infile, basedir) as database:
+        logger.log(1, f'Calling tblastn with {threads} processes.')
+        out_blast = blast_shards(
+            command=f'tblastn -evalue 1e-5 -outfmt 6 -seg no -db_gencode {genetic_code} -db {database}{extra}',
+            records=list(SeqIO.parse(dbfile, 'fasta')), data_dir=path.join(basedir, 'tblastn_data'),
+            out_blast=path.join(path.abspath(basedir), f'{prefix}.blast'), threads=threads)
 
-    logger.log(1, 'Generating map for calling blastn.')
-    pool = multiprocessing.Pool(processes=threads)
+    return out_blast
 
-    out_blast = path.join(path.abspath(basedir), f'{prefix}.blast')
-    with open(out_blast, 'w') as f:
-        pool.map_async(direct_call, tasks, callback=lambda x: f.write(''.join(x)))
-        pool.close()
-        logger.log(1, "Waiting for all processes to finish.")
-        pool.join()
 
-    logger.log(1, f'Cleaning generated temp files.')
+def blastn_multi(dbfile=None, infile=None, basedir=None, prefix=None, threads=8):
+    infile = path.abspath(infile)
+    dbfile = path.abspath(dbfile)
 
-    shell_call('rm -r', nucl_data_dir)
-    os.remove(f'{infile}.nhr')
-    os.remove(f'{infile}.nin')
-    os.remove(f'{infile}.nsq')
+    with blast_db(infile, basedir) as database:
+        logger.log(1, f'Calling blastn with {threads} processes.')
+        out_blast = blast_shards(
+            command=f'blastn -evalue 1e-5 -outfmt 6 -db {database}',
+            records=list(SeqIO.parse(dbfile, 'fasta')), data_dir=path.join(basedir, 'blastn_data'),
+            out_blast=path.join(path.abspath(basedir), f'{prefix}.blast'), threads=threads)
 
     return out_blast
 
@@ -170,6 +243,60 @@ def blast_to_csv(blast_file, ident=30, score=25):
     return blast_frame, out_blast_csv
 
 
+def _wash_picks(frame: pandas.DataFrame, cutoff):
+    '''
+    Positions of the results kept in a frame of a single sequence sorted by
+    sstart, in the order they are picked.
+    '''
+    sstart = frame.sstart.to_numpy()
+    send = frame.send.to_numpy()
+    qseqs = frame.qseq.astype(str).tolist()
+    genes = [qseq.split('_')[3] for qseq in qseqs]
+    spans = send - sstart
+    widest = spans.max() if len(spans) else 0
+
+    # The highest score result left is always the next alive one in this
+    # order, ties are broken by the position like head(1) does.
+    order = np.lexsort((np.arange(len(frame)), -frame.score.to_numpy()))
+    alive = np.ones(len(frame), dtype=bool)
+    same_gene = {}
+    picks = []
+
+    for pick in order:
+        if not alive[pick]:
+            continue
+        picks.append(pick)
+        alive[pick] = False
+
+        max_len = int(send[pick] - sstart[pick]) + 1
+        max_start = int(sstart[pick]) + 1
+        max_end = int(send[pick])
+        max_gene = genes[pick]
+        if max_gene not in same_gene:
+            same_gene[max_gene] = np.array([max_gene in qseq for qseq in qseqs])
+
+        # Only results starting in this window could overlap the pick.
+        low = np.searchsorted(sstart, max_start - widest, side='right')
+        high = np.searchsorted(sstart, max_end, side='left')
+        if low >= high:
+            continue
+        window = slice(low, high)
+
+        # Apply a conflict check for genes
+        # If the gene overlapping is equal to the highest, set
+        # the overlapping cutoff to 0 (No tolerance).
+        # The check is used for situations where multiple queries
+        # overlapped, but they all have a same PCG, which is
+        # hard to detect the border of the single gene.
+        conf = np.where(same_gene[max_gene][window], 0, max_len)
+        cutoffs = np.minimum(np.minimum(max_len, spans[window]), conf) * cutoff
+        overlays = np.minimum(send[window], max_end) - \
+            np.maximum(sstart[window], max_start)
+        alive[window] &= overlays <= cutoffs
+
+    return picks
+
+
 # Filter out the most important sequences
 def wash_blast_results(blast_frame: pandas.DataFrame = None, mut_plus=True):
     cutoff = configurations.annotation.overlap_ratio
@@ -186,37 +313,8 @@ def wash_blast_results(blast_frame: pandas.DataFrame = None, mut_plus=True):
     by_sseq = {key: value.sort_values('sstart')
                for key, value in by_sseq.items()}
 
-    results = []
-
-    for frame in by_sseq.values():
-        # Find all highest score results which does not overlap with
-        # any other sequences.
-        while not frame.empty:
-            highest = frame[frame.score == frame.score.max()].head(1)
-            results.append(highest)
-
-            max_len = int(highest.send - highest.sstart) + 1
-            max_start = int(highest.sstart) + 1
-            max_end = int(highest.send)
-            max_gene = str(highest.qseq).split('_')[3]
-
-            frame = frame.drop(highest.index)
-
-            # Apply a conflict check for genes
-            # If the gene overlapping is equal to the highest, set
-            # the overlapping cutoff to 0 (No tolerance).
-            # The check is used for situations where multiple queries
-            # overlapped, but they all have a same PCG, which is
-            # hard to detect the border of the single gene.
-            conf = ~frame.qseq.str.contains(max_gene)
-            conf = conf.map(lambda x: max_len if x else 0)
-
-            cutoffs = np.minimum(max_len, frame.send - frame.sstart)
-            cutoffs = np.minimum(cutoffs, conf) * cutoff
-
-            overlays = np.minimum(frame.send, max_end) - \
-                np.maximum(frame.sstart, max_start)
-            frame = frame[overlays <= cutoffs]
+    results = [frame.iloc[_wash_picks(frame, cutoff)]
+               for frame in by_sseq.values()]
 
     return pandas.concat(results)
 
@@ -224,7 +322,7 @@ def wash_blast_results(blast_frame: pandas.DataFrame = None, mut_plus=True):
 # Call genewise
 def genewise(basedir=None, prefix=None, codon_table=None,
              wises: pandas.DataFrame = None, infile=None,
-             dbfile=None, cutoff=0.5):
+             dbfile=None, cutoff=0.5, threads=1):
     wise_dir = path.abspath(
         path.join(path.dirname(__file__), '..', 'profile', 'genewise'))
 
@@ -256,13 +354,15 @@ def genewise(basedir=None, prefix=None, codon_table=None,
     env_var = dict(os.environ)
     env_var["WISECONFIGDIR"] = wise_cfg_dir
 
-    wises = wises.assign(wise_cover=np.nan, wise_shift=np.nan,
-                         wise_min_start=np.nan, wise_max_end=np.nan)
-
-    for index, wise in wises.iterrows():
+    # Query files are made in row order first, then genewise is run in a
+    # process pool, and results are gathered back in row order.
+    tasks = []
+    extended_starts = []
+    for idx, wise in enumerate(wises.itertuples(index=False)):
         # Extending search region for more sensitive finding
         extended_sstart = wise.sstart - 30 if wise.sstart > 30 else 0
         extended_send = min(wise.send + 30, len(queries[wise.sseq]))
+        extended_starts.append(extended_sstart)
 
         query_prefix = f'{wise.qseq}_{wise.sseq}_{extended_sstart}_{extended_send}'
         query_file = path.join(query_dir, f'{query_prefix}.fa')
@@ -273,198 +373,302 @@ def genewise(basedir=None, prefix=None, codon_table=None,
         SeqIO.write(queries[wise.sseq]
                     [extended_sstart:extended_send], query_file, 'fasta')
 
-        result = subprocess.check_output(
-            concat_command('genewise', codon=codon_table,
-                           trev=not wise.plus, genesf=True, gff=True, sum=True,
-                           appending=[
-                               path.join(dbdir, f'{wise.qseq}.fa'), query_file]
-                           ).replace("--", '-'), env=env_var, shell=True).decode('utf-8')
-        with open(path.join(basedir, 'genewise.txt'), 'a') as fgw:
+        tasks.append((idx, concat_command('genewise', codon=codon_table,
+                                          trev=not wise.plus, genesf=True, gff=True, sum=True,
+                                          appending=[
+                                              path.join(dbdir, f'{wise.qseq}.fa'), query_file]
+                                          ).replace("--", '-'), env_var))
+
+    logger.log(1, f'Calling genewise on {len(tasks)} alignments with {threads} processes.')
+    results = [None] * len(tasks)
+    parsed = [None] * len(tasks)
+    with process_pool(max(1, min(threads, len(tasks)))) as pool:
+        for idx, result in pool.imap_unordered(_call_genewise, tasks):
+            wise = wises.iloc[idx]
+            results[idx] = result
+            parsed[idx] = parse_genewise(result, extended_starts[idx], bool(wise.plus),
+                                         len(dbparsed[str(wise.qseq)]))
+
+    with open(path.join(basedir, 'genewise.txt'), 'a') as fgw:
+        for result in results:
             print(result, file=fgw)
 
-        # Parse the results
-        splited = result.split('//\n')
-        info = splited[0].split('\n')[1].split()
-
-        wise_cover = float(
-            int(info[3]) - int(info[2]) + 1) / len(dbparsed[str(wise.qseq)])
-
-        wise_result = [x.split('\t')
-                       for x in splited[2].split('\n')[:-1]
-                       if x.split('\t')[2] == 'cds']
-        for x in wise_result:
-            # Fix the actual position of seq
-            start, end = int(x[3]) + extended_sstart - 1, int(x[4]) + extended_sstart - 1
-            x[3] = min(start, end)
-            x[4] = max(start, end)
-        wise_result.sort(key=lambda x: x[3])
-        wise_shift = sum(x[2] == 'match' for x in wise_result) - 1
-        wise_start = min(x[3] for x in wise_result)
-        wise_end = max(x[4] for x in wise_result)
-
-        pandas.set_option('mode.chained_assignment', None)
-        wises['wise_cover'][index] = wise_cover
-        wises['wise_shift'][index] = wise_shift
-        wises['wise_min_start'][index] = wise_start if wise.plus else wise_end
-        wises['wise_max_end'][index] = wise_end if wise.plus else wise_start
+    columns = np.array(parsed, dtype=float).reshape(len(parsed), 4)
+    wises = wises.assign(wise_cover=columns[:, 0], wise_shift=columns[:, 1],
+                         wise_min_start=columns[:, 2], wise_max_end=columns[:, 3])
 
     wises.to_csv(path.join(basedir, f'{prefix}.wise.csv'), index=False)
     return wises, queries, dbparsed
 
 
-def reloc_genes(fasta_file=None, wises: pandas.DataFrame = None, code=9):
-    wise_seqs = {x.id: x for x in SeqIO.parse(fasta_file, 'fasta')}
-    wises.assign(start_real=np.nan, end_real=np.nan)
-    for _, wise in wises.iterrows():
-        start_real = end_real = -1
-        seq = wise_seqs[wise.sseq][wise.sstart - 29: wise.send + 30]
-        if not wise.plus:
-            seq = seq.reverse_complement()
-
-        # Truncating sequence to prevent future error of Biopython
-        if len(seq) % 3 != 0:
-            seq = seq[:-(len(seq) % 3)]
+def _call_genewise(task):
+    idx, command, env_var = task
+    return idx, direct_call(command, env=env_var)
+
+
+def parse_genewise(result, extended_sstart, plus, query_length):
+    '''
+    Returns wise_cover, wise_shift, wise_min_start and wise_max_end of a
+    genewise output.
+    '''
+    splited = result.split('//\n')
+    info = splited[0].split('\n')[1].split()
+
+    wise_cover = float(
+        int(info[3]) - int(info[2]) + 1) / query_length
+
+    wise_result = [x.split('\t')
+                   for x in splited[2].split('\n')[:-1]
+                   if x.split('\t')[2] == 'cds']
+    for x in wise_result:
+        # Fix the actual position of seq
+        start, end = int(x[3]) + extended_sstart - 1, int(x[4]) + extended_sstart - 1
+        x[3] = min(start, end)
+        x[4] = max(start, end)
+    wise_result.sort(key=lambda x: x[3])
+    wise_shift = sum(x[2] == 'match' for x in wise_result) - 1
+    wise_start = min(x[3] for x in wise_result)
+    wise_end = max(x[4] for x in wise_result)
+
+    return (wise_cover, wise_shift,
+            wise_start if plus else wise_end,
+            wise_end if plus else wise_start)
+
+
+def reloc_genes(fasta_file=None, wises: pandas.DataFrame = None, code=9, mercy=30):
+    '''
+    Moves the ends of genes to the nearest in-frame start codon before the
+    hit, and the first in-frame stop codon after it, both within mercy bps.
+    Incomplete stops (T or TA completed by polyadenylation) are taken if
+    there's no full stop nearby. Ends not found are left as they are.
+    '''
+    _, stops, starts = codon.table(code)
+    sequences = {x.id: x.seq for x in SeqIO.parse(fasta_file, 'fasta')}
+
+    # Codon sites of every strand are found once, genes on the minus strand
+    # are handled on the reverse complement.
+    strands = {}
+
+    def strand_sites(sseq, plus):
+        if (sseq, plus) not in strands:
+            encoded = codon.encode(sequences[sseq])
+            if not plus:
+                encoded = codon.reverse_complement(encoded)
+            strands[(sseq, plus)] = (encoded, codon.sites(encoded, stops), codon.sites(encoded, starts))
+        return strands[(sseq, plus)]
+
+    # Like genewise results, they are the start and the end of the gene
+    gene_starts = wises.wise_min_start.to_numpy().astype(float)
+    gene_ends = wises.wise_max_end.to_numpy().astype(float)
+    for row, (sseq, sstart, send, plus) in enumerate(zip(
+            wises.sseq.astype(str), wises.sstart.astype(int), wises.send.astype(int), wises.plus.astype(bool))):
+        encoded, stop_sites, start_sites = strand_sites(sseq, plus)
+        length = len(encoded)
+        begin, end = (sstart, send) if plus else (length - send + 1, length - sstart + 1)
+        frame = (begin - 1) % 3
+        start_real = end_real = None
 
-        try:
-            trans = seq.translate(9, cds=True)
-        except Exception:
-            trans = seq.translate(9)
         # Finding stop
-        if trans.seq.find('*') != -1:
-            offset = trans.seq.find('*') * 3
-            end_real = (wise.sstart + 1 + offset
-                        if wise.plus else
-                        wise.send - offset)
+        frame_stops = stop_sites[frame]
+        idx = np.searchsorted(frame_stops, begin)
+        if idx < len(frame_stops) and frame_stops[idx] <= end + mercy:
+            end_real = frame_stops[idx] + 2
         else:
-            mercy = seq[-30:] if wise.plus else seq[:30].reverse_complement()
-            offset = mercy.seq.find('TA')
-            if offset == -1:
-                offset = mercy.seq.find('T')
-
-            if offset != -1:
-                end_real = (
-                    wise.send + 30 + offset if wise.plus else wise.sstart - 28 - offset)
-
-        # Finding start
-        # Find the last M of mercied part of translated seq, where it should be the start codon
-        mercy = trans[:10:-1].seq.find('M')
-        if mercy != -1:
-            offset = (10 - mercy) * 3
-            start_real = wise.sstart + offset - 29 if wise.plus else wise.send + 30 + offset
-
-        wise.wise_min_start, wise.wise_max_end = (
-            start_real, end_real) if wise.plus else (end_real, start_real)
-
-    return wises
+            tail = encoded[end:end + mercy]
+            in_frame = (np.arange(end + 1, end + 1 + len(tail)) - begin) % 3 == 0
+            partial = np.flatnonzero(in_frame[:-1] & (tail[:-1] == 3) & (tail[1:] == 0))
+            if len(partial):
+                end_real = end + partial[0] + 2
+            else:
+                partial = np.flatnonzero(in_frame & (tail == 3))
+                if len(partial):
+                    end_real = end + partial[0] + 1
+
+        # Finding start, the last start codon before the hit
+        frame_starts = start_sites[frame]
+        idx = np.searchsorted(frame_starts, begin, side='right')
+        if idx > 0 and frame_starts[idx - 1] >= begin - mercy:
+            start_real = frame_starts[idx - 1]
+
+        if start_real is not None:
+            gene_starts[row] = start_real if plus else length - start_real + 1
+        if end_real is not None:
+            gene_ends[row] = end_real if plus else length - end_real + 1
+
+    return wises.assign(wise_min_start=gene_starts, wise_max_end=gene_ends)
 
 
 def redirect_genome(fasta_file=None, blast_frame: pandas.DataFrame = None):
-    reblast = False
+    '''
+    Reverse complements sequences having at least half of their hits on the
+    minus strand, returns the lengths of reversed sequences by their ids.
+    '''
+    # Washed frames have their sstart and send sorted already
+    if 'plus' in blast_frame:
+        minus = ~blast_frame.plus.astype(bool)
+    else:
+        minus = blast_frame.sstart > blast_frame.send
+    minus_ratio = minus.groupby(blast_frame.sseq.astype(str)).mean()
+    negatives = set(minus_ratio.index[minus_ratio >= 0.5])
+
+    flipped = {}
 
     def redirection(seq: SeqRecord):
-        nonlocal reblast
-        partial_frame = blast_frame[blast_frame.qseq == seq.id]
-
-        negative = len(partial_frame[partial_frame.sstart > partial_frame.send]) >= len(partial_frame) / 2
-        if negative:
-            reblast = True
-        return seq.reverse_complement(id=True, name=True, description=True) if negative else seq
+        if seq.id not in negatives:
+            return seq
+        flipped[seq.id] = len(seq)
+        return seq.reverse_complement(id=True, name=True, description=True)
 
     SeqIO.write([x for x in map(redirection, SeqIO.parse(fasta_file, 'fasta'))], fasta_file, 'fasta')
 
-    return reblast
-
-
-def trna_search(fasta_file=None, profile_dir=None, basedir=None, prefix=None, gene_code=9, e_value=0.001, overlap_cutoff=40):
+    return flipped
+
+
+def flip_blast_frame(blast_frame: pandas.DataFrame = None, flipped: dict = None):
+    '''
+    Moves washed blast results onto the reversed sequences, position x of a
+    sequence of length L is L - x + 1 after reversing, and the strand is
+    swapped.
+    '''
+    lengths = blast_frame.sseq.astype(str).map(flipped)
+    hit = lengths.notna().to_numpy()
+    lengths = lengths.fillna(0).to_numpy().astype(int)
+    sstart = blast_frame.sstart.to_numpy()
+    send = blast_frame.send.to_numpy()
+    plus = blast_frame.plus.to_numpy().astype(bool)
+    return blast_frame.assign(
+        sstart=np.where(hit, lengths - send + 1, sstart),
+        send=np.where(hit, lengths - sstart + 1, send),
+        plus=np.where(hit, ~plus, plus))
+
+
+def cm_database(profile_dir=None, basedir=None):
+    '''
+    Concatenates the covariance models in profile_dir into a single database
+    in basedir, returns the database file. The database is named by the
+    digest of the models, so it's only rebuilt if the models are changed.
+    '''
+    models = [path.join(profile_dir, x) for x in sorted(os.listdir(profile_dir))
+              if x.endswith('.cm')]
+    if not models:
+        raise RuntimeError(f'No covariance model found in {profile_dir}!')
+
+    database = path.join(basedir, f'{path.basename(profile_dir)}.{file_digest(*models)[:16]}.cm')
+    if not path.isfile(database):
+        logger.log(1, f'Building covariance model database of {profile_dir}.')
+        staging = f'{database}.{os.getpid()}.tmp'
+        with open(staging, 'wb') as fout:
+            for model in models:
+                with open(model, 'rb') as fin:
+                    shutil.copyfileobj(fin, fout)
+        os.replace(staging, database)
+    return database
+
+
+def trna_hits(fasta_file=None, profile_dir=None, basedir=None, prefix=None, e_value=0.001,
+              threads=1, residues=None):
+    '''
+    Searches all the tRNA models, returns the hits of every model. Given the
+    residues, E-values are computed as searching a genome of this size.
+    '''
     # Make sure it's the absolute path
     fasta_file = path.abspath(fasta_file)
     profile_dir = path.abspath(profile_dir)
     basedir = path.abspath(basedir)
 
-    codon_table = CodonTable.generic_by_id[gene_code]
-    forward_table = codon_table.forward_table
-
     infernal_file = path.join(basedir, f'{prefix}.infernal.out')
 
-    query_results = []
-    for idx, cm in enumerate(os.listdir(profile_dir)):
-        indexed = f'{infernal_file}.{idx}'
-        truncated_call('cmsearch', E=e_value, o=indexed, appending=[
-                       path.join(profile_dir, cm), fasta_file])
-        query_results.append(infernal.Infernal(indexed))
+    # All the models are searched in a single pass over the genome.
+    database = cm_database(profile_dir, basedir)
+
+    # Sequences are searched in residue balanced shards at once if there are
+    # many of them, the database size is then fixed to the whole file to keep
+    # the E-values unchanged.
+    records = list(SeqIO.parse(fasta_file, 'fasta'))
+    shards = [fasta_file]
+    if min(threads, len(records)) > 1:
+        if residues is None:
+            residues = sum(len(x) for x in records)
+        shards = []
+        for idx, batch in enumerate(balanced_split(records, min(threads, len(records)))):
+            shards.append(path.join(basedir, f'{prefix}.trna_shard.{idx}.fa'))
+            SeqIO.write(batch, shards[-1], 'fasta')
+
+    # Both strands are counted in the database size of cmsearch
+    tasks = [concat_command('cmsearch', E=e_value, o=f'{infernal_file}.{idx}',
+                            Z=2 * residues / 1e6 if residues is not None else None,
+                            cpu=max(1, threads // len(shards)), appending=[database, shard])
+             for idx, shard in enumerate(shards)]
+    # Threads are enough to wait for cmsearch, and it's safe to be called
+    # from an annotation track.
+    with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+        list(pool.map(direct_call, tasks))
+    return [align
+            for idx in range(len(tasks))
+            for align in infernal.Infernal(f'{infernal_file}.{idx}')]
+
+
+def trna_search(fasta_file=None, profile_dir=None, basedir=None, prefix=None, gene_code=9, e_value=0.001, overlap_cutoff=40,
+                threads=1, min_score=configurations.annotation.trna_min_score):
+    alignments = trna_hits(fasta_file=fasta_file, profile_dir=profile_dir, basedir=basedir,
+                           prefix=prefix, e_value=e_value, threads=threads)
+    return pick_trnas(alignments, gene_code=gene_code, overlap_cutoff=overlap_cutoff, min_score=min_score)
+
+
+def pick_trnas(alignments=None, gene_code=9, overlap_cutoff=40, min_score=configurations.annotation.trna_min_score):
+    '''
+    Reads the anticodon of tRNA hits, then resolves the overlapped ones.
+    Returns the picked tRNAs by their amino acids, and the missing ones.
+    '''
+    codon_table = CodonTable.generic_by_id[gene_code]
+    forward_table = codon_table.forward_table
 
     gene_map = []
 
-    for result in query_results:
-        for align in result.alignments:
-            loop = align.alignment
-
-            # Get the main loop of tRNA
-            main = [x for x in loop.components if isinstance(
-                x, wuss.MultiLoop)]
-            if not main:
-                continue
-            main = main[0]
-
-            # Get the three hairpin loops of the main loop
-            hairpins = [x for x in main.components if isinstance(
-                x, wuss.HairpinLoop)]
-            if len(hairpins) < 2:
-                continue
-
-            # Get the center hairpin loop (anticodon arm)
-            # No gap is allowed
-            center = hairpins[1]
-            if len(center.hairpin.sequence) != 7:
-                continue
-
-            # Can't read the center tri-base codon
-            if '-' in center.hairpin.to_str()[2:5]:
-                logger.log(
-                    1, f'Unqualified fold discarded, central hairpin : {center.hairpin.to_str()}, sequence : {center.sequence}')
-                continue
-
-            code = Seq(center.hairpin.to_str()[2:5]).reverse_complement()
-            amino = forward_table[code]
-
-            align.amino = amino
-            align.length = max(align.seqfrom, align.seqto) - \
-                min(align.seqfrom, align.seqto)
-            gene_map.append((align.seqfrom, align))
-            gene_map.append((align.seqto, align))
+    for align in alignments:
+        # Hits are folded only if they pass the score valve
+        if align.score < min_score:
+            continue
+        loop = align.alignment
+
+        # Get the main loop of tRNA
+        main = [x for x in loop.components if isinstance(
+            x, wuss.MultiLoop)]
+        if not main:
+            continue
+        main = main[0]
+
+        # Get the three hairpin loops of the main loop
+        hairpins = [x for x in main.components if isinstance(
+            x, wuss.HairpinLoop)]
+        if len(hairpins) < 2:
+            continue
+
+        # Get the center hairpin loop (anticodon arm)
+        # No gap is allowed
+        center = hairpins[1]
+        if len(center.hairpin.sequence) != 7:
+            continue
+
+        # Can't read the center tri-base codon
+        if '-' in center.hairpin.to_str()[2:5]:
+            logger.log(
+                1, f'Unqualified fold discarded, central hairpin : {center.hairpin.to_str()}, sequence : {center.sequence}')
+            continue
+
+        code = Seq(center.hairpin.to_str()[2:5]).reverse_complement()
+        amino = forward_table[code]
+
+        align.amino = amino
+        align.length = max(align.seqfrom, align.seqto) - \
+            min(align.seqfrom, align.seqto)
+        gene_map.append((align.seqfrom, align))
+        gene_map.append((align.seqto, align))
 
     gene_map.sort(key=lambda x: x[0])
 
-    gene_map = [x[1] for x in gene_map]
-
     # Then find the most possible of all
-    def overlapped(mapping: list):
-        def pairwise(iterable):
-            a, b = tee(iterable)
-            next(b, None)
-            return zip(a, b)
-
-        for gene_loc, pair_loc in pairwise(mapping):
-            dist = max(gene_loc.seqfrom, gene_loc.seqto) - \
-                min(pair_loc.seqfrom, pair_loc.seqto)
-            if gene_loc != pair_loc and dist >= overlap_cutoff and (dist <= gene_loc.length or dist <= pair_loc.length):
-                if gene_loc.score >= pair_loc.score:
-                    logger.log(
-                        0, f'conflict of {gene_loc.amino} and {pair_loc.amino}, removing {pair_loc.amino}, score:{gene_loc.score}, {pair_loc.score}, overlapping : {dist}')
-                    while pair_loc in mapping:
-                        mapping.remove(pair_loc)
-                else:
-                    logger.log(
-                        0, f'conflict of {gene_loc.amino} and {pair_loc.amino}, removing {gene_loc.amino}, score:{gene_loc.score}, {pair_loc.score}, overlapping : {dist}')
-                    while gene_loc in mapping:
-                        mapping.remove(gene_loc)
-                return True
-        return False
-
-    while overlapped(gene_map):
-        pass
-
-    gene_map = list(set(gene_map))
+    gene_map = resolve_trnas([x[1] for x in gene_map], overlap_cutoff)
 
     # Normalize the results
     query_dict = {}
@@ -480,7 +684,72 @@ def trna_search(fasta_file=None, profile_dir=None, basedir=None, prefix=None, ge
     return query_dict, missing_trnas
 
 
-def rrna_search(fasta_file=None, profile_dir=None, basedir=None, prefix=None, e_value=None):
+def resolve_trnas(mapping: list, overlap_cutoff=40):
+    '''
+    Removes the conflicted tRNAs from the ends of hits sorted by position,
+    returns the remained ones by the order they first appear.
+
+    It gives the same result as scanning the neighbouring ends from the start
+    over and over, and dropping both ends of the lower scored one in the first
+    conflict found. Only neighbours made by a removal can become a new
+    conflict, so conflicts are kept in a heap by their position, and every
+    end is removed from a linked list.
+    '''
+    count = len(mapping)
+    following = list(range(1, count + 1))
+    previous = list(range(-1, count - 1))
+    alive = [True] * count
+    ends = {}
+    for idx, gene in enumerate(mapping):
+        ends.setdefault(id(gene), []).append(idx)
+
+    def conflicted(idx):
+        if idx < 0 or not alive[idx] or following[idx] >= count:
+            return False
+        gene_loc, pair_loc = mapping[idx], mapping[following[idx]]
+        dist = max(gene_loc.seqfrom, gene_loc.seqto) - \
+            min(pair_loc.seqfrom, pair_loc.seqto)
+        return gene_loc is not pair_loc and dist >= overlap_cutoff and \
+            (dist <= gene_loc.length or dist <= pair_loc.length)
+
+    heap = [idx for idx in range(count - 1) if conflicted(idx)]
+    heapq.heapify(heap)
+    while heap:
+        idx = heapq.heappop(heap)
+        if not conflicted(idx):
+            continue
+        gene_loc, pair_loc = mapping[idx], mapping[following[idx]]
+        dist = max(gene_loc.seqfrom, gene_loc.seqto) - \
+            min(pair_loc.seqfrom, pair_loc.seqto)
+        if gene_loc.score >= pair_loc.score:
+            loser = pair_loc
+            logger.log(
+                0, f'conflict of {gene_loc.amino} and {pair_loc.amino}, removing {pair_loc.amino}, score:{gene_loc.score}, {pair_loc.score}, overlapping : {dist}')
+        else:
+            loser = gene_loc
+            logger.log(
+                0, f'conflict of {gene_loc.amino} and {pair_loc.amino}, removing {gene_loc.amino}, score:{gene_loc.score}, {pair_loc.score}, overlapping : {dist}')
+
+        for end in ends[id(loser)]:
+            if not alive[end]:
+                continue
+            alive[end] = False
+            before, after = previous[end], following[end]
+            if before >= 0:
+                following[before] = after
+            if after < count:
+                previous[after] = before
+            if conflicted(before):
+                heapq.heappush(heap, before)
+
+    return list(dict.fromkeys(gene for idx, gene in enumerate(mapping) if alive[idx]))
+
+
+def rrna_hits(fasta_file=None, profile_dir=None, basedir=None, prefix=None, e_value=None, residues=None,
+              threads=1):
+    '''
+    Returns the 12S and 16S hits by their ranks.
+    '''
     # Just make sure.
     fasta_file = path.abspath(fasta_file)
     profile_dir = path.abspath(profile_dir)
@@ -493,20 +762,58 @@ def rrna_search(fasta_file=None, profile_dir=None, basedir=None, prefix=None, e_
     query_12 = path.join(basedir, '12s.out')
     query_16 = path.join(basedir, '16s.out')
 
-    truncated_call('cmsearch', E=e_value, o=query_12,
-                   appending=[cm_12s, fasta_file])
-    truncated_call('cmsearch', E=e_value, o=query_16,
-                   appending=[cm_16s, fasta_file])
+    # 12S and 16S are searched at the same time, sharing the threads
+    size = 2 * residues / 1e6 if residues is not None else None
+    tasks = [concat_command('cmsearch', E=e_value, Z=size, o=out, cpu=max(1, threads // 2),
+                            appending=[cm_file, fasta_file])
+             for out, cm_file in [(query_12, cm_12s), (query_16, cm_16s)]]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        list(pool.map(direct_call, tasks))
 
-    result_12 = infernal.Queries(query_12)
-    result_16 = infernal.Queries(query_16)
+    return (infernal.Queries(query_12).queries,
+            infernal.Queries(query_16).queries)
 
-    return (result_12.queries[0] if result_12.queries else None,
-            result_16.queries[0] if result_16.queries else None)
+
+def rrna_search(fasta_file=None, profile_dir=None, basedir=None, prefix=None, e_value=None):
+    result_12, result_16 = rrna_hits(fasta_file=fasta_file, profile_dir=profile_dir,
+                                     basedir=basedir, prefix=prefix, e_value=e_value)
+    return (result_12[0] if result_12 else None,
+            result_16[0] if result_16 else None)
+
+
+def balanced_split(records, parts, size=len):
+    '''
+    Split records into at most parts batches of balanced total size.
+    Largest records are dealt first to the lightest batch, records in a batch
+    keep their original order.
+    '''
+    loads = [(0, i) for i in range(max(1, parts))]
+    batches = [[] for _ in loads]
+    for idx, record in sorted(enumerate(records), key=lambda x: size(x[1]), reverse=True):
+        load, i = heapq.heappop(loads)
+        batches[i].append((idx, record))
+        heapq.heappush(loads, (load + size(record), i))
+    return [[record for _, record in sorted(batch, key=lambda x: x[0])]
+            for batch in batches if batch]
+
+
+def sort_nhmmer_hits(hmm_frame: pandas.DataFrame = None, nhmmer_profile=None):
+    '''
+    Restore the order of a single nhmmer run, hits are listed by the query
+    order in profile, then by significance.
+    '''
+    with open(nhmmer_profile) as f:
+        query_order = {}
+        for line in f:
+            if line.startswith('NAME'):
+                query_order.setdefault(line.split()[1], len(query_order))
+    hmm_frame = hmm_frame.assign(query_order=hmm_frame['query'].map(query_order))
+    hmm_frame = hmm_frame.sort_values(['query_order', 'e'], kind='mergesort')
+    return hmm_frame.drop(columns=['query_order']).reset_index(drop=True)
 
 
 def nhmmer_search(fasta_file=None, thread_number=None, nhmmer_profile=None,
-                  prefix=None, basedir=None):
+                  prefix=None, basedir=None, shards=1, residues=None):
 
     logger.log(1, 'Calling nhmmer.')
 
@@ -514,8 +821,45 @@ def nhmmer_search(fasta_file=None, thread_number=None, nhmmer_profile=None,
     hmm_out = os.path.join(basedir, f'{prefix}.nhmmer.out')
     hmm_tbl = os.path.join(basedir, f'{prefix}.nhmmer.tblout')
     logger.log(1, f'Out file : o={hmm_out}, tbl={hmm_tbl}')
-    shell_call('nhmmer', o=hmm_out, tblout=hmm_tbl,
-               cpu=thread_number, appending=[nhmmer_profile, fasta_file])
+
+    records = list(SeqIO.parse(fasta_file, 'fasta')) if shards > 1 else []
+    if len(records) < shards:
+        shards = 1
+
+    if shards > 1:
+        # nhmmer threading scales poorly, so the contigs are searched as
+        # several residue balanced batches concurrently instead. Database
+        # size is fixed to the whole file to keep the E-values unchanged.
+        if residues is None:
+            residues = sum(len(x) for x in records)
+        shard_dir = path.join(basedir, 'nhmmer_shards')
+        os.makedirs(shard_dir, exist_ok=True)
+
+        tasks = []
+        outputs = []
+        for idx, batch in enumerate(balanced_split(records, shards)):
+            shard_fa = path.join(shard_dir, f'shard_{idx}.fa')
+            SeqIO.write(batch, shard_fa, 'fasta')
+            outputs.append((f'{shard_fa}.out', f'{shard_fa}.tblout'))
+            tasks.append(concat_command('nhmmer', o=outputs[-1][0], tblout=outputs[-1][1],
+                                        cpu=max(1, thread_number // shards),
+                                        Z=residues / 1e6, appending=[nhmmer_profile, shard_fa]))
+        logger.log(1, f'Searching {len(records)} sequences with {len(tasks)} nhmmer processes.')
+
+        with process_pool(len(tasks)) as pool:
+            pool.map(direct_call, tasks)
+
+        with open(hmm_out, 'w') as fout, open(hmm_tbl, 'w') as ftbl:
+            for out, tbl in outputs:
+                with open(out) as fin:
+                    shutil.copyfileobj(fin, fout)
+                with open(tbl) as fin:
+                    shutil.copyfileobj(fin, ftbl)
+        shutil.rmtree(shard_dir)
+    else:
+        shell_call('nhmmer', o=hmm_out, tblout=hmm_tbl, cpu=thread_number,
+                   Z=residues / 1e6 if residues is not None else None,
+                   appending=[nhmmer_profile, fasta_file])
 
     # Process data to pandas readable table
     hmm_tbl_pd = f'{hmm_tbl}.readable'
@@ -537,6 +881,9 @@ def nhmmer_search(fasta_file=None, thread_number=None, nhmmer_profile=None,
                                 ])
     hmm_frame = hmm_frame.drop(columns=['accession1', 'accession2'])
 
+    if shards > 1:
+        hmm_frame = sort_nhmmer_hits(hmm_frame, nhmmer_profile)
+
     # Deduplicate multiple hits on the same gene of same sequence
     hmm_frame = hmm_frame.drop_duplicates(
         subset=['target', 'query'], keep='first')
@@ -544,3 +891,121 @@ def nhmmer_search(fasta_file=None, thread_number=None, nhmmer_profile=None,
 
     logger.log(1, f'HMM query have {len(hmm_frame.index)} results.')
     return hmm_frame
+
+
+class HitStore():
+    '''
+    nhmmer hits of the sequences searched by findmitoscaf, kept with the
+    sequences themselves.
+
+    The final mitogenome is made of sequences findmitoscaf has already
+    searched, at most trimmed or reversed by the annotation. Hits are then
+    moved to the final coordinates by where the sequence is found in a stored
+    one, only sequences not found, or with hits cut by the trimming, need
+    another nhmmer search.
+    '''
+
+    def __init__(self):
+        self.profile = None
+        self.sequences = {}
+
+    def add(self, nhmmer_profile, records, hmm_frame, residues):
+        '''
+        Stores the hits of records with any, E-values are of a search of the
+        given residues.
+        '''
+        digest = file_digest(nhmmer_profile)
+        if digest != self.profile:
+            self.profile = digest
+            self.sequences = {}
+        by_target = dict(tuple(hmm_frame.groupby('target')))
+        for record in records:
+            if record.id in by_target:
+                self.sequences[str(record.seq).upper()] = (
+                    by_target[record.id], residues)
+
+    def locate(self, sequence):
+        '''
+        Returns (stored sequence, offset, reversed) of where the sequence or
+        its reverse complement lies, or None.
+        '''
+        forward = str(sequence).upper()
+        if forward in self.sequences:
+            return forward, 0, False
+        reverse = str(Seq(forward).reverse_complement())
+        # Later searches are more likely to have the final sequences
+        for stored in reversed(list(self.sequences)):
+            offset = stored.find(forward)
+            if offset >= 0:
+                return stored, offset, False
+            offset = stored.find(reverse)
+            if offset >= 0:
+                return stored, offset, True
+        return None
+
+    def project(self, nhmmer_profile, records):
+        '''
+        Returns (hits, residues searched) of every record the hits are known,
+        and the records which are needed to be searched again.
+        '''
+        if not self.sequences or file_digest(nhmmer_profile) != self.profile:
+            return [], list(records)
+
+        coords = ['alifrom', 'alito', 'envfrom', 'envto']
+        projected = []
+        unknown = []
+        for record in records:
+            located = self.locate(record.seq)
+            if located is None:
+                unknown.append(record)
+                continue
+            stored, offset, reverse = located
+            frame, searched = self.sequences[stored]
+            length = len(record)
+            if reverse:
+                moved = offset + length + 1 - frame[coords]
+                strand = frame.strand.map({'+': '-', '-': '+'})
+            else:
+                moved = frame[coords] - offset
+                strand = frame.strand
+            inside = ((moved >= 1) & (moved <= length)).all(axis=1)
+            if not inside.all():
+                # Trimming cut into a hit, scores of it are not reliable.
+                unknown.append(record)
+                continue
+            frame = frame.assign(target=record.id, sqlen=length, strand=strand)
+            frame[coords] = moved
+            projected.append((frame, searched))
+        return projected, unknown
+
+
+def nhmmer_rescue(fasta_file=None, thread_number=None, nhmmer_profile=None,
+                  prefix=None, basedir=None, hit_store: HitStore = None):
+    '''
+    nhmmer_search, but reusing hits from the store.
+    '''
+    if hit_store is None:
+        return nhmmer_search(fasta_file=fasta_file, thread_number=thread_number,
+                             nhmmer_profile=nhmmer_profile, prefix=prefix, basedir=basedir)
+
+    records = list(SeqIO.parse(fasta_file, 'fasta'))
+    residues = sum(len(x) for x in records)
+    projected, unknown = hit_store.project(nhmmer_profile, records)
+    if not projected:
+        return nhmmer_search(fasta_file=fasta_file, thread_number=thread_number,
+                             nhmmer_profile=nhmmer_profile, prefix=prefix, basedir=basedir)
+
+    logger.log(2, f'Reusing nhmmer hits of {len(records) - len(unknown)} sequences, '
+                  f'searching {len(unknown)} sequences.')
+    # E-values are rescaled to a search of this file like in findmitoscaf
+    hmm_frames = [frame.assign(e=frame.e * residues / searched)
+                  for frame, searched in projected]
+    if unknown:
+        unknown_file = path.join(basedir, f'{prefix}.nhmmer.unknown.fa')
+        SeqIO.write(unknown, unknown_file, 'fasta')
+        hmm_frames.append(nhmmer_search(fasta_file=unknown_file, thread_number=thread_number,
+                                        nhmmer_profile=nhmmer_profile, prefix=prefix,
+                                        basedir=basedir, residues=residues))
+
+    hmm_frame = sort_nhmmer_hits(pandas.concat(hmm_frames), nhmmer_profile)
+    return hmm_frame.drop_duplicates(subset=['target', 'query'], keep='first')
@@ -0,0 +1,190 @@
+"""
+batch.py
+=========
+
+Copyright (c) 2019-2020 Li Junyu <2018301050@szu.edu.cn>.
+
+This file is part of MitoFlex.
+
+MitoFlex is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MitoFlex is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+'''
+Annotating many finished mitogenomes at once.
+
+Sequences of all the samples are tagged with the sample index and written
+to a single fasta, which is searched once by tblastn, genewise, cmsearch and
+nhmmer. Hits are then split back by the tags, and genes of every sample are
+picked and written like a single annotation.
+
+E-values depend on the size of the searched database, so the searches are
+told to compute them as searching a genome of the average sample size.
+Samples much longer or shorter than the average will have E-values slightly
+different from annotating them one by one.
+'''
+
+import os
+import sys
+from os import path
+
+try:
+    sys.path.insert(0, os.path.abspath(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..")))
+    from annotation import annotation_tookit as tk  # pylint: disable=import-error, no-name-in-module
+    from annotation.annotation import search_genes, write_annotation, fix_circular, profile_dir_hmm
+    from Bio import SeqIO
+    from utility import logger
+    import configurations
+except ImportError as err:
+    sys.exit(
+        f"Unable to import helper module {err.name}, is the installation of MitoFlex valid?")
+
+fasta_exts = ('.fa', '.fasta', '.fna', '.fas')
+
+
+def tag(index, name):
+    return f'{index}__{name}'
+
+
+def untag(name):
+    index, name = str(name).split('__', 1)
+    return int(index), name
+
+
+def read_samples(batch=None):
+    '''
+    Returns (sample, fasta file) of a folder of fasta files, or of a sample
+    sheet with a sample name and a fasta file each line. Relative paths in
+    the sheet are relative to the sheet.
+    '''
+    batch = path.abspath(batch)
+    if path.isdir(batch):
+        samples = [(path.splitext(name)[0], path.join(batch, name))
+                   for name in sorted(os.listdir(batch))
+                   if name.lower().endswith(fasta_exts)]
+    else:
+        samples = []
+        with open(batch) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                fields = line.split('\t') if '\t' in line else line.split()
+                if len(fields) < 2:
+                    raise RuntimeError(f'No fasta file is given for sample in line "{line}" of the sample sheet.')
+                samples.append((fields[0].strip(), path.join(path.dirname(batch), fields[1].strip())))
+
+    if not samples:
+        raise RuntimeError(f'No samples are found in {batch}.')
+    names = [name for name, _ in samples]
+    if len(set(names)) != len(names):
+        raise RuntimeError('Sample names in a batch should be unique.')
+    for name, fasta in samples:
+        if not path.isfile(fasta):
+            raise RuntimeError(f'Fasta file {fasta} of sample {name} is not valid.')
+    return samples
+
+
+def annotate_batch(basedir=None, prefix=None, samples=None, ident=30, genetic_code=9, clade=None,
+                   thread_number=8, wildcard_profile=False, trna_overlapping=40, hmmer_search=True,
+                   score=5, e_value=0.005):
+    '''
+    Annotates all the samples, returns (locs file, cds fasta, rna fasta,
+    circular) of every sample by its name.
+    '''
+    logger.log(2, f'Entering batch annotation of {len(samples)} samples.')
+    sample_dir = path.join(basedir, 'samples')
+    batch_fa = path.join(basedir, f'{prefix}.batch.fa')
+
+    sample_files = []
+    circular = []
+    sizes = []
+    targets = 0
+    with open(batch_fa, 'w') as fout:
+        for idx, (name, fasta) in enumerate(samples):
+            os.makedirs(path.join(sample_dir, name), exist_ok=True)
+            sample_fa = path.join(sample_dir, name, f'{name}.fa')
+            SeqIO.write(SeqIO.parse(fasta, 'fasta'), sample_fa, 'fasta')
+            circular.append(configurations.annotation.trim_circular and fix_circular(fa_file=sample_fa))
+
+            records = list(SeqIO.parse(sample_fa, 'fasta'))
+            for record in records:
+                record.id = tag(idx, record.id)
+                record.description = ''
+            SeqIO.write(records, fout, 'fasta')
+            sample_files.append(sample_fa)
+            sizes.append(sum(len(x) for x in records))
+            targets += len(records)
+
+    residues = sum(sizes) // len(sizes)
+    wise_frame, trnas, rrnas = search_genes(
+        basedir=basedir, prefix=prefix, ident=ident, fastafile=batch_fa, genetic_code=genetic_code,
+        clade=clade, thread_number=thread_number, wildcard_profile=wildcard_profile,
+        residues=residues, targets=targets)
+
+    # Genomes may be reversed by the search, so the samples are split again
+    split_records = [[] for _ in samples]
+    for record in SeqIO.parse(batch_fa, 'fasta'):
+        idx, record.id = untag(record.id)
+        record.description = ''
+        split_records[idx].append(record)
+    for records, sample_fa in zip(split_records, sample_files):
+        SeqIO.write(records, sample_fa, 'fasta')
+
+    # Demultiplex the hits
+    tagged = wise_frame.sseq.map(untag)
+    wise_frame = wise_frame.assign(sample=tagged.map(lambda x: x[0]), sseq=tagged.map(lambda x: x[1]))
+
+    split_trnas = [[] for _ in samples]
+    for align in trnas:
+        idx, align.sequence = untag(align.sequence)
+        split_trnas[idx].append(align)
+
+    split_rrnas = [([], []) for _ in samples]
+    for part, queries in enumerate(rrnas):
+        for query in queries:
+            idx, query.sequence = untag(query.sequence)
+            split_rrnas[idx][part].append(query)
+
+    # nhmmer only runs once for all samples, and only if any is missing PCGs
+    hmm_frames = []
+
+    def rescue_of(idx):
+        def rescue():
+            if not hmm_frames:
+                hmm_frames.append(tk.nhmmer_search(
+                    fasta_file=batch_fa, thread_number=thread_number,
+                    nhmmer_profile=path.join(profile_dir_hmm, f'{clade}.hmm'),
+                    prefix=prefix, basedir=basedir, residues=residues))
+            tagged = hmm_frames[0].target.map(untag)
+            return hmm_frames[0][tagged.map(lambda x: x[0]) == idx].assign(
+                target=tagged.map(lambda x: x[1]))
+        return rescue if hmmer_search else None
+
+    results = {}
+    for idx, (name, _) in enumerate(samples):
+        logger.log(2, f'Picking genes of sample {name}.')
+        sample_frame = wise_frame[wise_frame['sample'] == idx].drop(columns=['sample'])
+        if sample_frame.empty:
+            logger.log(3, f'No PCG is found in sample {name}, skipping it.')
+            continue
+        locs_file, annotated_fa, annotated_rnas = write_annotation(
+            basedir=path.join(sample_dir, name), prefix=name, fastafile=sample_files[idx],
+            genetic_code=genetic_code, clade=clade, wise_frame=sample_frame,
+            trnas=split_trnas[idx], rrnas=split_rrnas[idx], trna_overlapping=trna_overlapping,
+            rescue=rescue_of(idx), score=score, e_value=e_value)
+        results[name] = (locs_file, annotated_fa, annotated_rnas, circular[idx])
+
+    return results
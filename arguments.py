@@ -102,7 +102,8 @@ universal_parser, universal_group = register_group('Universal arguments', [
     },
     {
         'name': 'basedir',
-        'default': os.getcwd(),
+        # Relative to where the command is run, which is not where a served MitoFlex starts
+        'default': os.curdir,
         'help': 'working folder will be generated in which directory.'
     },
     {
@@ -153,6 +154,10 @@ fastq_parser, fastq_group = register_group('Fastq arguments', [
 
 # Fasta group
 def fasta_regulator(args):
+    # Fasta files are given by the batch instead
+    if getattr(args, 'batch', None):
+        args.batch = os.path.abspath(args.batch)
+        return True
     args.fastafile = os.path.abspath(args.fastafile)
     if not os.path.isfile(args.fastafile):
         print("Input FASTA file not valid.")
@@ -291,6 +296,10 @@ def assembly_regulator(args):
         print('Prune depth lower than 0.')
         valid = False
 
+    if args.max_memory < 0:
+        print('Max memory lower than 0.')
+        valid = False
+
     return valid
 
 
@@ -330,6 +339,11 @@ assembly_parser, assembly_group = register_group('Assembly arguments', [
         'name': 'insert-size',
         'default': 150,
         'help': 'the insert size of reads, used in scaffolding.'
+    },
+    {
+        'name': 'max-memory',
+        'default': 0.0,
+        'help': 'the max memory in GB MEGAHIT could use, 0 to use the configured ratio of the available memory.'
     }
 ], func=assembly_regulator)
 
@@ -342,9 +356,6 @@ def search_regulator(args):
         print("Input minimum abundance is not valid.")
         valid = False
 
-    from ete3 import NCBITaxa
-    ncbi = NCBITaxa()
-
     if hasattr(args, 'temp_dir'):
         args.findmitoscaf_dir = os.path.join(args.temp_dir, 'findmitoscaf')
     else:
@@ -358,6 +369,12 @@ def search_regulator(args):
         valid = False
         print('Error occured when validating the directories, please check your permissions or things could be related.')
 
+    # The taxonomy database is slow to open, and only needed by the taxa filter
+    if args.disable_taxa:
+        return valid
+
+    from utility.taxonomy import taxonomy
+    ncbi = taxonomy()
     if args.required_taxa not in ncbi.get_name_translator([args.required_taxa]):
         print("Specified taxanomy name not in NCBI taxanomy database.")
         return False
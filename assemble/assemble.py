@@ -30,6 +30,7 @@ try:
         os.path.dirname(os.path.abspath(__file__)), "..")))
     from utility.helper import shell_call
     from utility import logger
+    from utility.profiler import span
     from configurations import assemble as a_conf  # Prevent naming confliction
     from assemble.assemble_wrapper import MEGAHIT, EmptyGraph  # pylint: disable=import-error, no-name-in-module
     from assemble.scaffold_wrapper import SOAP, scaf2mega
@@ -43,7 +44,7 @@ bin_dir = path.dirname(__file__)
 def assemble(fastq1=None, fastq2=None, base_dir=None, work_prefix=None,
              kmer_list=None, depth_list=None, disable_local=False,
              prune_level=2, prune_depth=2, keep_temp=False,
-             threads=8, min_multi=3.0, insert_size=125, no_scaf=False):
+             threads=8, min_multi=3.0, insert_size=125, no_scaf=False, max_memory=0):
 
     logger.log(2, 'Start assembling mitochondrial sequences.')
 
@@ -60,6 +61,7 @@ def assemble(fastq1=None, fastq2=None, base_dir=None, work_prefix=None,
         'min_depth': min_multi,
         'fq1': fastq1,
         'fq2': fastq2,
+        'max_memory': max_memory,
     }
 
     logger.log(2, f'Initializing megahit wrapper.')
@@ -86,27 +88,28 @@ def assemble(fastq1=None, fastq2=None, base_dir=None, work_prefix=None,
                  for i in range(len(kmer_list) - 2)]
 
     for i, (p, c, n) in enumerate(kmer_list):
-        try:
-            megahit.graph(p, c)
-        except EmptyGraph:
+        with span(f'k{c}', kind='iteration'):
+            try:
+                megahit.graph(p, c)
+            except EmptyGraph:
+                logger.log(
+                    3, f'Iteration broke at kmer = {p}, since no valid contig in kmer = {c} is done!')
+                # Return to last iteration kmer sets.
+                megahit.kmax = kmer_list[i - 1][0]
+                break
+
+            contig_info, _ = megahit.assemble(c)
+            contig_filtered, *_ = megahit.filter(c, min_depth=depth_list[i], force_filter=c == megahit.kmax,
+                                                 min_length=0 if n != -1 else a_conf.min_length, max_length=a_conf.max_length,
+                                                 deny_number=a_conf.filter_keep)
             logger.log(
-                3, f'Iteration broke at kmer = {p}, since no valid contig in kmer = {c} is done!')
-            # Return to last iteration kmer sets.
-            megahit.kmax = kmer_list[i - 1][0]
-            break
-
-        contig_info, _ = megahit.assemble(c)
-        contig_filtered, *_ = megahit.filter(c, min_depth=depth_list[i], force_filter=c == megahit.kmax,
-                                             min_length=0 if n != -1 else a_conf.min_length, max_length=a_conf.max_length,
-                                             deny_number=a_conf.filter_keep)
-        logger.log(
-            1, f'Contig for kmer = {c} : {contig_filtered}/{contig_info.count}')
+                1, f'Contig for kmer = {c} : {contig_filtered}/{contig_info.count}')
 
-        if n == -1:
-            break
-        if not disable_local:
-            megahit.local(c, n)
-        megahit.iterate(c, n)
+            if n == -1:
+                break
+            if not disable_local:
+                megahit.local(c, n)
+            megahit.iterate(c, n)
 
     megahit.finalize(megahit.kmax)
 
@@ -160,6 +160,9 @@ class MEGAHIT():
         logger.log(
             1, f"System memory status : {', '.join([f'{k}={v/(1024**2):.2f}MB' for k,v in vm._asdict().items() if type(v) is int])}")
         self.available_memory = int(vm.available * a_conf.max_mem_percent)
+        # Memory given by the user, like a share of the node in a batch run
+        if getattr(self, 'max_memory', 0) > 0:
+            self.available_memory = min(self.available_memory, int(self.max_memory * 1024**3))
         logger.log(2, f'Scheduled {self.available_memory/(1024**2):.2f}MB to use.')
 
     @timed(enabled=False)
@@ -0,0 +1,226 @@
+"""
+batch.py
+=========
+
+Copyright (c) 2019-2020 Li Junyu <2018301050@szu.edu.cn>.
+
+This file is part of MitoFlex.
+
+MitoFlex is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MitoFlex is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+'''
+Running the whole pipeline of many samples on a single node.
+
+Every sample is run by an 'all' process of its own, and samples are started
+only if the threads and the memory of the batch allows. A run writes the
+stage it's in to workname.stage, so a sample filtering the reads or mapping
+them for the visualization, which mostly waits for the disk, is only charged
+a few threads, and the next sample can start assembling meanwhile.
+'''
+
+import os
+import shlex
+import subprocess
+import sys
+import time
+from os import path
+
+try:
+    sys.path.insert(0, os.path.abspath(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..")))
+    from utility import logger
+except ImportError as err:
+    sys.exit(
+        f"Unable to import helper module {err.name}, is the installation of MitoFlex valid?")
+
+mitoflex_main = path.abspath(path.join(path.dirname(__file__), '..', 'MitoFlex.py'))
+
+# Stages that spend most of the time reading and writing files, and the ones
+# running after the annotation, which need no more searching.
+io_stages = ('filter', 'mapping', 'gc', 'visualize')
+late_stages = ('mapping', 'gc', 'visualize')
+
+
+class SampleRun():
+    def __init__(self, name, fastq1, fastq2=None):
+        self.name = name
+        self.fastq1 = fastq1
+        self.fastq2 = fastq2
+        self.process = None
+        self.start = self.end = None
+        self.stage = None
+        self.basedir = None
+        self.interrupted = False
+
+    @property
+    def work_dir(self):
+        return path.join(self.basedir, self.name)
+
+    @property
+    def result_dir(self):
+        return path.join(self.work_dir, f'{self.name}.result')
+
+    @property
+    def finished(self):
+        return self.process is not None and self.process.poll() is not None
+
+    @property
+    def succeeded(self):
+        # RuntimeErrors in the pipeline end the run with 0 as well
+        return self.finished and self.process.returncode == 0 and self.stage == 'done'
+
+    @property
+    def status(self):
+        if self.succeeded:
+            return 'finished'
+        return 'interrupted' if self.interrupted else 'failed'
+
+    def update_stage(self):
+        try:
+            with open(path.join(self.work_dir, f'{self.name}.stage')) as f:
+                self.stage = f.read().strip() or self.stage
+        except FileNotFoundError:
+            pass
+        return self.stage
+
+
+def read_sheet(sheet=None):
+    '''
+    Reads a sample sheet with a sample name, fastq1 and an optional fastq2
+    each line. Relative paths in the sheet are relative to the sheet.
+    '''
+    sheet = path.abspath(sheet)
+    samples = []
+    with open(sheet) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = [x.strip() for x in (line.split('\t') if '\t' in line else line.split())]
+            if len(fields) < 2:
+                raise RuntimeError(f'No fastq file is given for sample in line "{line}" of the sample sheet.')
+            fastqs = [path.join(path.dirname(sheet), x) for x in fields[1:3] if x and x != '-']
+            samples.append(SampleRun(fields[0], *fastqs))
+
+    if not samples:
+        raise RuntimeError(f'No samples are found in {sheet}.')
+    names = [x.name for x in samples]
+    if len(set(names)) != len(names):
+        raise RuntimeError('Sample names in a batch should be unique.')
+    for sample in samples:
+        for fastq in (sample.fastq1, sample.fastq2):
+            if fastq is not None and not path.isfile(fastq):
+                raise RuntimeError(f'Fastq file {fastq} of sample {sample.name} is not valid.')
+    return samples
+
+
+def run_batch(samples=None, basedir=None, prefix=None, threads=8, sample_threads=8, io_threads=2,
+              memory=0, sample_memory=16, all_args='', poll=5):
+    '''
+    Runs the pipeline of every sample, returns the path of the summary table.
+
+    threads and memory are the budget of the whole batch, memory and
+    sample_memory are in GB. A run in an I/O stage is charged io_threads
+    instead of sample_threads. Runs not yet done with the annotation will
+    still assemble and search, so they are counted with sample_threads as well, and at most
+    one sample is started ahead of the free threads to filter its reads
+    while others are assembling.
+    '''
+    if memory <= 0:
+        import psutil
+        from configurations import assemble as a_conf
+        memory = psutil.virtual_memory().available * a_conf.max_mem_percent / 1024**3
+    extra = shlex.split(all_args)
+    start_stage = 'assemble' if '--disable-filter' in extra else 'filter'
+
+    # Stages running at once are written as stage1,stage2
+    def charge(stage):
+        return io_threads if all(x in io_stages for x in stage.split(',')) else sample_threads
+
+    def is_late(stage):
+        return stage is not None and all(x in late_stages for x in stage.split(','))
+
+    logger.log(2, f'Running {len(samples)} samples with {threads} threads and {memory:.1f}GB memory, '
+               f'{sample_threads} threads and {sample_memory:.1f}GB each.')
+
+    pending = list(samples)
+    running = []
+    try:
+        while pending or running:
+            for sample in [x for x in running if x.finished]:
+                sample.update_stage()
+                sample.end = time.time()
+                running.remove(sample)
+                logger.log(2 if sample.succeeded else 3,
+                           f'Sample {sample.name} {"finished" if sample.succeeded else "failed"} '
+                           f'in {sample.end - sample.start:.2f}s, last stage {sample.stage}.')
+
+            used_threads = sum(charge(x.update_stage() or start_stage) for x in running)
+            needed_threads = sum(sample_threads for x in running if not is_late(x.stage))
+            used_memory = sample_memory * len(running)
+            while pending and (not running or (used_threads + charge(start_stage) <= threads
+                                               and needed_threads <= threads
+                                               and used_memory + sample_memory <= memory)):
+                sample = pending.pop(0)
+                sample.basedir = basedir
+                command = [sys.executable, mitoflex_main, 'all', '--workname', sample.name,
+                           '--basedir', basedir, '--threads', str(sample_threads),
+                           '--max-memory', str(sample_memory), '--fastq1', sample.fastq1]
+                if sample.fastq2:
+                    command += ['--fastq2', sample.fastq2]
+                command += extra
+                logger.log(1, f'Starting sample {sample.name} : {" ".join(command)}')
+                sample.start = time.time()
+                with open(path.join(basedir, f'{sample.name}.out'), 'w') as out:
+                    sample.process = subprocess.Popen(command, stdout=out, stderr=subprocess.STDOUT)
+                running.append(sample)
+                used_threads += charge(start_stage)
+                needed_threads += sample_threads
+                used_memory += sample_memory
+                logger.log(2, f'Sample {sample.name} started, {len(pending)} samples pending.')
+
+            if running:
+                time.sleep(poll)
+    finally:
+        # Samples still running or not started yet are marked as interrupted,
+        # and the summary is written for the ones done so far as well.
+        for sample in running:
+            if not sample.finished:
+                logger.log(3, f'Terminating sample {sample.name}.')
+                sample.process.terminate()
+                sample.interrupted = True
+        for sample in running:
+            try:
+                sample.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                sample.process.kill()
+                sample.process.wait()
+            sample.update_stage()
+            sample.end = time.time()
+        for sample in pending:
+            sample.interrupted = True
+
+        summary = path.join(basedir, f'{prefix}.batch.tsv')
+        with open(summary, 'w') as f:
+            print('sample', 'status', 'return_code', 'last_stage', 'elapsed', 'result_dir', sep='\t', file=f)
+            for sample in samples:
+                started = sample.process is not None
+                print(sample.name, sample.status, sample.process.returncode if started else '',
+                      sample.stage or '', f'{sample.end - sample.start:.2f}' if started else '',
+                      sample.result_dir if sample.succeeded else '', sep='\t', file=f)
+        logger.log(2, f'{sum(x.succeeded for x in samples)} of {len(samples)} samples finished, '
+                   f'summary is written to {summary}.')
+    return summary
@@ -32,12 +32,14 @@ the value inside this configuration if needed.
 '''
 
 # It's not acutally circos configuration file, but used to make the file structure clean
+from os import path
 from utility.bio.circos import Circos
 annotation = Circos()
 findmitoscaf = Circos()
 assemble = Circos()
 filter_rawdata = Circos()
 visualize = Circos()
+serve = Circos()
 
 # Filter
 
@@ -140,6 +142,20 @@ findmitoscaf.full_ratio = 0.95
 # the sensitivity, while lowering the accuracy.
 findmitoscaf.min_valid_ratio = 0.3
 
+# How many threads are given to a single nhmmer process in findmitoscaf.
+# nhmmer scales poorly with threads, so the contigs are split into residue
+# balanced batches and searched with threads/this nhmmer processes at once.
+# Set it to the thread number or higher to use a single nhmmer process.
+findmitoscaf.nhmmer_shard_threads = 4
+
+# How many distinct translated minimizers should a contig share with the clade
+# protein profile before it's searched by nhmmer.
+# Short nuclear contigs with no mitochondrial signal will be dropped early this
+# way, a report of the removed contigs is written to prefix.prescreen.txt.
+# Set it to 0 to disable the prescreen, 2 or 3 removes most of the noise while
+# keeping even quite partial genes.
+findmitoscaf.prescreen_hits = 0
+
 # Should another findmitoscaf run to be launched after the merging.
 # Since some sequences will be conflicted, or resulted to be have no gene at all after
 # the merge method, an additional check can improve the result quality, though at some
@@ -179,7 +195,44 @@ annotation.redirection = False
 # with lower accuracy, and vise versa.
 annotation.overlap_ratio = 0.2
 
+# How many shards per thread are made for the blast searches.
+# Queries are cut into threads*this residue balanced shards, and idle workers
+# take the next shard, so a shard of long proteins won't keep other threads
+# waiting. Higher values balance better, but start more blast processes.
+annotation.blast_shards = 4
+
+# Where the blast databases are cached, and how many of them are kept.
+# Databases are reused by the content of the sequences, so searching the same
+# file again skips makeblastdb. None keeps them in the blastdb folder of the
+# run temp folder, a shared folder makes them reused across runs as well.
+# The least recently used databases are removed if there are more than the
+# given number, except the ones still searched by a run.
+annotation.blast_db_cache = None
+annotation.blast_db_entries = 32
+
+# The minimum bit score of a tRNA hit to be folded and considered.
+# cmsearch already filters hits by E-value, this valve skips weak hits before
+# their secondary structures are built. 0 keeps every reported hit, real
+# mitochondrial tRNAs usually score above 20.
+annotation.trna_min_score = 0
+
+# Where the annotation results are cached, and how large the cache could be.
+# Annotating the same sequences again with the same options and profiles, like
+# rerunning the pipeline for a new visualization, reuses the results at once,
+# and the tblastn, genewise and cmsearch results are reused if only the options
+# of picking genes are changed. None disables the cache, set it to a folder
+# like ~/.cache/MitoFlex/annotation to enable it. The least recently used
+# results are removed if the cache is larger than the given bytes.
+annotation.result_cache = None
+annotation.result_cache_size = 256 * 1024 * 1024
+
 # The fill color of genes in visualize method
 visualize.color_cds = '141,211,199'
 visualize.color_trna = '251,128,114'
 visualize.color_rrna = '253,192,134'
+
+# Serve
+
+# Where a served MitoFlex listens for the jobs, and where submit sends them.
+# Use different sockets to serve with different MitoFlex installations.
+serve.socket = path.join(path.expanduser('~'), '.cache', 'MitoFlex', 'serve.sock')
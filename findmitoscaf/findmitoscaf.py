@@ -25,12 +25,14 @@ from time import time
 import os
 import sys
 import json
+import hashlib
 from utility.helper import some
+from collections import deque
 
 
+import numpy
 import pandas
 from Bio import SeqIO, SeqRecord, Seq
-from ete3 import NCBITaxa
 from os import path
 
 
@@ -40,17 +42,19 @@ try:
     from utility.bio.seq import decompile, compile_seq
     from annotation import annotation_tookit as tk
     from utility import logger
+    from utility.taxonomy import taxonomy
     from configurations import findmitoscaf as f_conf
     from configurations import assemble as a_conf
     from utility.helper import concat_command, direct_call, shell_call, timed
-    from subprocess import check_output
+    from utility.mapping import map_reads
+    from utility.cache import Cache, file_digest
+    from findmitoscaf.prescreen import prescreen
     from misc.check_circular import check_circular
     from misc import libfastmathcal
 except ImportError as err:
     sys.exit(
         f"Unable to import helper module {err.name}, is the installation of MitoFlex valid?")
 
-ncbi = NCBITaxa()
 mitoflex_dir = path.abspath(path.join(path.dirname(__file__), '..'))
 profile_dir = path.join(mitoflex_dir, 'profile')
 profile_dir_hmm = path.join(profile_dir, 'CDS_HMM')
@@ -65,6 +69,7 @@ rank_list = ['kindom', 'phylum', 'class',
 
 
 def get_rank(taxa_name=None):
+    ncbi = taxonomy()
     name_dict = ncbi.get_name_translator([taxa_name])
 
     if taxa_name not in name_dict:
@@ -98,12 +103,15 @@ def get_rank(taxa_name=None):
 def findmitoscaf(thread_number=8, clade=None, prefix=None, split_two=f_conf.split_two,
                  basedir=None, gene_code=9, taxa=None, max_contig_len=20000,
                  contigs_file=None, relaxing=0, multi=10, merge_method=1, merge_overlapping=50,
-                 merge_search=50):
+                 merge_search=50, hit_cache=None, hit_store=None):
 
     if path.getsize(contigs_file) > 10_000_000:
         logger.log(3, 'For such a big contig file, merging will probably lead to some unhappy results.')
 
     logger.log(2, 'Finding mitochondrial scaffold.')
+    if hit_cache is None:
+        hit_cache = HitCache()
+
     if merge_method == 0:
         logger.log(2, f'Merging sequences with global method.')
         logger.log(2, f'Merged {merge_sequences(contigs_file,overlapped_len=merge_overlapping,threads=thread_number,search_range=merge_search)} sequences.')
@@ -124,14 +132,63 @@ def findmitoscaf(thread_number=8, clade=None, prefix=None, split_two=f_conf.spli
     nhmmer_profile = path.join(profile_dir_hmm, f'{clade}.hmm')
     logger.log(1, f'nhmmer profile : {nhmmer_profile}')
 
-    # do hmmer search
-    hmm_frame = tk.nhmmer_search(fasta_file=contigs_file, thread_number=thread_number,
-                                 nhmmer_profile=nhmmer_profile, prefix=prefix,
-                                 basedir=basedir)
+    # Drop contigs with no mitochondrial signal before the heavy searches,
+    # contigs_file is still used as a whole for merging later.
+    search_file = contigs_file
+    if f_conf.prescreen_hits > 0:
+        prescreen_profile = path.join(profile_dir_tbn, f'{clade}.fa')
+        if not path.isfile(prescreen_profile):
+            prescreen_profile = path.join(profile_dir_tbn, 'Animal.fa')
+        search_file = prescreen(fasta_file=contigs_file, profile_fasta=prescreen_profile,
+                                basedir=basedir, prefix=prefix, code=gene_code,
+                                min_hits=f_conf.prescreen_hits)
+
+    # do hmmer search, only sequences not searched yet by the same profile
+    # are given to nhmmer, others take their hits from the cache.
+    search_records = list(SeqIO.parse(search_file, 'fasta'))
+    if not search_records:
+        raise RuntimeError("Parsed fasta file is empty!")
+    residues = sum(len(x) for x in search_records)
+    hmm_space = Cache.key('nhmmer', file_digest(nhmmer_profile))
+    cached, uncached = hit_cache.split(hmm_space, search_records)
+
+    hmm_frames = []
+    if uncached:
+        uncached_file = search_file
+        if cached:
+            logger.log(
+                2, f'Reusing nhmmer hits of {len(cached)} sequences, searching {len(uncached)} new sequences.')
+            uncached_file = path.join(basedir, f'{prefix}.nhmmer.uncached.fa')
+            SeqIO.write(uncached, uncached_file, 'fasta')
+        new_frame = tk.nhmmer_search(fasta_file=uncached_file, thread_number=thread_number,
+                                     nhmmer_profile=nhmmer_profile, prefix=prefix, basedir=basedir,
+                                     shards=max(1, thread_number // f_conf.nhmmer_shard_threads),
+                                     residues=residues if cached else None)
+        by_target = dict(tuple(new_frame.groupby('target')))
+        for record in uncached:
+            hit_cache.store(hmm_space, record,
+                            (by_target.get(record.id, new_frame.iloc[0:0]), residues))
+        hmm_frames.append(new_frame)
+
+    if cached:
+        # E-values are proportional to the database size, rescale them so
+        # hits from different searches still sort as a single search.
+        for record_id, (frame, searched) in cached.items():
+            hmm_frames.append(frame.assign(
+                target=record_id, e=frame.e * residues / searched))
+        hmm_frame = tk.sort_nhmmer_hits(
+            pandas.concat(hmm_frames), nhmmer_profile)
+    else:
+        hmm_frame = hmm_frames[0]
+
+    # Hits are handed to the annotation, the last search is the one of the
+    # final sequences.
+    if hit_store is not None:
+        hit_store.add(nhmmer_profile, search_records, hmm_frame, residues)
 
     logger.log(1, f'Generating hmm-filtered fasta.')
     hmm_seqs = [record
-                for record in SeqIO.parse(contigs_file, 'fasta')
+                for record in SeqIO.parse(search_file, 'fasta')
                 if record.id in set(hmm_frame['target'])
                 ]
     if not hmm_seqs:
@@ -148,14 +205,15 @@ def findmitoscaf(thread_number=8, clade=None, prefix=None, split_two=f_conf.spli
         hmm_frame = filter_taxanomy(
             taxa=taxa, fasta_file=hmm_fa, hmm_frame=hmm_frame,
             basedir=basedir, prefix=prefix, dbfile=tbn_profile, gene_code=gene_code,
-            relaxing=relaxing, threads=thread_number)
+            relaxing=relaxing, threads=thread_number, hit_cache=hit_cache)
     else:
         logger.log(
             3, 'Skipping taxanomy filtering because the disable-taxa option is on.')
 
+    hmm_targets = set(hmm_frame.target)
     contig_data = [x
                    for x in SeqIO.parse(hmm_fa, 'fasta')
-                   if hmm_frame.target.str.contains(x.id).any()]
+                   if x.id in hmm_targets]
 
     if not contig_data:
         raise RuntimeError(
@@ -177,9 +235,11 @@ def findmitoscaf(thread_number=8, clade=None, prefix=None, split_two=f_conf.spli
             contig_multis[contig.id] = float(traits['multi'])
         else:
             contig_data_low.append(contig)
-            # Here we dispose all the low abundance contigs,
-            # so only hmm_frame and contigs_file_high will be used.
-            hmm_frame = hmm_frame[hmm_frame.target != contig.id]
+
+    # Here we dispose all the low abundance contigs,
+    # so only hmm_frame and contigs_file_high will be used.
+    hmm_frame = hmm_frame[~hmm_frame.target.isin(
+        [x.id for x in contig_data_low])]
 
     contigs_file_high = path.join(basedir, f'{prefix}.abundance.high.fa')
     contigs_file_low = path.join(basedir, f'{prefix}.abundance.low.fa')
@@ -195,52 +255,54 @@ def findmitoscaf(thread_number=8, clade=None, prefix=None, split_two=f_conf.spli
     # Here we pick out the last sequences by using a greedy algorithm
     # the brute is deprecated because I found myself didn't realize what
     # I'm really going to do at the time I created it.
-    cds_indexes = json.load(
-        open(path.join(profile_dir_hmm, 'required_cds.json')))[clade]
+    cds_indexes = tk.required_cds(path.join(profile_dir_hmm, 'required_cds.json'), clade)
+
+    # Collects all the related cds, completeness of all the alignments
+    # are decided at once with columns of the hmm frame.
+    queries = hmm_frame['query'].astype(str).values
+    targets = hmm_frame['target'].astype(str).values
+    required = numpy.array([cds_indexes[x] for x in queries], dtype=float)
+    align_start = hmm_frame.alifrom.values.astype(int)
+    align_end = hmm_frame.alito.values.astype(int)
+    align_length = numpy.abs(align_start - align_end) + 1
+    contig_length = numpy.array([len(contig_map_high[x]) for x in targets])
+
+    complete = align_length >= required * f_conf.full_ratio
+
+    # Check if the alignment is 'isolated', which means no possiblity to be
+    # a gene sliced at side.
+    missing_length = required - align_length
+    isolated = ~complete & (align_start > missing_length) & (
+        contig_length - align_end > missing_length)
+    complete |= isolated
+
+    # If such a gene is 'isolated' and being too short to be a valid alignment,
+    # ignores it in the calculation.
+    ignored = isolated & (align_length <= required * f_conf.min_valid_ratio)
+    for query, index, length, req in zip(queries[ignored], targets[ignored],
+                                         align_length[ignored], required[ignored]):
+        logger.log(
+            3, f'Ignoring {query} on {index} since no significant length is aligned : {length} / {int(req * f_conf.min_valid_ratio)}')
+
+    kept = ~ignored
+    scores = numpy.trunc(hmm_frame.score.values.astype(float)) * \
+        numpy.array([contig_multis[x] for x in targets])
 
-    # Collects all the related cds
     candidates = {}
     sequence_completeness = {}
-
-    for _, row in hmm_frame.iterrows():
-        query = str(row.query)
-        index = str(row.target)
-        score = int(row.score)
-        align_start = int(row.alifrom)
-        align_end = int(row.alito)
-        align_length = abs(align_start - align_end) + 1
-        query_start = int(row.hmmfrom)
-        query_to = int(row['hmm to'])
-
-        complete = align_length >= cds_indexes[query] * f_conf.full_ratio
-
-        if not complete:
-            missing_length = cds_indexes[query] - align_length
-            # Check if the alignment is 'isolated', which means no possiblity to be
-            # a gene sliced at side.
-            complete = complete or (
-                align_start > missing_length and
-                len(contig_map_high[index]) - align_end > missing_length
-            )
-
-            # If such a gene is 'isolated' and being too short to be a valid alignment,
-            # ignores it in the calculation.
-            if complete and align_length <= cds_indexes[query] * f_conf.min_valid_ratio:
-                logger.log(
-                    3, f'Ignoring {query} on {index} since no significant length is aligned : {align_length} / {int(cds_indexes[query] * f_conf.min_valid_ratio)}')
-                continue
-
+    for query, index, score, query_start, query_to, is_complete in zip(
+            queries[kept], targets[kept], scores[kept],
+            hmm_frame.hmmfrom.values.astype(int)[kept],
+            hmm_frame['hmm to'].values.astype(int)[kept], complete[kept]):
         if index not in sequence_completeness:
             sequence_completeness[index] = []
+            candidates[index] = {}
 
-        if complete:
+        if is_complete:
             sequence_completeness[index].append(query)
 
-        if index not in candidates:
-            candidates[index] = {}
-
         candidates[index][query] = (
-            score * contig_multis[index], query_start, query_to, complete
+            float(score), int(query_start), int(query_to), bool(is_complete)
         )
 
     flatten_candidates = [(key, value) for key, value in candidates.items()]
@@ -271,7 +333,6 @@ def findmitoscaf(thread_number=8, clade=None, prefix=None, split_two=f_conf.spli
                 selected_candidates[c].append((index, *mapping[c][:-1]))
 
     # For fragments, select non-conflict sequence as much as possible
-    conflicts = []
     for empty_pcg in [x for x in selected_candidates if selected_candidates[x] is None or isinstance(selected_candidates[x], list)]:
         for index, mapping in candidates.items():
             # No pcg in this sequence, next sequence
@@ -293,34 +354,8 @@ def findmitoscaf(thread_number=8, clade=None, prefix=None, split_two=f_conf.spli
         if isinstance(selected_candidates[empty_pcg], list):
             logger.log(
                 3, f'Gene {empty_pcg} is fragmentized, deducing most possible sequences')
-            gene_map = []
-            for pos in selected_candidates[empty_pcg]:
-                gene_map.append((pos[2], (pos[0], pos[1])))
-                gene_map.append((pos[3], (pos[0], pos[1])))
-            gene_map.sort(key=lambda x: x[0])
-            gene_map = [x[1] for x in gene_map]
-
-            def overlapping():
-                for i in range(0, len(gene_map) - 1, 2):
-                    left = gene_map[i]
-                    right = gene_map[i + 1]
-                    if left[0] != right[0]:
-                        if left[1] < right[1]:
-                            gene_map.remove(left)
-                            gene_map.remove(left)
-                        else:
-                            gene_map.remove(right)
-                            gene_map.remove(right)
-                        conflicts.append((left, right))
-                        return True
-                return False
-
-            while overlapping():
-                pass
-            final_candidates = list(
-                set([x[0] for x in gene_map])
-            )
-
+            final_candidates = resolve_fragments(
+                selected_candidates[empty_pcg])
             selected_candidates[empty_pcg] = final_candidates
 
             total_length = sum([abs(candidates[index][empty_pcg][2] - candidates[index][empty_pcg][1])
@@ -359,13 +394,14 @@ def findmitoscaf(thread_number=8, clade=None, prefix=None, split_two=f_conf.spli
         logger.log(
             2, f"Merged {merge_partial(fasta_file=picked_fasta, dbfile=contigs_file, overlapped_len=merge_overlapping, search_range=merge_search)} sequences.")
 
-        if f_conf.addtional_check:
+        if f_conf.additional_check:
             logger.log(2, f'Launching another findmitoscaf run to filter out non-target sequences.')
             picked_fasta = findmitoscaf(thread_number=thread_number, clade=clade, prefix=prefix,
                                         basedir=basedir, gene_code=gene_code, taxa=taxa,
                                         max_contig_len=max_contig_len, contigs_file=picked_fasta,
                                         relaxing=relaxing, multi=multi, merge_method=2,
-                                        merge_overlapping=merge_overlapping, split_two=False)
+                                        merge_overlapping=merge_overlapping, split_two=False,
+                                        hit_cache=hit_cache, hit_store=hit_store)
             """Some of the merged contigs are thought to be conflicted with selected sequences, so they are not picked in the result
             But they may also contain some gene, if so, please check at the [workname].abundance.high.fa at findmitoscaf temp folder.
             They are mainly not merged because blastn failed to recognize their overlapped region, if so happened visualization is
@@ -389,24 +425,97 @@ def findmitoscaf(thread_number=8, clade=None, prefix=None, split_two=f_conf.spli
     return picked_fasta
 
 
+def resolve_fragments(fragments):
+    '''
+    Picks non-conflicting fragments of a gene, fragments are tuples of
+    (index, score, hmm from, hmm to).
+
+    Both ends of the fragments are sorted by their position on the model, and
+    every two adjacent ends should belong to the same sequence. Ends of a
+    conflict pair are resolved by removing the first two ends of the lower
+    scored sequence, then the sweep goes on from the survived end. Removed
+    ends are unlinked instead of rescanning the whole list after each removal.
+    '''
+    gene_map = []
+    for pos in fragments:
+        gene_map.append((pos[2], (pos[0], pos[1])))
+        gene_map.append((pos[3], (pos[0], pos[1])))
+    gene_map.sort(key=lambda x: x[0])
+    gene_map = [x[1] for x in gene_map]
+
+    size = len(gene_map)
+    next_end = list(range(1, size + 1))
+    prev_end = list(range(-1, size - 1))
+    alive = [True] * size
+    occurrences = {}
+    for i, end in enumerate(gene_map):
+        occurrences.setdefault(end, deque()).append(i)
+
+    def unlink(i):
+        alive[i] = False
+        if prev_end[i] >= 0:
+            next_end[prev_end[i]] = next_end[i]
+        if next_end[i] < size:
+            prev_end[next_end[i]] = prev_end[i]
+
+    head = 0
+    cur = 0
+    while cur < size and next_end[cur] < size:
+        left, right = cur, next_end[cur]
+        if gene_map[left][0] == gene_map[right][0]:
+            cur = next_end[right]
+            continue
+
+        loser = gene_map[left] if gene_map[left][1] < gene_map[right][1] else gene_map[right]
+        ends = occurrences[loser]
+        for _ in range(2):
+            while not alive[ends[0]]:
+                ends.popleft()
+            removed = ends.popleft()
+            if removed == head:
+                head = next_end[removed]
+            unlink(removed)
+        cur = left if alive[left] else right
+
+    picked = []
+    cur = head
+    while cur < size:
+        picked.append(gene_map[cur][0])
+        cur = next_end[cur]
+    return list(dict.fromkeys(picked))
+
+
 def filter_taxanomy(taxa=None, fasta_file=None, hmm_frame: pandas.DataFrame = None, basedir=None,
-                    prefix=None, dbfile=None, gene_code=9, relaxing=0, threads=8):
+                    prefix=None, dbfile=None, gene_code=9, relaxing=0, threads=8, hit_cache=None):
 
     logger.log(1, f'Filtering taxanomy with tblastn.')
-    # Extract sequences from input fasta file according to hmm frame
+    # Sequences judged before with the same database and options are skipped
+    taxa_space = Cache.key('taxa', file_digest(dbfile), taxa, relaxing, gene_code)
+    records = list(SeqIO.parse(fasta_file, 'fasta'))
+    cached, uncached = hit_cache.split(taxa_space, records) if hit_cache is not None else ({}, records)
+    to_save = [key for key, is_in in cached.items() if is_in]
+    if not uncached:
+        logger.log(2, f'Reusing taxanomy of all the {len(cached)} sequences.')
+        return taxa_selected(hmm_frame, to_save, basedir, prefix)
+    if cached:
+        logger.log(
+            2, f'Reusing taxanomy of {len(cached)} sequences, searching {len(uncached)} new sequences.')
+        fasta_file = path.join(basedir, f'{prefix}.taxa.uncached.fa')
+        SeqIO.write(uncached, fasta_file, 'fasta')
 
     # Do tblastn to search out the possible taxanomy of the gene
     blast_file = tk.tblastn_multi(dbfile=dbfile, infile=fasta_file,
                                   genetic_code=gene_code, basedir=basedir, prefix=prefix, threads=threads)
-    blast_frame_unfiltered, _ = tk.blast_to_csv(blast_file)
     try:
+        blast_frame_unfiltered, _ = tk.blast_to_csv(blast_file)
         blast_frame = tk.wash_blast_results(blast_frame_unfiltered)
     except Exception:
-        raise RuntimeError("Empty blast frame! Please check if your data is valid or of good quality.")
+        if not cached:
+            raise RuntimeError("Empty blast frame! Please check if your data is valid or of good quality.")
+        blast_frame = pandas.DataFrame(columns=['qseq', 'sseq'])
 
     # Drop the sequences which don't have even a gene related to taxa
     by_seqid = dict(tuple(blast_frame.groupby(['sseq'])))
-    to_save = []
     for key, frame in by_seqid.items():
         is_in = False
         for _, row in frame.iterrows():
@@ -414,8 +523,8 @@ def filter_taxanomy(taxa=None, fasta_file=None, hmm_frame: pandas.DataFrame = No
             taxa_name = ' '.join([qseq[4], qseq[5]])
             taxa_rank = get_rank(taxa_name)
             required_rank = get_rank(taxa)
-            required_id = ncbi.get_name_translator([taxa])[taxa][0]
-            required_class = ncbi.get_rank([required_id])[required_id]
+            required_id = taxonomy().get_name_translator([taxa])[taxa][0]
+            required_class = taxonomy().get_rank([required_id])[required_id]
             required_index = rank_list.index(required_class)
             # Get last index for the matching rank
             matches = [idx
@@ -430,6 +539,15 @@ def filter_taxanomy(taxa=None, fasta_file=None, hmm_frame: pandas.DataFrame = No
         if is_in:
             to_save.append(key)
 
+    if hit_cache is not None:
+        saved = set(to_save)
+        for record in uncached:
+            hit_cache.store(taxa_space, record, record.id in saved)
+
+    return taxa_selected(hmm_frame, to_save, basedir, prefix)
+
+
+def taxa_selected(hmm_frame, to_save, basedir, prefix):
     filtered_frame = hmm_frame[hmm_frame['target'].isin(to_save)]
     filtered_frame.to_csv(
         path.join(basedir, f'{prefix}.taxa.csv'), index=False)
@@ -438,24 +556,54 @@ def filter_taxanomy(taxa=None, fasta_file=None, hmm_frame: pandas.DataFrame = No
     return filtered_frame
 
 
-def remap_sequence(prefix=None, basedir=None, fasta_file=None, fastq1=None, fastq2=None, threads=8):
+class HitCache():
+    '''
+    Search results of sequences already searched in this run.
+
+    The additional check runs findmitoscaf again on the picked sequences,
+    and most of them are not changed by merging at all. Results are kept by
+    the sequence content under a space made of the profile digest and the
+    options, so only the sequences created by merging are searched again.
+    '''
+
+    def __init__(self):
+        self.results = {}
+
+    @staticmethod
+    def seq_key(record):
+        return hashlib.sha1(str(record.seq).upper().encode()).hexdigest()
+
+    def split(self, space, records):
+        '''
+        Returns the cached results by record ids, and the records not cached.
+        '''
+        cached = {}
+        uncached = []
+        for record in records:
+            key = (space, self.seq_key(record))
+            if key in self.results:
+                cached[record.id] = self.results[key]
+            else:
+                uncached.append(record)
+        return cached, uncached
+
+    def store(self, space, record, result):
+        self.results[(space, self.seq_key(record))] = result
+
+
+def remap_sequence(prefix=None, basedir=None, fasta_file=None, fastq1=None, fastq2=None, threads=8, cache_dir=None):
 
     # Remap sequence back to the fastq file
-    # This can be a non-trival task, so a partial of threads are
-    # given to samtools view and samtools sort.
-    logger.log(2, "Mapping fastq reads back onto fasta file.")
-    shell_call('bwa index', fasta_file)
-    bam_file = path.join(basedir, f'{prefix}.bam')
-    check_output(
-        f'bwa mem -t {max(1, int(threads*0.75))} {fasta_file} {fastq1} {fastq2 if fastq2!=None else ""} |samtools view -bS -q 30 -h -@ {max(1, int(threads*0.25))} -o {bam_file} -', shell=True)
-    bam_sorted_file = path.join(basedir, f'{prefix}.sorted.bam')
-    check_output(f'samtools sort -@ {threads} -o {bam_sorted_file} {bam_file}', shell=True)
+    # The mapping is shared with visualize, so it's done through the
+    # mapping cache rather than here.
+    _, depth_file = map_reads(fasta_file=fasta_file, fastq1=fastq1, fastq2=fastq2,
+                              cache_dir=cache_dir if cache_dir is not None else path.join(basedir, 'mapping'),
+                              threads=threads)
 
     logger.log(2, "Calculating average depth for each sequence.")
     gene_depth_file = path.join(basedir, f'{prefix}.dep')
     avgdep_bin = path.join(path.abspath(path.dirname(__file__)), 'avgdep_bin')
-    check_output(
-        f'samtools depth -aa {bam_sorted_file} |{avgdep_bin} -o {gene_depth_file}', shell=True)
+    direct_call(f'{avgdep_bin} -i {depth_file} -o {gene_depth_file}')
 
     mapping = {k: v for k, v in map(str.split, open(gene_depth_file))}
 
@@ -0,0 +1,141 @@
+"""
+prescreen.py
+=========
+
+Copyright (c) 2019-2020 Li Junyu <2018301050@szu.edu.cn>.
+
+This file is part of MitoFlex.
+
+MitoFlex is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MitoFlex is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+'''
+A cheap translated minimizer prescreen of contigs.
+
+Minimizers of amino acid k-mers are collected from the clade protein profile,
+then every contig is translated in six frames and the number of distinct
+minimizers it shares with the profile is counted. Contigs sharing fewer than
+the given number are thought to have no mitochondrial signal, and will not be
+searched by nhmmer and tblastn at all.
+'''
+
+import os
+import sys
+from os import path
+
+try:
+    sys.path.insert(0, os.path.abspath(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..")))
+    import numpy as np
+    from utility import logger
+    from utility.bio import codon
+    from utility.bio.seq import read_fasta
+except ImportError as err:
+    sys.exit(
+        f"Unable to import helper module {err.name}, is the installation of MitoFlex valid?")
+
+# Length of the amino acid k-mers and the window to pick minimizers from.
+KMER = 5
+WINDOW = 6
+
+_amino_codes = np.full(256, 20, dtype=np.int64)
+for _idx, _amino in enumerate('ACDEFGHIKLMNPQRSTVWY'):
+    _amino_codes[ord(_amino)] = _amino_codes[ord(_amino.lower())] = _idx
+
+_empty = np.iinfo(np.uint64).max
+
+
+def minimizers(protein: np.ndarray) -> np.ndarray:
+    '''
+    Minimizers of an uint8 array of amino acid letters, k-mers with stops or
+    unknown residues are never picked.
+    '''
+    codes = _amino_codes[protein]
+    count = len(codes) - KMER + 1
+    if count <= 0:
+        return np.empty(0, dtype=np.uint64)
+
+    kmers = np.zeros(count, dtype=np.int64)
+    invalid = np.zeros(count, dtype=bool)
+    for offset in range(KMER):
+        window = codes[offset:offset + count]
+        kmers = kmers * 21 + window
+        invalid |= window == 20
+
+    # Scramble k-mers before taking the minimum, otherwise the minimizers
+    # are biased to k-mers full of alanines.
+    with np.errstate(over='ignore'):
+        hashed = kmers.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        hashed ^= hashed >> np.uint64(29)
+    hashed[invalid] = _empty
+
+    if count < WINDOW:
+        picked = hashed.min(keepdims=True)
+    else:
+        windows = np.lib.stride_tricks.as_strided(
+            hashed, shape=(count - WINDOW + 1, WINDOW),
+            strides=(hashed.strides[0], hashed.strides[0]))
+        picked = windows.min(axis=1)
+    return np.unique(picked[picked != _empty])
+
+
+def profile_index(profile_fasta: str) -> np.ndarray:
+    collected = [minimizers(np.frombuffer(seq.encode(), dtype=np.uint8))
+                 for _, _, seq in read_fasta(profile_fasta)]
+    return np.unique(np.concatenate(collected)) if collected else np.empty(0, dtype=np.uint64)
+
+
+def shared_minimizers(sequence: str, index: np.ndarray, code=9) -> int:
+    encoded = codon.encode(sequence)
+    reverse = codon.reverse_complement(encoded)
+    found = [minimizers(codon.translate(strand, frame, code))
+             for strand in (encoded, reverse)
+             for frame in range(3)]
+    return int(np.isin(np.unique(np.concatenate(found)), index, assume_unique=True).sum())
+
+
+def prescreen(fasta_file=None, profile_fasta=None, basedir=None, prefix=None, code=9, min_hits=1):
+    '''
+    Writes contigs passing the prescreen to a new fasta file and returns it,
+    a report of the removed input is written alongside.
+    '''
+    index = profile_index(profile_fasta)
+    logger.log(1, f'Prescreen index has {len(index)} minimizers from {profile_fasta}.')
+
+    screened_fa = path.join(basedir, f'{prefix}.prescreen.fa')
+    report_file = path.join(basedir, f'{prefix}.prescreen.txt')
+
+    total = kept = total_bases = kept_bases = 0
+    with open(screened_fa, 'w') as fout, open(report_file, 'w') as report:
+        print('id', 'length', 'shared', 'kept', sep='\t', file=report)
+        for name, desc, seq in read_fasta(fasta_file):
+            hits = shared_minimizers(seq, index, code)
+            passed = hits >= min_hits
+            total += 1
+            total_bases += len(seq)
+            if passed:
+                kept += 1
+                kept_bases += len(seq)
+                print(f'>{name} {desc}'.rstrip(), seq, sep='\n', file=fout)
+            print(name, len(seq), hits, int(passed), sep='\t', file=report)
+
+        removed, removed_bases = total - kept, total_bases - kept_bases
+        summary = (f'Prescreen removed {removed}/{total} sequences, '
+                   f'{removed_bases}/{total_bases} bps ({100 * removed_bases / max(1, total_bases):.2f}%) '
+                   f'of the search input with minimum {min_hits} shared minimizers.')
+        print(f'# {summary}', file=report)
+
+    logger.log(2, summary)
+    return screened_fa
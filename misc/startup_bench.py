@@ -0,0 +1,128 @@
+"""
+startup_bench.py
+=========
+
+Copyright (c) 2019-2020 Li Junyu <2018301050@szu.edu.cn>.
+
+This file is part of MitoFlex.
+
+MitoFlex is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MitoFlex is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import sys
+import os
+import json
+import subprocess
+from statistics import median
+from time import time
+
+try:
+    sys.path.insert(0, os.path.abspath(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..")))
+    from utility.parser import parse_func, parse_then_call, freeze_main, arg_prop
+
+except ImportError as err:
+    sys.exit(f"Unable to import helper module {err}, is the installation of MitoFlex valid?")
+
+mitoflex_main = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'MitoFlex.py'))
+
+# Command lines that should never load anything heavy
+cases = [
+    ['--help'],
+    ['all', '--help'],
+    ['annotate', '--no-such-argument'],
+]
+
+# Modules only the commands themselves should import
+heavy_modules = ['Bio', 'pandas', 'numpy', 'scipy', 'ete3', 'psutil']
+
+# Runs MitoFlex.py like the command line, then reports the heavy modules loaded
+probe = '''
+import runpy, sys, json
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+loaded = sorted(set(x.split('.')[0] for x in sys.modules) & set(json.loads({heavy!r})))
+print('LOADED', json.dumps(loaded), file=sys.__stderr__)
+'''.format(heavy=json.dumps(heavy_modules))
+
+
+def run_case(argv=None, runs=5):
+    '''
+    Returns the median time of running the command line, and the heavy
+    modules it loaded, None if it crashed. A bare python is run if argv is
+    None.
+    '''
+    elapsed = []
+    loaded = []
+    for _ in range(runs):
+        start = time()
+        command = [sys.executable, '-c', probe, mitoflex_main] + argv if argv is not None else [sys.executable, '-c', 'pass']
+        finished = subprocess.run(command,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                  universal_newlines=True, cwd=os.path.dirname(mitoflex_main))
+        elapsed.append(time() - start)
+        if argv is None:
+            continue
+        reports = [x for x in finished.stderr.splitlines() if x.startswith('LOADED ')]
+        if not reports:
+            print(finished.stderr, file=sys.stderr)
+            return median(elapsed), None
+        loaded = json.loads(reports[-1][len('LOADED '):])
+    return median(elapsed), loaded
+
+
+@parse_func
+@arg_prop(dest='runs', default=5, help='how many times each command line is run, the median time is used')
+@arg_prop(dest='limit', default=0.5, help='the max seconds a command line could take more than a bare python')
+def main(args):
+    baseline, _ = run_case(runs=args.runs)
+    print(f'Bare python starts in {baseline:.3f}s.')
+
+    failed = False
+    for argv in cases:
+        elapsed, loaded = run_case(argv, args.runs)
+        if loaded is None:
+            failed = True
+            print(f'MitoFlex.py {" ".join(argv)} : crashed')
+            continue
+        slow = elapsed - baseline > args.limit
+        failed = failed or slow or bool(loaded)
+        print(f'MitoFlex.py {" ".join(argv)} : {elapsed:.3f}s (+{elapsed - baseline:.3f}s)',
+              '(too slow)' if slow else '',
+              f'(loaded {", ".join(loaded)})' if loaded else '')
+
+    if failed:
+        sys.exit('Startup of MitoFlex became slower or heavier, check the imports.')
+    print('Startup is fine.')
+
+
+desc = '''
+startup_bench.py
+
+Description
+    Measures how long MitoFlex.py takes to show help or report a bad argument,
+    and checks that heavy modules like Bio, pandas and ete3 are not loaded
+    before a command runs. Exits with an error if the startup is slower than
+    the limit or heavy modules are loaded, so it can guard against imports
+    added at the top of the command line modules.
+'''
+
+# Program entry starts at here
+if __name__ == '__main__':
+    parser = freeze_main(prog='startup_bench.py', desc=desc)
+    parse_then_call(parser)
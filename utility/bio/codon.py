@@ -0,0 +1,99 @@
+"""
+codon.py
+=========
+
+Copyright (c) 2019-2020 Li Junyu <2018301050@szu.edu.cn>.
+
+This file is part of MitoFlex.
+
+MitoFlex is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MitoFlex is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+'''
+Codon helpers working on numpy arrays instead of strings.
+
+Sequences are encoded as uint8 arrays (A=0, C=1, G=2, T=3, others=4), and
+codons as indexes 16*a+4*b+c, where codons with any unknown base are 64.
+Every genetic code is then just a lookup table of 65 entries, so translating
+or finding stops of a whole contig is a couple of array operations.
+'''
+
+import numpy as np
+from Bio.Data import CodonTable
+
+UNKNOWN = 4
+INVALID_CODON = 64
+
+_encoding = np.full(256, UNKNOWN, dtype=np.uint8)
+for _idx, _base in enumerate('ACGT'):
+    _encoding[ord(_base)] = _encoding[ord(_base.lower())] = _idx
+_encoding[ord('U')] = _encoding[ord('u')] = 3
+
+_codon_names = [a + b + c for a in 'ACGT' for b in 'ACGT' for c in 'ACGT']
+_tables = {}
+
+
+def encode(sequence) -> np.ndarray:
+    return _encoding[np.frombuffer(str(sequence).encode(), dtype=np.uint8)]
+
+
+def reverse_complement(encoded: np.ndarray) -> np.ndarray:
+    return np.where(encoded < UNKNOWN, 3 - encoded, UNKNOWN).astype(np.uint8)[::-1]
+
+
+def codons(encoded: np.ndarray, frame=0) -> np.ndarray:
+    '''
+    Codon indexes of the given frame, trailing bases are ignored.
+    '''
+    count = max(0, (len(encoded) - frame) // 3)
+    triplets = encoded[frame:frame + count * 3].reshape(count, 3).astype(np.int16)
+    indexes = triplets[:, 0] * 16 + triplets[:, 1] * 4 + triplets[:, 2]
+    indexes[(triplets == UNKNOWN).any(axis=1)] = INVALID_CODON
+    return indexes
+
+
+def table(code=9):
+    '''
+    Returns (amino, stops, starts) of a genetic code, where amino is the one
+    letter translation of each codon index as uint8, 'X' for unknown, '*' for
+    stops; stops and starts are boolean masks of codon indexes. Start codons
+    here are the ones translated to M, like the translation-based search does.
+    '''
+    if code not in _tables:
+        codon_table = CodonTable.unambiguous_dna_by_id[code]
+        amino = np.full(65, ord('X'), dtype=np.uint8)
+        for idx, name in enumerate(_codon_names):
+            if name in codon_table.stop_codons:
+                amino[idx] = ord('*')
+            else:
+                amino[idx] = ord(codon_table.forward_table[name])
+        stops = amino == ord('*')
+        starts = amino == ord('M')
+        _tables[code] = (amino, stops, starts)
+    return _tables[code]
+
+
+def translate(encoded: np.ndarray, frame=0, code=9) -> np.ndarray:
+    amino, _, _ = table(code)
+    return amino[codons(encoded, frame)]
+
+
+def sites(encoded: np.ndarray, mask: np.ndarray) -> list:
+    '''
+    Sorted 1-based positions of the codons in mask (like stops or starts of
+    a table), one array for each frame.
+    '''
+    return [np.flatnonzero(mask[codons(encoded, frame)]) * 3 + frame + 1
+            for frame in range(3)]
@@ -43,9 +43,14 @@ except ImportError as err:
 class Infernal():
 
     class Result():
-        def __init__(self, data: str):
-            lines = data.split('\n')
+        '''
+        A hit of cmsearch, the secondary structure of the alignment is only
+        folded when it's first asked for.
+        '''
+
+        def __init__(self, lines: list, query=None):
             ids = lines[0].split()
+            self.query = query
             self.sequence = ids[0]
             paras = lines[3].split()
             self.rank = paras[0].translate({ord(i): None for i in '()'})
@@ -60,16 +65,18 @@ class Infernal():
             self.acc = float(paras[13])
             self.full = paras[14] == 'no'
             self.gc = float(paras[15])
-            self.alignment = None
-
-            seq = lines[8].split(maxsplit=2)[2].rsplit(maxsplit=1)[0]
-            fold = lines[5].split()[0]
 
-            fold, seq = wuss.align_fold(fold, seq)
-
-            sing = wuss.seq2single(seq)
+            self._seq = lines[8].split(maxsplit=2)[2].rsplit(maxsplit=1)[0]
+            self._fold = lines[5].split()[0]
+            self._alignment = None
             self.qual = lines[9].split()[0]
-            self.alignment = wuss.GenericLoop(fold, sing)
+
+        @property
+        def alignment(self):
+            if self._alignment is None:
+                fold, seq = wuss.align_fold(self._fold, self._seq)
+                self._alignment = wuss.GenericLoop(fold, seq)
+            return self._alignment
 
         def __repr__(self):
             return '\n'.join([f'{key}={value}' for key, value in vars(self).items()])
@@ -78,34 +85,53 @@ class Infernal():
             return '\n'.join([f'{key}={value}' for key, value in vars(self).items()])
 
     def __init__(self, file):
-
-        alignments = []
-
-        # Read file into result
+        self.file = file
+        self._alignments = None
+
+    def __iter__(self):
+        '''
+        Yields hits one by one while reading the file, hits are kept with the
+        model they belong to, so a search of multiple models could be told
+        apart.
+        '''
         try:
-            with open(file, 'r') as inf:
-                stage = 0
-                for line in inf:
-                    if line != '\n':
-                        if line.startswith('#'):
-                            continue
-                        elif line.startswith('Hit alignments'):
-                            stage = 1
-                            continue
-                        elif '[No hits detected that satisfy reporting thresholds]' in line:
-                            continue
-                        elif line.startswith('Internal CM pipeline statistics summary'):
-                            stage = 2
-                            continue
-
-                        if stage == 1:
-                            alignments.append(line)
+            inf = open(self.file, 'r')
         except Exception:
             raise IOError("Cannot read infernal file!")
 
-        alignments = ''.join(alignments).split('\n>> ')[1:]
-        self.alignments = [Infernal.Result(
-            data) for data in alignments if '[No hits detected that satisfy reporting thresholds]' not in data]
+        with inf:
+            stage = 0
+            query = None
+            block = []
+            for line in inf:
+                if line == '\n' or line.startswith('#'):
+                    continue
+                elif line.startswith('>> ') and stage == 1:
+                    if block:
+                        yield Infernal.Result(block, query)
+                    block = [line[3:]]
+                    continue
+
+                if line.startswith('Query:') or line.startswith('Internal CM pipeline statistics summary'):
+                    if block:
+                        yield Infernal.Result(block, query)
+                    block = []
+                    if line.startswith('Query:'):
+                        query = line.split()[1]
+                    stage = 0
+                elif line.startswith('Hit alignments'):
+                    stage = 1
+                elif stage == 1 and block and \
+                        '[No hits detected that satisfy reporting thresholds]' not in line:
+                    block.append(line)
+            if block:
+                yield Infernal.Result(block, query)
+
+    @property
+    def alignments(self):
+        if self._alignments is None:
+            self._alignments = list(self)
+        return self._alignments
 
 
 class Queries():
@@ -34,3 +34,35 @@ def decompile(input_seq: str, equ='=', sep='\t'):
     return {trait.split(equ)[0]: trait.split(equ)[1]
             for trait in input_seq.split(sep)
             if equ in trait}
+
+
+# read a fasta file into (id, description, sequence) tuples without biopython
+def read_fasta(fasta_file: str):
+    name = desc = None
+    chunks = []
+    with open(fasta_file, 'r') as f:
+        for line in f:
+            line = line.rstrip()
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, desc, ''.join(chunks)
+                header = line[1:].split(maxsplit=1)
+                name = header[0] if header else ''
+                desc = header[1] if len(header) > 1 else ''
+                chunks = []
+            elif line:
+                chunks.append(line)
+    if name is not None:
+        yield name, desc, ''.join(chunks)
+
+
+# digest the sequences of a fasta file, ids are returned but not hashed
+def sequence_digest(fasta_file: str):
+    import hashlib
+    sha = hashlib.sha1()
+    ids = []
+    for name, _, seq in read_fasta(fasta_file):
+        ids.append(name)
+        sha.update(seq.upper().encode())
+        sha.update(b'\n')
+    return sha.hexdigest(), ids
@@ -22,7 +22,7 @@ along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 
-from itertools import groupby
+from array import array
 
 
 '''
@@ -30,336 +30,299 @@ A simple parser for parsing Washington University
 Secondary Structure (WUSS) parsing.
 How did you have this name as the format...?
 I'm confused.
+
+Bases are never made into objects, the fold is turned into a table of base
+pairs with one stack pass, and every part of the structure only keeps the
+positions it covers in the shared fold and sequence strings. Loops skip over
+the ranges of their inner loops, so the whole structure is parsed in a
+single linear walk.
 '''
 
 
+_left_brackets = '{[(<'
+_right_brackets = '}])>'
+
+
 # Conversion
 
-def seq2single(sequence: str):
-    return [Single(x, []) for x in sequence]
+def pair_table(fold: str):
+    '''
+    Returns the partner position of every position in fold, -1 for the
+    unpaired ones. Unmatched brackets are left unpaired.
+    '''
+    table = array('i', [-1]) * len(fold)
+    stacks = {x: [] for x in _left_brackets}
+    for idx, cha in enumerate(fold):
+        if cha in stacks:
+            stacks[cha].append(idx)
+        elif cha in _right_brackets:
+            stack = stacks[_left_brackets[_right_brackets.index(cha)]]
+            if stack:
+                pos = stack.pop()
+                table[pos] = idx
+                table[idx] = pos
+    return table
 
 
 # Foundamental structures
 
-class Single():
-    def __init__(self, base, parent: list):
-        self.base = base
-        self.parent = parent
-
-    def __repr__(self):
-        return self.base
+class Sequence():
+    '''
+    Positions of bases in the order they are pushed.
+    '''
+    __slots__ = ('source', 'positions')
 
+    def __init__(self, source: str):
+        self.source = source
+        self.positions = []
 
-class Sequence():
-    def __init__(self, sequence: list):
-        self.sequence = sequence
+    def push(self, idx: int):
+        self.positions.append(idx)
 
-    def push(self, base: Single):
-        self.sequence.append(base)
+    @property
+    def sequence(self):
+        return self.to_str()
 
     def to_str(self):
-        return ''.join([single.base for single in self.sequence])
+        return ''.join([self.source[idx] for idx in self.positions])
 
     def __repr__(self):
-        return ''.join([single.base for single in self.sequence])
+        return self.to_str()
 
 
-class Sets():
-    def __init__(self, bases: set):
-        self.bases = bases
+class Sets(Sequence):
+    __slots__ = ()
 
-    def insert(self, base: Single):
-        self.bases.add(base)
+    def insert(self, idx: int):
+        self.positions.append(idx)
 
     def __repr__(self):
-        return f'({",".join([single.base for single in self.bases])})'
+        return f'({",".join(self.to_str())})'
 
 
 class Paired():
-    def __init__(self, left: list, right: list):
-        self.left = left
-        self.right = right
+    __slots__ = ('source', 'left', 'right')
+
+    def __init__(self, source: str):
+        self.source = source
+        self.left = []
+        self.right = []
 
-    def insert(self, l: Single, r: Single):
+    def insert(self, l: int, r: int):
         self.left.insert(0, l)
         self.right.append(r)
 
     def __repr__(self):
-        return f'L:{"".join([single.base for single in self.left])} R:{"".join([single.base for single in self.right])}'
+        return f'L:{"".join([self.source[x] for x in self.left])} R:{"".join([self.source[x] for x in self.right])}'
 
 
 # Components
 
 class Hairpin(Sequence):
-    def __init__(self, sequence):
-        super().__init__(sequence)
+    __slots__ = ()
 
 
 class Stem(Paired):
-    def __init__(self, left, right):
-        super().__init__(left, right)
+    __slots__ = ()
 
 
 class InteriorLoop(Sets):
-    def __init__(self, bases: set):
-        super().__init__(bases)
+    __slots__ = ()
 
 
 class MultiBranchLoop(Sets):
-    def __init__(self, bases: set):
-        super().__init__(bases)
+    __slots__ = ()
 
 
 # Partions of Secondary Structures
 
-class HairpinLoop():
-
-    '''
-    Any loops that enclosed by <>, which indicates it a hairpin loop.
-    '''
-
-    def __init__(self, foldseq: str, sequence: list):
-        if len(foldseq) != len(sequence):
-            raise RuntimeError(
-                "Fold sequence should be as long as the base sequence!")
-        self.sequence = sequence
-        self.loop = InteriorLoop(set())
-        self.hairpin = Hairpin([])
-        self.stem = Stem([], [])
-        self.unknown = Sets(set())
-        self.fold = foldseq
-
-        stack = []
-        for idx, cha in enumerate(foldseq):
-            sequence[idx].parent.append(self)
-            if cha == '_':
-                sequence[idx].parent.append(self.hairpin)
-                self.hairpin.push(sequence[idx])
-            elif cha == '<':
-                sequence[idx].parent.append(self.stem)
-                stack.append(sequence[idx])
-            elif cha == '>':
-                sequence[idx].parent.append(self.hairpin)
-                ident = stack.pop()
-                self.stem.insert(ident, sequence[idx])
-            elif cha == '-':
-                sequence[idx].parent.append(self.loop)
-                self.loop.insert(sequence[idx])
-            else:
-                self.unknown.insert(sequence[idx])
-                sequence[idx].parent.append(self.unknown)
-
-        son_level = sequence[0].parent.index(self)+1
-        translated = [base.parent[son_level] for base in sequence]
-        self.components = [x[0] for x in groupby(translated)]
-
-
-class MultiLoop():
+class Loop():
     '''
-    Any loops that is enclosed by (), indicating the loop has serveral hairpins or others.
+    A loop covering fold[start:end], components are the parts of the loop in
+    the order they appear, with repeated neighbours merged.
     '''
+    __slots__ = ('fold', 'source', 'start', 'end', 'components')
 
-    def __init__(self, fold: str, sequence: list):
+    def __init__(self, fold: str, sequence, start=0, end=None, pairs=None):
+        if not isinstance(sequence, str):
+            sequence = ''.join([str(x) for x in sequence])
         if len(fold) != len(sequence):
             raise RuntimeError(
                 "Fold sequence should be as long as the base sequence!")
-        self.sequence = sequence
-        self.stem = Stem([], [])
-        self.multi = MultiBranchLoop(set())
-        self.interior = InteriorLoop(set())
-        self.unknown = Sets(set())
         self.fold = fold
+        self.source = sequence
+        self.start = start
+        self.end = len(fold) if end is None else end
+        self.components = []
+
+    @property
+    def sequence(self):
+        return self.source[self.start:self.end]
+
+    def add(self, component):
+        if not self.components or self.components[-1] is not component:
+            self.components.append(component)
+
+    def walk(self, pairs, inner):
+        '''
+        Gives every position to classify, or builds an inner loop and jumps
+        over it if the position opens one of the inner kinds.
+        '''
+        idx = self.start
+        while idx < self.end:
+            cha = self.fold[idx]
+            if cha in inner and self.start <= pairs[idx] < self.end and pairs[idx] > idx:
+                self.add(inner[cha](self.fold, self.source,
+                                    idx, pairs[idx] + 1, pairs))
+                idx = pairs[idx] + 1
+                continue
+            self.classify(idx, cha, pairs)
+            idx += 1
+
+
+class HairpinLoop(Loop):
 
-        stack = []
-
-        for idx, cha in enumerate(fold):
-            sequence[idx].parent.append(self)
-
-            if cha == '(':
-                stack.append(('(', sequence[idx]))
-            elif cha == ')':
-                ident = stack.pop()[1]
-                self.stem.insert(ident, sequence[idx])
-                sequence[idx].parent.append(self.stem)
-                ident.parent.append(self.stem)
-            elif cha == '<':
-                stack.append(('<', idx))
-            elif cha == '>':
-                pos = stack.pop()[1]
-                if '<' not in [x[0] for x in stack]:
-                    HairpinLoop(fold[pos:idx+1], sequence[pos:idx+1])
-            elif cha == ',':
-                self.multi.insert(sequence[idx])
-                sequence[idx].parent.append(self.multi)
-            elif cha == '-':
-                if '<' not in [x[0] for x in stack]:
-                    self.interior.insert(sequence[idx])
-                    sequence[idx].parent.append(self.interior)
-            else:
-                if '<' not in [x[0] for x in stack]:
-                    self.unknown.insert(sequence[idx])
-                    sequence[idx].parent.append(self.unknown)
-
-        son_level = sequence[0].parent.index(self)+1
-        translated = [base.parent[son_level] for base in sequence]
-        self.components = [x[0] for x in groupby(translated)]
-
-
-class ComplexLoop():
+    '''
+    Any loops that enclosed by <>, which indicates it a hairpin loop.
+    '''
+    __slots__ = ('loop', 'hairpin', 'stem', 'unknown')
+
+    def __init__(self, fold: str, sequence, start=0, end=None, pairs=None):
+        super().__init__(fold, sequence, start, end)
+        self.loop = InteriorLoop(self.source)
+        self.hairpin = Hairpin(self.source)
+        self.stem = Stem(self.source)
+        self.unknown = Sets(self.source)
+        if pairs is None:
+            pairs = pair_table(fold)
+        self.walk(pairs, {})
+
+    def classify(self, idx, cha, pairs):
+        if cha == '_':
+            self.hairpin.push(idx)
+            self.add(self.hairpin)
+        elif cha == '<':
+            self.add(self.stem)
+        elif cha == '>':
+            # Closing bases are merged into the hairpin part
+            self.stem.insert(pairs[idx], idx)
+            self.add(self.hairpin)
+        elif cha == '-':
+            self.loop.insert(idx)
+            self.add(self.loop)
+        else:
+            self.unknown.insert(idx)
+            self.add(self.unknown)
+
+
+class MultiLoop(Loop):
+    '''
+    Any loops that is enclosed by (), indicating the loop has serveral hairpins or others.
+    '''
+    __slots__ = ('stem', 'multi', 'interior', 'unknown')
+
+    def __init__(self, fold: str, sequence, start=0, end=None, pairs=None):
+        super().__init__(fold, sequence, start, end)
+        self.stem = Stem(self.source)
+        self.multi = MultiBranchLoop(self.source)
+        self.interior = InteriorLoop(self.source)
+        self.unknown = Sets(self.source)
+        if pairs is None:
+            pairs = pair_table(fold)
+        self.walk(pairs, {'<': HairpinLoop})
+
+    def classify(self, idx, cha, pairs):
+        if cha in '()':
+            if cha == ')':
+                self.stem.insert(pairs[idx], idx)
+            self.add(self.stem)
+        elif cha == ',':
+            self.multi.insert(idx)
+            self.add(self.multi)
+        elif cha == '-':
+            self.interior.insert(idx)
+            self.add(self.interior)
+        else:
+            self.unknown.insert(idx)
+            self.add(self.unknown)
+
+
+class ComplexLoop(Loop):
     '''
     Any loop that is enclosed by [], indicating it a higher level than MultiLoop
     '''
-
-    def __init__(self, fold: str, sequence: list):
-        if len(fold) != len(sequence):
-            raise RuntimeError(
-                "Fold sequence should be as long as the base sequence!")
-        self.sequence = sequence
-        self.multi = MultiBranchLoop(set())
-        self.stem = Stem([], [])
-        self.interior = InteriorLoop(set())
-        self.mismatch = Sets(set())
-        self.unknown = Sets(set())
-        self.fold = fold
-
-        stack = []
-
-        for idx, cha in enumerate(fold):
-            sequence[idx].parent.append(self)
-
-            if cha == '[':
-                stack.append(('[', sequence[idx]))
-            elif cha == ']':
-                ident = stack.pop()[1]
-                self.stem.insert(ident, sequence[idx])
-                ident.parent.append(self.stem)
-                sequence[idx].parent.append(self.stem)
-            elif cha == '(':
-                stack.append(('(', idx))
-            elif cha == ')':
-                ident = stack.pop()[1]
-                if '(' not in [x[0] for x in stack]:
-                    MultiLoop(fold[ident: idx+1], sequence[ident:idx+1])
-            elif cha == '<':
-                if '(' not in [x[0] for x in stack]:
-                    stack.append(('<', idx))
-            elif cha == '>':
-                if '<' in [x[0] for x in stack]:
-                    ident = stack.pop()[1]
-                    if '<' not in [x[0] for x in stack]:
-                        HairpinLoop(fold[ident:idx+1], sequence[ident:idx+1])
-            elif cha == ',':
-                if '(' not in [x[0] for x in stack]:
-                    self.multi.insert(sequence[idx])
-                    sequence[idx].parent.append(self.multi)
-            elif cha == '-':
-                if not(False in [x[0] == '[' for x in stack]):
-                    self.interior.insert(sequence[idx])
-                    sequence[idx].parent.append(self.interior)
-            elif cha == ':':
-                self.mismatch.insert(sequence[idx])
-                sequence[idx].parent.append(self.mismatch)
-            else:
-                if not (False in [x[0] == '[' for x in stack]):
-                    self.unknown.insert(sequence[idx])
-                    sequence[idx].parent.append(self.unknown)
-
-        son_level = sequence[0].parent.index(self)+1
-        translated = [base.parent[son_level] for base in sequence]
-        self.components = [x[0] for x in groupby(translated)]
+    __slots__ = ('multi', 'stem', 'interior', 'mismatch', 'unknown')
+    stem_brackets = '[]'
+
+    def __init__(self, fold: str, sequence, start=0, end=None, pairs=None):
+        super().__init__(fold, sequence, start, end)
+        self.multi = MultiBranchLoop(self.source)
+        self.stem = Stem(self.source)
+        self.interior = InteriorLoop(self.source)
+        self.mismatch = Sets(self.source)
+        self.unknown = Sets(self.source)
+        if pairs is None:
+            pairs = pair_table(fold)
+        self.walk(pairs, self.inner())
+
+    @staticmethod
+    def inner():
+        return {'(': MultiLoop, '<': HairpinLoop}
+
+    def classify(self, idx, cha, pairs):
+        if cha in self.stem_brackets:
+            if cha == self.stem_brackets[1]:
+                self.stem.insert(pairs[idx], idx)
+            self.add(self.stem)
+        elif cha == ',':
+            self.multi.insert(idx)
+            self.add(self.multi)
+        elif cha == '-':
+            self.interior.insert(idx)
+            self.add(self.interior)
+        elif cha == ':':
+            self.mismatch.insert(idx)
+            self.add(self.mismatch)
+        else:
+            self.unknown.insert(idx)
+            self.add(self.unknown)
 
 
 # General structure
 
-class GenericLoop():
+class GenericLoop(ComplexLoop):
 
     '''
     Any loops that is enclosed by {}, means that the loop is on a even higher level.
     Also, it can parse loops that of any lower level, since it's the highest one of
     all, the name 'GenericLoop' is called.
     '''
+    __slots__ = ()
+    stem_brackets = '{}'
 
-    def __init__(self, fold: str, sequence: list):
-        if len(fold) != len(sequence):
-            raise RuntimeError(
-                "Fold sequence should be as long as the base sequence!")
-        self.sequence = sequence
-        self.multi = MultiBranchLoop(set())
-        self.stem = Stem([], [])
-        self.interior = InteriorLoop(set())
-        self.mismatch = Sets(set())
-        self.unknown = Sets(set())
-        self.fold = fold
-
-        stack = []
-
-        for idx, cha in enumerate(fold):
-            sequence[idx].parent.append(self)
-
-            if cha == '{':
-                stack.append(('{', sequence[idx]))
-            elif cha == '}':
-                ident = stack.pop()[1]
-                self.stem.insert(ident, sequence[idx])
-                ident.parent.append(self.stem)
-                sequence[idx].parent.append(self.stem)
-            elif cha == '[':
-                stack.append(('[', idx))
-            elif cha == ']':
-                ident = stack.pop()[1]
-                if '[' not in [x[0] for x in stack]:
-                    ComplexLoop(fold[ident:idx+1], sequence[ident:idx+1])
-            elif cha == '(':
-                if '[' not in [x[0] for x in stack]:
-                    stack.append(('(', idx))
-            elif cha == ')':
-                if '(' in [x[0] for x in stack]:
-                    ident = stack.pop()[1]
-                    if '(' not in [x[0] for x in stack]:
-                        MultiLoop(fold[ident: idx+1], sequence[ident:idx+1])
-            elif cha == '<':
-                if not(False in [x[0] == '{' or x[0] == '<' for x in stack]):
-                    stack.append(('<', idx))
-            elif cha == '>':
-                if '<' in [x[0] for x in stack]:
-                    ident = stack.pop()[1]
-                    if '<' not in [x[0] for x in stack]:
-                        HairpinLoop(fold[ident:idx+1], sequence[ident:idx+1])
-            elif cha == ',':
-                if not(False in [x[0] == '{' for x in stack]):
-                    self.multi.insert(sequence[idx])
-                    sequence[idx].parent.append(self.multi)
-            elif cha == '-':
-                if not(False in [x[0] == '{' for x in stack]):
-                    self.interior.insert(sequence[idx])
-                    sequence[idx].parent.append(self.interior)
-            elif cha == ':':
-                self.mismatch.insert(sequence[idx])
-                sequence[idx].parent.append(self.mismatch)
-            else:
-                if not(False in [x[0] == '{' for x in stack]):
-                    self.unknown.insert(sequence[idx])
-                    sequence[idx].parent.append(self.unknown)
-
-        son_level = sequence[0].parent.index(self)+1
-        translated = [base.parent[son_level] for base in sequence]
-        self.components = [x[0] for x in groupby(translated)]
+    @staticmethod
+    def inner():
+        return {'[': ComplexLoop, '(': MultiLoop, '<': HairpinLoop}
 
 
 def align_fold(fold, sing):
-    left_collections = '{[(<'
-    right_collections = '}])>'
+    left_collections = _left_brackets
+    right_collections = _right_brackets
 
     stack = []
     unaligned = []
     for idx, cha in enumerate(fold):
         if cha in right_collections and stack:
-            last_cha = stack[-1]
             right_level = right_collections.index(cha)
-            left_level = left_collections.index(last_cha[0])
 
             aligned = False
             while not aligned:
+                if not stack:
+                    # Every left hand bracket is rejected, so is this one.
+                    unaligned.append((cha, idx))
+                    aligned = True
+                    continue
+                left_level = left_collections.index(stack[-1][0])
                 if right_level == left_level:
                     aligned = True
                     stack.pop()
@@ -379,6 +342,6 @@ def align_fold(fold, sing):
             unaligned.append((cha, idx))
 
     unaligned += stack  # Adding remained unaligned brackets
-    indexes = [x[1] for x in unaligned]
+    indexes = set(x[1] for x in unaligned)
     return (''.join(x for idx, x in enumerate(fold) if idx not in indexes),
             ''.join(x for idx, x in enumerate(sing) if idx not in indexes))
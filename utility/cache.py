@@ -0,0 +1,197 @@
+"""
+cache.py
+=========
+
+Copyright (c) 2019-2020 Li Junyu <2018301050@szu.edu.cn>.
+
+This file is part of MitoFlex.
+
+MitoFlex is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MitoFlex is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+'''
+A tiny content-addressed cache made of plain directories.
+
+Every entry is a folder named by its key under the cache root, entries are
+built in a hidden staging folder and renamed into place once finished, so
+a half-written entry is never visible, even when several runs share the same
+root. The modification time of an entry is refreshed on every hit, and the
+least recently used entries are removed when the cache grows over its limit.
+Entries held by a run, in this process or another one, are never removed.
+'''
+
+import os
+import fcntl
+import shutil
+import hashlib
+import tempfile
+from os import path
+from contextlib import contextmanager
+
+
+def file_digest(*files):
+    '''
+    Digest the contents of the files given, None is skipped.
+    '''
+    sha = hashlib.sha1()
+    for file in files:
+        if file is None:
+            continue
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def file_stamp(file):
+    '''
+    A cheap identity of a file, used for large inputs like reads where
+    hashing the whole content is not affordable.
+    '''
+    if file is None:
+        return None
+    stat = os.stat(file)
+    return (path.abspath(file), stat.st_size, int(stat.st_mtime))
+
+
+class Cache():
+
+    def __init__(self, root, max_entries=None, max_size=None):
+        self.root = path.abspath(root)
+        self.max_entries = max_entries
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def lookup(self, key):
+        entry = path.join(self.root, key)
+        if not path.isdir(entry):
+            return None
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return entry
+
+    @contextmanager
+    def hold(self, key):
+        '''
+        Yields the entry of the key like lookup, the entry is not evicted until
+        the block exits. Entries created in the block are held as well.
+        '''
+        fd = self._lock(key, fcntl.LOCK_SH)
+        try:
+            yield self.lookup(key)
+        finally:
+            os.close(fd)
+
+    def _lock(self, key, operation):
+        # Lock files are removed with their entries, so a lock taken on a
+        # removed one is taken again on the new file.
+        lock_file = path.join(self.root, f'.{key}.lock')
+        while True:
+            fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, operation)
+                if path.samestat(os.fstat(fd), os.stat(lock_file)):
+                    return fd
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    @contextmanager
+    def create(self, key):
+        '''
+        Yields a staging folder to build the entry in, the entry is published
+        when the block exits without errors. If the same entry was published
+        by others in the meantime, the staging one is simply discarded.
+        '''
+        staging = tempfile.mkdtemp(prefix=f'.{key}.', dir=self.root)
+        try:
+            yield staging
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        entry = path.join(self.root, key)
+        try:
+            os.rename(staging, entry)
+            os.utime(entry)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        return [path.join(self.root, x) for x in os.listdir(self.root)
+                if not x.startswith('.') and path.isdir(path.join(self.root, x))]
+
+    @staticmethod
+    def size(entry):
+        total = 0
+        for folder, _, files in os.walk(entry):
+            for file in files:
+                try:
+                    total += path.getsize(path.join(folder, file))
+                except OSError:
+                    pass
+        return total
+
+    def evict(self):
+        if not self.max_entries and not self.max_size:
+            return
+        entries = self.entries()
+
+        def last_used(entry):
+            try:
+                return path.getmtime(entry)
+            except OSError:
+                return 0
+
+        entries.sort(key=last_used)
+        count = len(entries)
+        sizes = [self.size(entry) for entry in entries] if self.max_size else [0] * count
+        total = sum(sizes)
+
+        def over():
+            return (self.max_entries and count > self.max_entries) or \
+                (self.max_size and total > self.max_size)
+
+        # The newest entry is always kept, even if it's larger than the limit
+        for entry, size in zip(entries[:-1], sizes):
+            if not over():
+                break
+            if self._remove(entry):
+                count -= 1
+                total -= size
+
+    def _remove(self, entry):
+        key = path.basename(entry)
+        fd = self._lock(key, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if fd is None:
+            return False
+        try:
+            shutil.rmtree(entry, ignore_errors=True)
+            os.remove(path.join(self.root, f'.{key}.lock'))
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+        return True
@@ -21,12 +21,12 @@ along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import subprocess
 import sys
 import os
 from typing import Iterable
 from . import logger
-from time import time
+from .profiler import span
+from .runner import run
 from functools import wraps
 
 # cmd runner
@@ -75,15 +75,12 @@ def concat_command(*args, **kwargs):
     return command
 
 
-def direct_call(command):
+def direct_call(command, **kwargs):
     '''
-    Call a command directly.
+    Call a command directly, and return its output.
+    Keyword arguments like stdout, cwd, env and timeout are passed to runner.run.
     '''
-    try:
-        return subprocess.check_output(command, shell=True, stderr=subprocess.DEVNULL).decode('utf-8')
-    except subprocess.CalledProcessError as err:
-        print(err)
-        raise RuntimeError(f"Error when running command '{command}'. Exiting.")
+    return run(command, **kwargs)
 
 
 # playing with items
@@ -106,20 +103,20 @@ def safe_makedirs(path, exist_ok=False):
 
 def timed(enabled: bool):
     '''
-    A decorator that logs the start and the end of execution.
+    A decorator that records the execution as a profiler span, and logs the
+    start and the end of it if enabled.
     '''
     def timed_constructor(func):
-        if enabled:
-            @wraps(func)
-            def timed_wrapper(*args, **kwargs):
-                start = time()
+        @wraps(func)
+        def timed_wrapper(*args, **kwargs):
+            if enabled:
                 logger.log(level=1, info=f"Entering {func}.")
+            with span(func.__qualname__) as record:
                 result = func(*args, **kwargs)
-                logger.log(level=1, info=f"{func} execution finished in {time()-start:.2f}s.")
-                return result
-            return timed_wrapper
-        else:
-            return func
+            if enabled:
+                logger.log(level=1, info=f"{func} execution finished in {record.elapsed:.2f}s.")
+            return result
+        return timed_wrapper
 
     return timed_constructor
 
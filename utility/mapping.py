@@ -0,0 +1,104 @@
+"""
+mapping.py
+=========
+
+Copyright (c) 2019-2020 Li Junyu <2018301050@szu.edu.cn>.
+
+This file is part of MitoFlex.
+
+MitoFlex is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MitoFlex is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+'''
+Read mapping shared by findmitoscaf and visualize.
+
+Both modules map the reads back onto (almost) the same sequences, so the
+sorted BAM and the per-base depth are kept in a cache keyed by the sequence
+content, the reads and the MAPQ valve. If a later stage only renamed the
+sequences (like visualize does, mt1, mt2...), the cached depth is projected
+onto the new ids instead of mapping all over again.
+'''
+
+import os
+import sys
+import shutil
+from os import path
+
+try:
+    sys.path.insert(0, os.path.abspath(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..")))
+    from utility.helper import direct_call
+    from utility.cache import Cache, file_stamp
+    from utility.bio.seq import sequence_digest
+    from utility import logger
+except ImportError as err:
+    sys.exit(
+        f"Unable to import helper module {err.name}, is the installation of MitoFlex valid?")
+
+
+def map_reads(fasta_file=None, fastq1=None, fastq2=None, cache_dir=None, threads=8, quality=30):
+    '''
+    Map reads onto the fasta file, returns the sorted bam and the per-base depth
+    file (samtools depth -aa) whose sequence ids are the ones in fasta_file.
+    '''
+    fasta_file = path.abspath(fasta_file)
+    cache = Cache(cache_dir)
+
+    digest, ids = sequence_digest(fasta_file)
+    key = Cache.key(digest, file_stamp(fastq1), file_stamp(fastq2), quality)
+
+    entry = cache.lookup(key)
+    if entry is None:
+        logger.log(2, "Mapping fastq reads back onto fasta file.")
+        with cache.create(key) as staging:
+            reference = path.join(staging, 'reference.fa')
+            shutil.copy(fasta_file, reference)
+            direct_call(f'bwa index {reference}')
+
+            # Mapping is heavier than filtering and sorting, so a larger part
+            # of the threads is given to bwa mem.
+            bam_sorted_file = path.join(staging, 'sorted.bam')
+            direct_call(
+                f'bwa mem -t {max(1, int(threads*0.75))} {reference} {fastq1} {fastq2 if fastq2 is not None else ""} |'
+                f'samtools view -bS -q {quality} -h -@ {max(1, int(threads*0.25))} - |'
+                f'samtools sort -@ {threads} -o {bam_sorted_file} -')
+            direct_call(f'samtools depth -aa {bam_sorted_file} > {path.join(staging, "depth.txt")}')
+
+            with open(path.join(staging, 'ids.txt'), 'w') as f:
+                print(*ids, sep='\n', file=f)
+        entry = cache.lookup(key)
+    else:
+        logger.log(2, "Reusing cached mapping of the same sequences.")
+
+    bam_sorted_file = path.join(entry, 'sorted.bam')
+    depth_file = path.join(entry, 'depth.txt')
+
+    with open(path.join(entry, 'ids.txt')) as f:
+        mapped_ids = f.read().split()
+    if mapped_ids == ids:
+        return bam_sorted_file, depth_file
+
+    # Sequences are the same but renamed, project the depth onto new ids.
+    renamed = dict(zip(mapped_ids, ids))
+    projected = path.join(entry, f'depth.{Cache.key(*ids)}.txt')
+    if not path.isfile(projected):
+        logger.log(1, "Projecting cached depth onto renamed sequences.")
+        with open(depth_file) as fin, open(projected + '.tmp', 'w') as fout:
+            for line in fin:
+                seq_id, rest = line.split('\t', 1)
+                fout.write(f'{renamed[seq_id]}\t{rest}')
+        os.rename(projected + '.tmp', projected)
+
+    return bam_sorted_file, projected
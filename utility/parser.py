@@ -341,7 +341,7 @@ def freeze_arguments(prog, desc):
     return main_parser
 
 
-def parse_then_call(expr, pre=None, post=None):
+def parse_then_call(expr, pre=None, post=None, argv=None):
     '''
     Analyze the parser information, then call a certain function with the name
     registered with parse_func before.
@@ -358,8 +358,11 @@ def parse_then_call(expr, pre=None, post=None):
     not yet called.
 
     post : Callback function when the command is executed.
+
+    argv : Arguments to parse instead of the ones of the command line, like the
+    arguments of a job sent to a served MitoFlex.
     '''
-    args = expr.parse_args()
+    args = expr.parse_args(argv)
     parsed = vars(args)
 
     parsed = {str(x).replace('-', '_'): parsed[x] for x in parsed}
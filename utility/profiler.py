@@ -0,0 +1,196 @@
+"""
+profiler.py
+=========
+
+Copyright (c) 2019-2020 Li Junyu <2018301050@szu.edu.cn>.
+
+This file is part of MitoFlex.
+
+MitoFlex is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MitoFlex is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+'''
+Spans of a run, like stages, k-mer iterations and calls of external programs.
+
+A span records its wall time, the CPU time of the child processes finished
+meanwhile, the peak RSS of MitoFlex and its children so far, and the bytes
+they read and wrote. Spans are nested by the thread they run in, and the
+finished ones are written as a Chrome trace (chrome://tracing or
+ui.perfetto.dev) and a table of the stages.
+
+Resource usage is only counted for the whole process, so when stages run at
+once, a stage also counts the programs of others finished meanwhile. Calls
+of external programs are measured by their own processes instead.
+'''
+
+import json
+import os
+import resource
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+_local = threading.local()
+_lock = threading.Lock()
+_spans = []
+_origin = perf_counter()
+
+
+class Span():
+    def __init__(self, name, kind='step', parent=None, args=None):
+        self.name = name
+        self.kind = kind
+        self.parent = parent
+        self.args = args or {}
+        self.thread = threading.get_ident()
+        self.start = self.end = None
+        self.cpu = 0
+        self.rss = 0
+        self.read = self.written = 0
+        self._usage = None
+        self._accounted = None
+
+    @property
+    def elapsed(self):
+        return (self.end if self.end is not None else perf_counter()) - self.start
+
+    def within(self, other):
+        parent = self.parent
+        while parent is not None:
+            if parent is other:
+                return True
+            parent = parent.parent
+        return False
+
+    def open(self):
+        self._usage = _usage()
+        self.start = perf_counter()
+
+    def account(self, cpu, rss, read, written):
+        # Usage known exactly, like the one of reaped processes, is kept when closed
+        self._accounted = (cpu, rss, read, written)
+
+    def close(self):
+        self.end = perf_counter()
+        if self._accounted is not None:
+            self.cpu, self.rss, self.read, self.written = self._accounted
+        else:
+            cpu_end, self.rss, read_end, written_end = _usage()
+            cpu, _, read, written = self._usage
+            self.cpu = cpu_end - cpu
+            self.read = read_end - read
+            self.written = written_end - written
+        with _lock:
+            _spans.append(self)
+
+
+def _usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in KB, and blocks are of 512 bytes on Linux
+    return (children.ru_utime + children.ru_stime,
+            max(own.ru_maxrss, children.ru_maxrss) * 1024,
+            (own.ru_inblock + children.ru_inblock) * 512,
+            (own.ru_oublock + children.ru_oublock) * 512)
+
+
+def current():
+    return getattr(_local, 'span', None)
+
+
+@contextmanager
+def span(name, kind='step', parent=None, **args):
+    '''
+    Records the block as a span inside the running span of this thread, or
+    the given parent for a new thread. Extra arguments are kept in the trace.
+    '''
+    previous = current()
+    record = Span(name, kind, previous or parent, args)
+    _local.span = record
+    record.open()
+    try:
+        yield record
+    finally:
+        record.close()
+        _local.span = previous
+
+
+def reset():
+    # Drops the spans recorded, like the ones of a server before forking a job
+    global _origin
+    with _lock:
+        _spans.clear()
+    _local.span = None
+    _origin = perf_counter()
+
+
+def after_fork():
+    # Another thread could hold the lock copied by fork, and the spans of the
+    # parent are not the child's to write.
+    global _lock
+    _lock = threading.Lock()
+    reset()
+
+
+def spans():
+    with _lock:
+        return sorted(_spans, key=lambda x: x.start)
+
+
+def write_trace(trace_file=None):
+    '''
+    Writes the spans in the Chrome trace event format.
+    '''
+    recorded = spans()
+    threads = {}
+    events = []
+    for record in recorded:
+        events.append({
+            'name': record.name,
+            'cat': record.kind,
+            'ph': 'X',
+            'ts': round((record.start - _origin) * 1e6),
+            'dur': round((record.end - record.start) * 1e6),
+            'pid': os.getpid(),
+            'tid': threads.setdefault(record.thread, len(threads)),
+            'args': {
+                'child_cpu_s': round(record.cpu, 3),
+                'peak_rss_mb': round(record.rss / 1024**2, 1),
+                'read_mb': round(record.read / 1024**2, 1),
+                'written_mb': round(record.written / 1024**2, 1),
+                **{key: str(value) for key, value in record.args.items()}
+            }
+        })
+    with open(trace_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return trace_file
+
+
+def write_summary(summary_file=None):
+    '''
+    Writes a table of the stages, or of the outermost spans if the run has
+    no stages.
+    '''
+    recorded = spans()
+    stages = [x for x in recorded if x.kind == 'stage'] or [x for x in recorded if x.parent is None]
+    with open(summary_file, 'w') as f:
+        print('stage', 'wall_s', 'child_cpu_s', 'peak_rss_mb', 'read_mb', 'written_mb', 'calls',
+              sep='\t', file=f)
+        for stage in stages:
+            calls = sum(x.kind == 'call' and x.within(stage) for x in recorded)
+            print(stage.name, f'{stage.elapsed:.2f}', f'{stage.cpu:.2f}', f'{stage.rss / 1024**2:.1f}',
+                  f'{stage.read / 1024**2:.1f}', f'{stage.written / 1024**2:.1f}', calls,
+                  sep='\t', file=f)
+    return summary_file
@@ -0,0 +1,356 @@
+"""
+runner.py
+=========
+
+Copyright (c) 2019-2020 Li Junyu <2018301050@szu.edu.cn>.
+
+This file is part of MitoFlex.
+
+MitoFlex is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MitoFlex is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+'''
+Running external programs without a shell.
+
+A command is an argv list, or a command line like the ones made by
+concat_command. Command lines of plain arguments, pipes between programs
+and a '>' or '>>' redirection at the end are run directly, anything else,
+like globs or variables, is left to /bin/sh. Output can be returned,
+written to a file or read line by line, and only the end of stderr is kept
+to tell why a program failed.
+
+Every call is a profiler span with the CPU time, peak RSS and I/O of its
+own processes, as reported by wait4 when they are reaped.
+
+Programs stay in the process group of MitoFlex, so a hangup or Ctrl-C of
+the terminal reaches them as well. cancel() kills the programs of this
+process, and the ones called by the workers of pools made by process_pool.
+'''
+
+import os
+import re
+import shlex
+import signal
+import subprocess
+import threading
+import weakref
+from os import path
+from . import logger
+from . import profiler
+from .profiler import Span, current
+
+# Bytes of stderr kept for the error message of a failed call
+stderr_tail = 8192
+
+# Characters only a shell could deal with
+_shell_chars = re.compile(r'[;&<$`(){}*?~\[\]\n]|(^|\s)\d+>')
+
+# Reentrant, since cancel() is called from signal handlers
+_lock = threading.RLock()
+_running = set()
+_pools = weakref.WeakSet()
+
+
+class CallError(RuntimeError):
+    def __init__(self, command, returncode=None, stderr='', reason=None):
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+        self.reason = reason
+        super().__init__(
+            f"Error when running command '{command}'"
+            f"{f', {reason}' if reason else f', exited with {returncode}'}. Exiting."
+            + (f'\nEnd of its stderr :\n{stderr}' if stderr else ''))
+
+    def __reduce__(self):
+        # Raised again in the parent of a process pool
+        return CallError, (self.command, self.returncode, self.stderr, self.reason)
+
+
+def parse(command=None):
+    '''
+    Splits a command into the argv of each program piped, and the file the
+    output is redirected to with its mode. Returns None for the argv if the
+    command needs a shell.
+    '''
+    if not isinstance(command, str):
+        return [[str(x) for x in command]], None, None
+    if _shell_chars.search(command):
+        return None, None, None
+
+    if '|' in command or '>' in command:
+        # Pipes and redirections are split by hand, so quoting them is left to the shell
+        if re.search(r'[\'"\\]', command):
+            return None, None, None
+        tokens = re.findall(r'>>|[|>]|[^\s|>]+', command)
+    else:
+        try:
+            tokens = shlex.split(command)
+        except ValueError:
+            return None, None, None
+
+    redirect = mode = None
+    if len(tokens) > 2 and tokens[-2] in ('>', '>>'):
+        redirect, mode = tokens[-1], 'ab' if tokens[-2] == '>>' else 'wb'
+        tokens = tokens[:-2]
+    if '>' in tokens or '>>' in tokens or redirect in ('|', '>', '>>'):
+        return None, None, None
+
+    stages = [[]]
+    for token in tokens:
+        if token == '|':
+            stages.append([])
+        else:
+            stages[-1].append(token)
+    if not all(stages) or any('=' in x[0] for x in stages):
+        return None, None, None
+    return stages, redirect, mode
+
+
+class Call():
+    '''
+    Processes of a running command. stdout is None to read the output
+    through out, or a file path or an opened file to write it into.
+    '''
+
+    def __init__(self, command=None, stdout=None, cwd=None, env=None, timeout=None):
+        self.command = command if isinstance(command, str) else ' '.join(shlex.quote(str(x)) for x in command)
+        self.cwd = cwd
+        self.env = env
+        self.timeout = timeout
+        self.processes = []
+        self.out = None
+        self.reason = None
+        self.tail = b''
+        self.usage = (0, 0, 0, 0)
+
+        stages, redirect, mode = parse(command)
+        if redirect is not None:
+            if stdout is not None:
+                raise CallError(self.command, reason='its output is redirected twice')
+            stdout = path.join(cwd, redirect) if cwd else redirect
+        name = path.basename(stages[0][0]) if stages is not None else self.command.split(' ', 1)[0]
+        self.stages = stages or [['/bin/sh', '-c', command]]
+        self.record = Span(name, 'call', current(), {'command': self.command[:500]})
+
+        self.record.open()
+        stderr_read, stderr_write = os.pipe()
+        try:
+            if isinstance(stdout, str):
+                target = open(stdout, mode or 'wb')
+            else:
+                target = subprocess.PIPE if stdout is None else stdout
+            try:
+                self._spawn(target, stderr_write)
+            finally:
+                if isinstance(stdout, str):
+                    target.close()
+        except BaseException:
+            os.close(stderr_read)
+            self.kill()
+            self._reap()
+            raise
+        finally:
+            os.close(stderr_write)
+
+        self.stderr = threading.Thread(target=self._read_stderr, args=(stderr_read,), daemon=True)
+        self.stderr.start()
+        self.timer = None
+        if timeout is not None:
+            self.timer = threading.Timer(timeout, self.kill, args=(f'timed out after {timeout}s',))
+            self.timer.daemon = True
+            self.timer.start()
+        with _lock:
+            _running.add(self)
+
+    def _spawn(self, target, stderr_write):
+        stdin = None
+        for idx, argv in enumerate(self.stages):
+            last = idx == len(self.stages) - 1
+            try:
+                process = subprocess.Popen(argv, stdin=stdin, stdout=target if last else subprocess.PIPE,
+                                           stderr=stderr_write, cwd=self.cwd, env=self.env)
+            except OSError as err:
+                raise CallError(self.command, reason=f'{argv[0]} cannot be started : {err.strerror}')
+            finally:
+                if stdin is not None:
+                    stdin.close()
+            self.processes.append(process)
+            stdin = process.stdout
+        self.out = self.processes[-1].stdout
+
+    def _read_stderr(self, fd):
+        with open(fd, 'rb') as f:
+            for chunk in iter(lambda: f.read1(65536), b''):
+                self.tail = (self.tail + chunk)[-stderr_tail:]
+
+    def kill(self, reason='cancelled'):
+        alive = [x for x in self.processes if x.returncode is None]
+        if alive:
+            self.reason = self.reason or reason
+        # Programs started by a shell or by the program itself are killed as well
+        pids = [x.pid for x in alive]
+        for process in alive:
+            try:
+                import psutil
+                pids += [x.pid for x in psutil.Process(process.pid).children(recursive=True)]
+            except Exception:
+                # The programs themselves are still killed
+                pass
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def _reap(self):
+        cpu, rss, read, written = self.usage
+        for process in self.processes:
+            if process.returncode is not None:
+                continue
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            # ru_maxrss is in KB, and blocks are of 512 bytes on Linux
+            cpu += usage.ru_utime + usage.ru_stime
+            rss = max(rss, usage.ru_maxrss * 1024)
+            read += usage.ru_inblock * 512
+            written += usage.ru_oublock * 512
+            self.usage = (cpu, rss, read, written)
+        self.record.account(*self.usage)
+
+    def wait(self, check=True):
+        '''
+        Waits for the processes, and raises CallError if any failed when
+        check is True.
+        '''
+        try:
+            if self.out is not None:
+                self.out.close()
+            self._reap()
+        except BaseException:
+            self.kill()
+            self._reap()
+            raise
+        finally:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.stderr.join()
+            with _lock:
+                _running.discard(self)
+            self.record.close()
+
+        # Programs feeding a later one are fine to be stopped by a closed pipe
+        failed = [x.returncode for x in self.processes[:-1] if x.returncode not in (0, -signal.SIGPIPE)]
+        returncode = failed[0] if failed else self.processes[-1].returncode
+        if check and (self.reason is not None or returncode != 0):
+            raise CallError(self.command, returncode, self.tail.decode('utf-8', 'replace').strip(), self.reason)
+
+
+def run(command=None, stdout=None, cwd=None, env=None, timeout=None):
+    '''
+    Runs the command, returns its output decoded, or an empty string if the
+    output is written to stdout, a file path or an opened file.
+    '''
+    call = Call(command, stdout, cwd, env, timeout)
+    try:
+        output = call.out.read() if call.out is not None else b''
+    except BaseException:
+        call.kill()
+        call.wait(check=False)
+        raise
+    call.wait()
+    return output.decode('utf-8')
+
+
+def stream(command=None, cwd=None, env=None, timeout=None):
+    '''
+    Runs the command and yields its output line by line, the programs are
+    killed if the lines are not all read.
+    '''
+    call = Call(command, None, cwd, env, timeout)
+    try:
+        for line in call.out:
+            yield line.decode('utf-8')
+    except BaseException:
+        call.kill()
+        call.wait(check=False)
+        raise
+    call.wait()
+
+
+def process_pool(processes=1):
+    '''
+    A multiprocessing pool, whose workers cancel their calls when cancel()
+    is called here, and when the pool is terminated.
+    '''
+    import multiprocessing
+    pool = multiprocessing.Pool(processes=processes, initializer=_init_worker)
+    with _lock:
+        _pools.add(pool)
+    return pool
+
+
+def _init_worker():
+    global _lock
+    # Pools are made from the threads of stages and tracks, so locks copied
+    # by fork could be held by a thread not in the worker. Calls and pools of
+    # the parent are copied as well, but not to be cancelled here.
+    _lock = threading.RLock()
+    _running.clear()
+    _pools.clear()
+    profiler.after_fork()
+    try:
+        # Imported before any signal handler needs it
+        import psutil  # noqa: F401
+    except ImportError:
+        pass
+    signal.signal(signal.SIGUSR1, lambda *_: _kill_calls())
+    signal.signal(signal.SIGTERM, _stop_worker)
+
+
+def _stop_worker(signum, frame):
+    # Nothing is logged, the handler could interrupt another one writing the log
+    try:
+        _kill_calls()
+    finally:
+        os._exit(128 + signum)
+
+
+def _kill_calls():
+    with _lock:
+        calls = list(_running)
+    for call in calls:
+        call.kill()
+    return calls
+
+
+def cancel():
+    '''
+    Kills the programs of all running calls, the calls then raise CallError.
+    '''
+    calls = _kill_calls()
+    if calls:
+        logger.log(3, f'Cancelled {len(calls)} running commands.')
+    with _lock:
+        pools = list(_pools)
+
+    # Workers cancel their own calls when signalled, the pool keeps the workers as _pool
+    for pool in pools:
+        for worker in list(getattr(pool, '_pool', [])):
+            if worker.exitcode is None:
+                try:
+                    os.kill(worker.pid, signal.SIGUSR1)
+                except OSError:
+                    pass
@@ -0,0 +1,187 @@
+"""
+server.py
+=========
+
+Copyright (c) 2019-2020 Li Junyu <2018301050@szu.edu.cn>.
+
+This file is part of MitoFlex.
+
+MitoFlex is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MitoFlex is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+'''
+A long running MitoFlex taking jobs from a local Unix socket.
+
+The served process has the modules, the taxonomy database and the profiles
+loaded already, and forks a worker for every job, so jobs start warm instead
+of loading everything again. Output of the worker is sent back through the
+socket, followed by a NUL and the exit code of the job.
+'''
+
+import json
+import os
+import select
+import signal
+import socket
+import sys
+from os import path
+
+try:
+    sys.path.insert(0, os.path.abspath(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..")))
+    from utility import logger
+    import configurations
+except ImportError as err:
+    sys.exit(
+        f"Unable to import helper module {err.name}, is the installation of MitoFlex valid?")
+
+
+def serve(socket_path=None, run_job=None, workers=4):
+    '''
+    Serves jobs until interrupted. run_job is called in the worker with the
+    arguments of the job after changing to the folder of the client, and
+    returns the exit code.
+    '''
+    socket_path = path.abspath(socket_path or configurations.serve.socket)
+    os.makedirs(path.dirname(socket_path), exist_ok=True)
+    if path.exists(socket_path):
+        # A socket left by a dead server is removed, a living one is kept
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.remove(socket_path)
+        else:
+            raise RuntimeError(f'Another MitoFlex is already serving at {socket_path}.')
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(16)
+    logger.log(2, f'Serving at {socket_path} with {workers} workers.')
+
+    # Stopped by kill as well, the socket is then removed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    jobs = {}
+    try:
+        while True:
+            # Clients wait in the backlog if all the workers are busy
+            readable, _, _ = select.select([server] if len(jobs) < workers else [], [], [], 0.5)
+            if readable:
+                conn, _ = server.accept()
+                try:
+                    conn.settimeout(5)
+                    with conn.makefile('rb') as f:
+                        request = json.loads(f.readline().decode())
+                    conn.settimeout(None)
+                except (OSError, ValueError) as err:
+                    logger.log(3, f'Invalid job request : {err}')
+                    conn.close()
+                    continue
+
+                pid = os.fork()
+                if pid == 0:
+                    server.close()
+                    _run_worker(conn, request, run_job)
+                jobs[pid] = conn
+                logger.log(2, f'Job {pid} started : {" ".join(request["argv"])}')
+
+            while jobs:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                conn = jobs.pop(pid, None)
+                if conn is None:
+                    continue
+                code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+                try:
+                    conn.sendall(f'\0{code}\n'.encode())
+                except OSError:
+                    pass
+                conn.close()
+                logger.log(2, f'Job {pid} exited with {code}.')
+    finally:
+        server.close()
+        os.remove(socket_path)
+        for conn in jobs.values():
+            conn.close()
+
+
+def _run_worker(conn, request, run_job):
+    code = 1
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.chdir(request['cwd'])
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(conn.fileno(), 1)
+        os.dup2(conn.fileno(), 2)
+        conn.close()
+        sys.stdout = open(1, 'w', buffering=1, closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, closefd=False)
+        code = run_job(request['argv'])
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code if isinstance(code, int) and 0 <= code < 256 else 1)
+
+
+def submit(argv=None):
+    '''
+    Sends a job to the served MitoFlex and prints its output, returns the
+    exit code of the job. argv is [--socket <FILE>] <command> <arguments>.
+    '''
+    socket_path = configurations.serve.socket
+    if argv[:1] == ['--socket'] and len(argv) > 1:
+        socket_path, argv = argv[1], argv[2:]
+    if not argv:
+        print('Usage : MitoFlex.py submit [--socket <FILE>] <command> <arguments>')
+        return 1
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path.abspath(socket_path))
+    except OSError:
+        print(f'No MitoFlex is serving at {socket_path}, start one with MitoFlex.py serve.')
+        return 1
+
+    with client:
+        client.sendall((json.dumps({'argv': argv, 'cwd': os.getcwd()}) + '\n').encode())
+        out = sys.stdout.buffer
+        trailer = None
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            if trailer is None:
+                head, sep, rest = chunk.partition(b'\0')
+                out.write(head)
+                out.flush()
+                if sep:
+                    trailer = rest
+            else:
+                trailer += chunk
+
+    if trailer is None:
+        print('The job was interrupted before it finished.')
+        return 1
+    return int(trailer.strip() or 1)
@@ -0,0 +1,128 @@
+"""
+stages.py
+=========
+
+Copyright (c) 2019-2020 Li Junyu <2018301050@szu.edu.cn>.
+
+This file is part of MitoFlex.
+
+MitoFlex is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MitoFlex is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+'''
+Running the stages of a pipeline by what they depend on.
+
+A stage starts once all the stages it depends on are done, and stages ready
+at the same time run in parallel if the threads they take are within the
+budget. Stages are run in threads, since they mostly wait for the external
+programs they call.
+'''
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from . import logger
+from .profiler import span, current
+from .runner import cancel
+
+
+class Stage():
+    def __init__(self, name, func, after=(), threads=1):
+        self.name = name
+        self.func = func
+        self.after = tuple(after)
+        self.threads = threads
+        self.elapsed = None
+
+
+class StageGraph():
+    '''
+    Stages should be added after the stages they depend on, so there could
+    be no cycle. on_change is called with the names of running stages every
+    time some stages start.
+    '''
+
+    def __init__(self, threads=1, on_change=None):
+        self.threads = threads
+        self.on_change = on_change
+        self.stages = {}
+
+    def add(self, name, func, after=(), threads=1):
+        if name in self.stages:
+            raise RuntimeError(f'Stage {name} is added twice.')
+        for dependency in after:
+            if dependency not in self.stages:
+                raise RuntimeError(f'Stage {name} depends on {dependency}, which is not added before it.')
+        self.stages[name] = Stage(name, func, after, min(threads, self.threads))
+
+    def run(self):
+        '''
+        Runs all the stages, the first error raised by a stage is raised
+        again after the programs called by the running stages are killed.
+        '''
+        pending = list(self.stages.values())
+        parent = current()
+        running = {}
+        done = set()
+        error = None
+
+        with ThreadPoolExecutor(max_workers=max(1, len(pending))) as pool:
+            try:
+                while pending or running:
+                    started = False
+                    for stage in list(pending) if error is None else []:
+                        used = sum(x.threads for x in running.values())
+                        if any(x not in done for x in stage.after):
+                            continue
+                        if running and used + stage.threads > self.threads:
+                            continue
+                        pending.remove(stage)
+                        logger.log(1, f'Stage {stage.name} started with {stage.threads} threads.')
+                        running[pool.submit(self._run_stage, stage, parent)] = stage
+                        started = True
+                    if started and callable(self.on_change):
+                        self.on_change([x.name for x in running.values()])
+                    if not running:
+                        break
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        stage = running.pop(future)
+                        try:
+                            future.result()
+                        except BaseException as err:
+                            if error is None:
+                                # Other stages are stopped instead of running on
+                                error = err
+                                cancel()
+                            continue
+                        done.add(stage.name)
+                        logger.log(2, f'Stage {stage.name} finished in {stage.elapsed:.2f}s.')
+            except BaseException:
+                # Programs of the running stages are killed instead of waited for
+                cancel()
+                raise
+
+        if error is not None:
+            raise error
+        logger.log(2, 'Time of stages : ' + ', '.join(
+            f'{x.name} {x.elapsed:.2f}s' for x in self.stages.values()))
+
+    @staticmethod
+    def _run_stage(stage, parent=None):
+        # Stages run in other threads, so they are put into the span of run()
+        with span(stage.name, kind='stage', parent=parent) as record:
+            try:
+                return stage.func()
+            finally:
+                stage.elapsed = record.elapsed
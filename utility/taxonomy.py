@@ -0,0 +1,40 @@
+"""
+taxonomy.py
+=========
+
+Copyright (c) 2019-2020 Li Junyu <2018301050@szu.edu.cn>.
+
+This file is part of MitoFlex.
+
+MitoFlex is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MitoFlex is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MitoFlex.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+'''
+The NCBI taxonomy database of ete3.
+
+Importing ete3 and opening its database takes a while, so it's only done
+the first time the database is used, and the handle is kept for the rest of
+the process.
+'''
+
+_ncbi = None
+
+
+def taxonomy():
+    global _ncbi
+    if _ncbi is None:
+        from ete3 import NCBITaxa
+        _ncbi = NCBITaxa()
+    return _ncbi
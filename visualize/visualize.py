@@ -29,7 +29,8 @@ from os import path
 try:
     sys.path.insert(0, os.path.abspath(os.path.join(
         os.path.dirname(os.path.abspath(__file__)), "..")))
-    from utility.helper import shell_call
+    from utility.helper import direct_call
+    from utility.mapping import map_reads
     from Bio import SeqIO
     from utility.bio import circos
     from visualize import circos_config
@@ -39,30 +40,83 @@ except ImportError as err:
         f"Unable to import helper module {err.name}, is the installation of MitoFlex valid?")
 
 
-def visualize(fasta_file=None, fastq1=None, fastq2=None, pos_json=None,
-              prefix=None, basedir=None, threads=8, circular=False):
-    logger.log(2, 'Entering visualize module.')
-    # Validate the paths
+def rename_sequences(fasta_file=None):
+    # Rename to a easier form, mt1, mt2...
+    renamed = []
+    for counter, seq in enumerate(SeqIO.parse(fasta_file, 'fasta'), 1):
+        seq.id_old = seq.id
+        seq.id = f'mt{counter}'
+        seq.description = ''
+        renamed.append(seq)
+    return renamed
+
+
+def depth_track(fasta_file=None, fastq1=None, fastq2=None, prefix=None, basedir=None, threads=8, cache_dir=None):
+    '''
+    Maps the reads onto the renamed sequences, returns the depth file for
+    circos and the max depth.
+    '''
     fasta_file = path.abspath(fasta_file)
     fastq1 = path.abspath(fastq1)
     if fastq2 != None:
         fastq2 = path.abspath(fastq2)
     basedir = path.abspath(basedir)
+
+    fa_copy = path.join(basedir, f'{prefix}.depth.fasta')
+    SeqIO.write(rename_sequences(fasta_file), fa_copy, 'fasta')
+
+    logger.log(1, 'Generating depth files.')
+    _, gene_depth_file = map_reads(fasta_file=fa_copy, fastq1=fastq1, fastq2=fastq2,
+                                   cache_dir=cache_dir if cache_dir is not None else path.join(basedir, 'mapping'),
+                                   threads=threads)
+
+    # Calculate the things
+    circos_depth_file = path.join(basedir, f'{prefix}.depth.txt')
+    max_gene_depth = 0
+    with open(gene_depth_file, 'r') as gdf, open(circos_depth_file, 'w') as cdf:
+        for line in gdf:
+            content = str(line).rstrip().split()
+            print(' '.join([content[0], content[1],
+                            content[1], content[2]]), file=cdf)
+            if int(content[2]) > max_gene_depth:
+                max_gene_depth = int(content[2])
+
+    return circos_depth_file, max_gene_depth
+
+
+def gc_track(fasta_file=None, prefix=None, basedir=None):
+    '''
+    Writes the GC content of every 50bp of the renamed sequences.
+    '''
+    gc_content_file = path.join(path.abspath(basedir), f'{prefix}.gc.txt')
+    with open(gc_content_file, 'w') as gc_f:
+        for seq in rename_sequences(path.abspath(fasta_file)):
+            # Stepping 50 to walk through
+            for s in range(0, len(seq), 50):
+                seq_slice = seq[s:s + 50]
+                gc_num = sum(x == 'G' or x == 'C' for x in seq_slice)
+                gc_per = gc_num / len(seq_slice)
+                print(seq.id, s, s + len(seq_slice), gc_per, file=gc_f)
+    return gc_content_file
+
+
+def visualize(fasta_file=None, fastq1=None, fastq2=None, pos_json=None,
+              prefix=None, basedir=None, threads=8, circular=False, cache_dir=None,
+              depth=None, gc_file=None):
+    '''
+    Draws the genome with circos. The depth track (file, max depth) and the
+    GC track made before, like in parallel with the annotation, are used if
+    given.
+    '''
+    logger.log(2, 'Entering visualize module.')
+    # Validate the paths
+    fasta_file = path.abspath(fasta_file)
+    basedir = path.abspath(basedir)
     pos_json = path.abspath(pos_json)
 
     fa_copy = path.join(basedir, f'{prefix}.fasta')
-    list_conv = []
-    counter = 1
-
-    # Rename to a easier form
-    index_list = {}
-    for seq in SeqIO.parse(fasta_file, 'fasta'):
-        index_list[seq.id] = f'mt{counter}'
-        seq.id_old = seq.id
-        seq.id = f'mt{counter}'
-        seq.description = ''
-        list_conv.append(seq)
-        counter += 1
+    list_conv = rename_sequences(fasta_file)
+    index_list = {seq.id_old: seq.id for seq in list_conv}
     SeqIO.write(list_conv, fa_copy, 'fasta')
 
     with open(pos_json, 'r') as f:
@@ -95,42 +149,13 @@ def visualize(fasta_file=None, fastq1=None, fastq2=None, pos_json=None,
             print(strand_conv, end, end,
                   f'fill_color=black,r0={r0}r,r1={r1}r', file=gf_f, sep='\t')
 
-    logger.log(1, 'Generating depth files.')
-    # Using check_output directly because being too lazy to remove decoder
-    from subprocess import check_output
-
-    shell_call('bwa index', fa_copy)
-    bam_file = path.join(basedir, f'{prefix}.bam')
-    check_output(
-        f'bwa mem -t {threads} {fa_copy} {fastq1} {fastq2 if fastq2!=None else ""} |samtools view -bS -q 30 -h -o {bam_file} -', shell=True)
-    bam_sorted_file = path.join(basedir, f'{prefix}.sorted.bam')
-    check_output(f'samtools sort -o {bam_sorted_file} {bam_file}', shell=True)
-    gene_depth_file = path.join(basedir, f'{prefix}.dep')
-    check_output(
-        f'samtools depth -aa {bam_sorted_file} > {gene_depth_file}', shell=True)
-
-    # Calculate the things
-    circos_depth_file = path.join(basedir, f'{prefix}.depth.txt')
-    max_gene_depth = 0
-    with open(gene_depth_file, 'r') as gdf, open(circos_depth_file, 'w') as cdf:
-        for line in gdf:
-            content = str(line).rstrip().split()
-            print(' '.join([content[0], content[1],
-                            content[1], content[2]]), file=cdf)
-            if int(content[2]) > max_gene_depth:
-                max_gene_depth = int(content[2])
+    circos_depth_file, max_gene_depth = depth if depth is not None else depth_track(
+        fasta_file=fasta_file, fastq1=fastq1, fastq2=fastq2, prefix=prefix, basedir=basedir,
+        threads=threads, cache_dir=cache_dir)
 
     # GC content
-    # Reusing conv-list here, as it's not deleted in the scope
-    gc_content_file = path.join(basedir, f'{prefix}.gc.txt')
-    with open(gc_content_file, 'w') as gc_f:
-        for seq in list_conv:
-            # Stepping 50 to walk through
-            for s in range(0, len(seq), 50):
-                seq_slice = seq[s:s + 50]
-                gc_num = sum(x == 'G' or x == 'C' for x in seq_slice)
-                gc_per = gc_num / len(seq_slice)
-                print(seq.id, s, s + len(seq_slice), gc_per, file=gc_f)
+    gc_content_file = gc_file if gc_file is not None else gc_track(
+        fasta_file=fasta_file, prefix=prefix, basedir=basedir)
 
     # Karyotype
     logger.log(1, 'Generating chr files.')
@@ -178,7 +203,7 @@ def visualize(fasta_file=None, fastq1=None, fastq2=None, pos_json=None,
 
     logger.log(1, 'Running Circos.')
     try:
-        check_output('circos', shell=True, cwd=basedir)
+        direct_call('circos', cwd=basedir)
     except Exception:
         logger.log(4, "Running circos errored, no graph is outputted!")
 